@@ -0,0 +1,262 @@
+"""On-disk index of the certificate bundles uploaded to Nginx Unit.
+
+Maps the common name and the subject alternative names of every bundle to
+the bundle names, with their expiry and key type, so that finding the bundles
+replaced by a deploy does not need to read and parse the whole
+``/certificates`` of Unit.
+
+"""
+import hashlib
+import json
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set
+
+from certbot import errors
+from certbot.compat import filesystem
+from certbot.compat import os
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+UNIT_VALIDITY_FORMAT = "%b %d %H:%M:%S %Y GMT"
+
+
+def unit_key_type(key: Any) -> Optional[str]:
+    """Key type of a Unit ``key`` description ("RSA (2048 bits)", "ECDH (prime256v1)"), None if unknown."""
+    name = key.split(" ", 1)[0].upper() if isinstance(key, str) and key else ""
+    if name in ("EC", "ECDH", "ECDSA"):
+        return "EC"
+    return name or None
+
+
+def bundle_fingerprint(bundle: bytes) -> str:
+    """Fingerprint of the content (private key and fullchain) of a bundle."""
+    return "sha256:" + hashlib.sha256(bundle).hexdigest()
+
+
+def parse_certificate(pem: bytes) -> Dict[str, Any]:
+    """Index entry (common name, names, validity, key type) of the first certificate of ``pem``."""
+    # cryptography takes most of the import time of the command line tools: only imported when parsing
+    # pylint: disable=import-outside-toplevel
+    from cryptography import x509
+    from cryptography.hazmat.primitives.asymmetric import dsa, ec, ed448, ed25519, rsa
+    from cryptography.x509.oid import NameOID
+
+    # key types of the public keys, named like the Unit /certificates descriptions
+    key_types = ((rsa.RSAPublicKey, "RSA"), (ec.EllipticCurvePublicKey, "EC"), (dsa.DSAPublicKey, "DSA"),
+                 (ed25519.Ed25519PublicKey, "ED25519"), (ed448.Ed448PublicKey, "ED448"))
+    certificate = x509.load_pem_x509_certificate(pem)
+    common_names = certificate.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+    common_name = str(common_names[0].value) if common_names else ""
+    try:
+        extension = certificate.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+        alt_names = extension.value.get_values_for_type(x509.DNSName)
+    except x509.ExtensionNotFound:
+        alt_names = []
+    if hasattr(certificate, "not_valid_after_utc"):
+        not_before, not_after = certificate.not_valid_before_utc, certificate.not_valid_after_utc
+    else:
+        not_before = certificate.not_valid_before.replace(tzinfo=timezone.utc)
+        not_after = certificate.not_valid_after.replace(tzinfo=timezone.utc)
+    public_key = certificate.public_key()
+    key_type = next((name for key_class, name in key_types if isinstance(public_key, key_class)), None)
+    return {"common_name": common_name, "alt_names": alt_names, "not_before": not_before.isoformat(),
+            "not_after": not_after.isoformat(), "key_type": key_type}
+
+
+def _parse_unit_validity(value: Optional[str]) -> Optional[str]:
+    """ISO format of a Unit validity date ("May  2 13:57:59 2024 GMT"), None if unknown."""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, UNIT_VALIDITY_FORMAT).replace(tzinfo=timezone.utc).isoformat()
+    except ValueError:
+        logger.debug("Unknown certificate validity format: %s", value)
+        return None
+
+
+def parse_unit_certificate(certificate: Dict[str, Any]) -> Dict[str, Any]:
+    """Index entry of a bundle as described by the Unit ``/certificates`` API."""
+    chain = certificate.get("chain") or [{}]
+    subject = chain[0].get("subject", {})
+    validity = chain[0].get("validity", {})
+    return {
+        "common_name": subject.get("common_name", ""),
+        "alt_names": subject.get("alt_names", []),
+        "not_before": _parse_unit_validity(validity.get("since")),
+        "not_after": _parse_unit_validity(validity.get("until")),
+        "key_type": unit_key_type(certificate.get("key")),
+    }
+
+
+def slim_unit_certificate(bundle_name: str, certificate: Any) -> Dict[str, Any]:
+    """Fields of a Unit ``/certificates`` bundle description read by the index and the collector."""
+    chain = (certificate.get("chain") if isinstance(certificate, dict) else None) or [{}]
+    return {"key": certificate.get("key") if isinstance(certificate, dict) else None, "chain": [
+        {
+            "subject": {key: link.get("subject", {}).get(key) for key in ("common_name", "alt_names")
+                        if key in link.get("subject", {})} if position == 0 else {},
+            "validity": {key: link.get("validity", {}).get(key) for key in ("since", "until")},
+        }
+        for position, link in enumerate(chain)
+    ]}
+
+
+class BundleIndex:
+    """Certificate bundles uploaded to Unit, persisted as JSON in ``path``.
+
+    Several processes deploy with the same index: :meth:`save` writes the changes made
+    since the index was read over the index on disk, read again, and must be called
+    under the inter-process lock.
+
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.bundles: Dict[str, Dict[str, Any]] = {}
+        self.loaded = False
+        # entries added (and None for those removed) since the index was read
+        self._changes: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._by_common_name: Dict[str, Set[str]] = {}
+        self._by_name: Dict[str, Set[str]] = {}
+        self._by_fingerprint: Dict[str, Set[str]] = {}
+
+    def _link(self, bundle_name: str, entry: Dict[str, Any]) -> None:
+        self._by_common_name.setdefault(entry.get("common_name", ""), set()).add(bundle_name)
+        for name in [entry.get("common_name", "")] + entry.get("alt_names", []):
+            self._by_name.setdefault(name, set()).add(bundle_name)
+        if entry.get("fingerprint"):
+            self._by_fingerprint.setdefault(entry["fingerprint"], set()).add(bundle_name)
+
+    def _unlink(self, bundle_name: str, entry: Dict[str, Any]) -> None:
+        self._by_common_name.get(entry.get("common_name", ""), set()).discard(bundle_name)
+        for name in [entry.get("common_name", "")] + entry.get("alt_names", []):
+            self._by_name.get(name, set()).discard(bundle_name)
+        if entry.get("fingerprint"):
+            self._by_fingerprint.get(entry["fingerprint"], set()).discard(bundle_name)
+
+    def _insert(self, bundle_name: str, entry: Dict[str, Any]) -> None:
+        self._delete(bundle_name)
+        self.bundles[bundle_name] = entry
+        self._link(bundle_name, entry)
+
+    def _delete(self, bundle_name: str) -> None:
+        entry = self.bundles.pop(bundle_name, None)
+        if entry is not None:
+            self._unlink(bundle_name, entry)
+
+    def _set_bundles(self, bundles: Dict[str, Dict[str, Any]]) -> None:
+        self.bundles = {}
+        self._by_common_name = {}
+        self._by_name = {}
+        self._by_fingerprint = {}
+        for bundle_name, entry in bundles.items():
+            self._insert(bundle_name, entry)
+        self.loaded = True
+
+    def _read(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Bundles of the index on disk, None when there is no usable one."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exception:
+            logger.warning("Ignoring unreadable certificate bundle index %s: %s", self.path, exception)
+            return None
+        if not isinstance(data, dict) or data.get("version") != INDEX_VERSION:
+            return None
+        return data.get("bundles", {})
+
+    def load(self) -> bool:
+        """Load the index, False when there is no usable index on disk."""
+        bundles = self._read()
+        if bundles is None:
+            return False
+        self._set_bundles(bundles)
+        self._changes = {}
+        return True
+
+    def rebuild(self, certificates: Dict[str, Any]) -> None:
+        """Replace the index with the bundles of a Unit ``/certificates`` response."""
+        self._set_bundles({})
+        for name, certificate in certificates.items():
+            self.add(name, parse_unit_certificate(certificate))
+
+    def add(self, bundle_name: str, entry: Dict[str, Any]) -> None:
+        """Record the uploaded bundle ``bundle_name``."""
+        self._insert(bundle_name, entry)
+        self._changes[bundle_name] = entry
+
+    def remove(self, bundle_name: str) -> None:
+        """Forget the deleted bundle ``bundle_name``."""
+        if bundle_name in self.bundles:
+            self._delete(bundle_name)
+            self._changes[bundle_name] = None
+
+    def by_common_name(self, common_name: str) -> List[str]:
+        """Names of the bundles whose certificate has the given common name."""
+        return sorted(self._by_common_name.get(common_name, set()))
+
+    def by_name(self, domain: str) -> List[str]:
+        """Names of the bundles whose certificate covers ``domain`` (common name or SAN)."""
+        return sorted(self._by_name.get(domain, set()))
+
+    def by_fingerprint(self, fingerprint: str) -> List[str]:
+        """Names of the bundles uploaded with the content fingerprint ``fingerprint``."""
+        return sorted(self._by_fingerprint.get(fingerprint, set()))
+
+    def by_certificate(self, entry: Dict[str, Any]) -> List[str]:
+        """Names of the bundles without a fingerprint whose certificate is the one of ``entry``.
+
+        Unit does not describe the content of a bundle: the bundles indexed from ``/certificates``
+        are matched by the names, validity and key type of their certificate.
+
+        """
+        if not entry.get("not_before") or not entry.get("not_after"):
+            return []
+        fields = ("not_before", "not_after", "key_type")
+        return sorted(
+            bundle_name for bundle_name in self._by_common_name.get(entry.get("common_name", ""), set())
+            if not self.bundles[bundle_name].get("fingerprint")
+            and all(self.bundles[bundle_name].get(field) == entry.get(field) for field in fields)
+            and sorted(self.bundles[bundle_name].get("alt_names", [])) == sorted(entry.get("alt_names", [])))
+
+    def key_type(self, bundle_name: str) -> Optional[str]:
+        """Key type ("RSA", "EC") of the bundle, None if unknown."""
+        return self.bundles.get(bundle_name, {}).get("key_type")
+
+    def not_after(self, bundle_name: str) -> Optional[datetime]:
+        """Expiry of the bundle, None if unknown."""
+        value = self.bundles.get(bundle_name, {}).get("not_after")
+        return datetime.fromisoformat(value) if value else None
+
+    def save(self) -> None:
+        """Merge the changes into the index on disk, which is then read as the current index.
+
+        The bundles indexed or forgotten meanwhile by the other processes are kept as they are.
+
+        """
+        if not self._changes:
+            return
+        bundles = self._read()
+        if bundles is None:
+            bundles = dict(self.bundles)
+        for bundle_name, entry in self._changes.items():
+            if entry is None:
+                bundles.pop(bundle_name, None)
+            else:
+                bundles[bundle_name] = entry
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                filesystem.makedirs(directory, 0o700)
+        except OSError as exception:
+            raise errors.PluginError("Unable to create {0}: {1}".format(directory, exception))
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, "bundles": bundles}, f)
+        filesystem.replace(temporary_path, self.path)
+        self._set_bundles(bundles)
+        self._changes = {}
@@ -0,0 +1,245 @@
+"""Command line tools working on Nginx Unit outside of a certbot run."""
+import argparse
+import logging
+from typing import List, Optional
+
+from certbot import errors
+from certbot.compat import os
+
+from .bundle_index import BundleIndex
+from .collector import collect
+from .deployer import Deployer, split_addresses
+from .journal import pending_bundles
+from .lock import UnitLock, default_lock_path
+from .metrics import METRICS
+from .notify import use_printer
+from .scheduler import MaintenanceWindow
+from .session import SessionSettings
+from .unitc import create_unitc
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORK_DIR = "/var/lib/letsencrypt"
+DEFAULT_CONFIG_DIR = "/etc/letsencrypt"
+
+
+def _add_unit_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--control", default=None,
+                        help="Nginx Unit control socket path or TCP address host:port, certbot-nginx-unit-deploy "
+                             "accepts a comma separated list of them (default: autodetect the unix control socket)")
+    parser.add_argument("--unitc", action="store_true", default=False,
+                        help="Use the unitc command instead of talking to the control socket directly")
+    parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR,
+                        help="certbot working directory, holding the certificate bundle index "
+                             "(default: %(default)s)")
+    parser.add_argument("--concurrency", default=4, type=int,
+                        help="Maximum number of control API calls at the same time (default: %(default)s)")
+    parser.add_argument("--lock-file", default=None,
+                        help="Lock file shared with the certbot runs updating Nginx Unit "
+                             "(default: /run/lock/certbot-nginx-unit.lock)")
+    parser.add_argument("--metrics-textfile", default="",
+                        help="Write the control API timings to this Prometheus textfile")
+    parser.add_argument("--metrics-json", default="", help="Write the control API timings to this JSON file")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="More verbose output")
+
+
+def _add_session_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--session-cache-size", default=None, type=int,
+                        help="TLS sessions cached per Nginx Unit router process on the *:443 listener "
+                             "(default: left as configured)")
+    parser.add_argument("--session-timeout", default=None, type=int,
+                        help="Seconds a cached TLS session or a session ticket stays valid "
+                             "(default: left as configured)")
+    parser.add_argument("--ticket-keys-file", default=None,
+                        help="Session ticket key ring of the *:443 listener, shared by the nodes resuming "
+                             "each other's sessions (default: session tickets left as configured)")
+    parser.add_argument("--ticket-key-rotation", default=12.0, type=float,
+                        help="Hours between two rotations of the session ticket key (default: %(default)s)")
+
+
+def _session_settings(args: argparse.Namespace) -> SessionSettings:
+    return SessionSettings(args.session_cache_size, args.session_timeout, args.ticket_keys_file or "",
+                           args.ticket_key_rotation * 3600)
+
+
+def _setup(args: argparse.Namespace) -> None:
+    level = logging.WARNING - 10 * args.verbose
+    logging.basicConfig(level=max(level, logging.DEBUG), format="%(message)s")
+    # the certbot display would import acme and requests for a few messages
+    use_printer(print)
+
+
+def _find_lineages(config_dir: str) -> List[str]:
+    """Lineage directories of the certbot configuration directory ``config_dir``."""
+    live = os.path.join(config_dir, "live")
+    try:
+        names = sorted(os.listdir(live))
+    except OSError as exception:
+        raise errors.Error("Unable to list the certbot lineages of {0}: {1}".format(live, exception))
+    return [os.path.join(live, name) for name in names
+            if os.path.isfile(os.path.join(live, name, "fullchain.pem"))
+            and os.path.isfile(os.path.join(live, name, "privkey.pem"))]
+
+
+def _load_bundle_index(work_dir: str) -> Optional[BundleIndex]:
+    bundle_index = BundleIndex(os.path.join(work_dir, "nginx-unit", "bundles.json"))
+    return bundle_index if bundle_index.load() else None
+
+
+def gc_main(argv: Optional[List[str]] = None) -> int:
+    """Remove the expired and the unreferenced certificate bundles from Nginx Unit.
+
+    Usable as a certbot post hook: ``certbot renew --post-hook certbot-nginx-unit-gc``
+
+    """
+    parser = argparse.ArgumentParser(
+        prog="certbot-nginx-unit-gc",
+        description="Remove the expired and the unreferenced certificate bundles from Nginx Unit.")
+    _add_unit_arguments(parser)
+    parser.add_argument("--dry-run", action="store_true", default=False,
+                        help="Only list the certificate bundles that would be removed")
+    args = parser.parse_args(argv)
+    _setup(args)
+
+    unitc = create_unitc(args.control, args.unitc)
+    try:
+        with UnitLock(args.lock_file or default_lock_path()):
+            # read under the lock: the deploys upload their bundles under it, once planned in their journals
+            pending = pending_bundles(os.path.join(args.work_dir, "nginx-unit", "bundles.journal"))
+            report = collect(unitc, _load_bundle_index(args.work_dir), args.concurrency, args.dry_run,
+                             pending=pending)
+    except errors.Error as exception:
+        logger.error("%s", exception)
+        return 1
+    finally:
+        unitc.close()
+        METRICS.write(args.metrics_textfile, args.metrics_json)
+
+    for bundle_name in report.deleted:
+        print(("would remove " if args.dry_run else "removed ") + bundle_name)
+    print(report.summary())
+    return 1 if report.failed else 0
+
+
+def deploy_main(argv: Optional[List[str]] = None) -> int:
+    """Deploy the certificates of existing certbot lineages to Nginx Unit, without running certbot.
+
+    Usable as a certbot deploy hook (``certbot renew --deploy-hook certbot-nginx-unit-deploy``):
+    without lineage arguments, the lineage of ``$RENEWED_LINEAGE`` is deployed. With
+    ``--reconcile``, every lineage of ``--config-dir`` is compared with Unit in one pass. With
+    ``--apply-deferred``, run as a post hook, the renew deploys of ``--nginx-unit-deferred-deploy``
+    are applied.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog="certbot-nginx-unit-deploy",
+        description="Deploy the certificates of certbot lineages to Nginx Unit.")
+    _add_unit_arguments(parser)
+    parser.add_argument("lineages", nargs="*", metavar="LINEAGE_DIR",
+                        help="certbot lineage directories, like /etc/letsencrypt/live/www.example.org "
+                             "(default: $RENEWED_LINEAGE, every lineage of --config-dir with --reconcile)")
+    parser.add_argument("--reconcile", action="store_true", default=False,
+                        help="Compare the lineages with the certificates and the *:443 listener of Nginx Unit "
+                             "in one pass, after a Unit state loss or on a new node: only the missing or "
+                             "outdated certificates are uploaded")
+    parser.add_argument("--apply-deferred", action="store_true", default=False,
+                        help="Update the listeners and remove the old certificates once for the renew deploys "
+                             "deferred by --nginx-unit-deferred-deploy, as a certbot post hook")
+    parser.add_argument("--config-dir", default=DEFAULT_CONFIG_DIR,
+                        help="certbot configuration directory, holding the lineages reconciled by "
+                             "--reconcile (default: %(default)s)")
+    parser.add_argument("--max-reconfigurations", default=0, type=int,
+                        help="Maximum Nginx Unit reconfigurations per --reconfiguration-period, shared with "
+                             "the certbot runs, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--reconfiguration-period", default=60.0, type=float,
+                        help="Seconds of the --max-reconfigurations window (default: %(default)s)")
+    parser.add_argument("--maintenance-window", default=None, type=MaintenanceWindow.parse,
+                        help="Daily local time range HH:MM-HH:MM in which the certificates are deployed, "
+                             "waiting for it to open (default: any time)")
+    _add_session_arguments(parser)
+    parser.add_argument("--tls-profile", default=None,
+                        help="TLS performance profile of the *:443 listener, applied with the deployed "
+                             "certificates: aes, chacha20, auto, tls13 or compatible "
+                             "(default: the OpenSSL defaults of Nginx Unit)")
+    args = parser.parse_args(argv)
+    _setup(args)
+
+    if args.reconcile:
+        try:
+            lineages = args.lineages or _find_lineages(args.config_dir)
+        except errors.Error as exception:
+            logger.error("%s", exception)
+            return 1
+    elif args.apply_deferred:
+        lineages = []
+    else:
+        lineages = args.lineages or (
+            [os.environ["RENEWED_LINEAGE"]] if os.environ.get("RENEWED_LINEAGE") else [])
+        if not lineages:
+            parser.error("no lineage directory given and RENEWED_LINEAGE is not set")
+
+    addresses = split_addresses(args.control)
+    unitc = create_unitc(addresses[0] if addresses else None, args.unitc)
+    deployer = Deployer(unitc, args.work_dir, args.concurrency, args.lock_file, control_addresses=addresses,
+                        max_reconfigurations=args.max_reconfigurations,
+                        reconfiguration_period=args.reconfiguration_period,
+                        maintenance_window=args.maintenance_window, session_settings=_session_settings(args),
+                        tls_profile=args.tls_profile)
+    # certbot deploys a lineage under its name, like renew_deploy does
+    sources = [(os.path.basename(os.path.normpath(lineage)), os.path.join(lineage, "privkey.pem"),
+                os.path.join(lineage, "fullchain.pem")) for lineage in lineages]
+    try:
+        if args.apply_deferred:
+            deployer.apply_deferred()
+        elif args.reconcile:
+            outcomes = deployer.reconcile(sources)
+            for outcome, names in outcomes.items():
+                for name in names:
+                    print("{0} {1}".format(outcome, name))
+            print("{0} lineages: {1}".format(len(sources), ", ".join(
+                "{0} {1}".format(len(names), outcome) for outcome, names in outcomes.items())))
+        else:
+            for name, key_path, fullchain_path in sources:
+                deployer.deploy(name, key_path, fullchain_path)
+            deployer.save()
+    except (errors.Error, OSError) as exception:
+        logger.error("%s", exception)
+        return 1
+    finally:
+        deployer.close()
+        METRICS.write(args.metrics_textfile, args.metrics_json)
+    return 0
+
+
+def session_main(argv: Optional[List[str]] = None) -> int:
+    """Apply the TLS session resumption options to Nginx Unit, rotating the session ticket keys when due.
+
+    Usable from a timer running more often than the rotation period, so that the keys rotate on
+    schedule even when no certificate is renewed.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog="certbot-nginx-unit-session",
+        description="Apply the TLS session resumption options and rotate the session ticket keys of Nginx Unit.")
+    _add_unit_arguments(parser)
+    _add_session_arguments(parser)
+    args = parser.parse_args(argv)
+    _setup(args)
+
+    settings = _session_settings(args)
+    if not settings.managed:
+        parser.error("no session option given")
+
+    addresses = split_addresses(args.control)
+    unitc = create_unitc(addresses[0] if addresses else None, args.unitc)
+    deployer = Deployer(unitc, args.work_dir, args.concurrency, args.lock_file, control_addresses=addresses,
+                        session_settings=settings)
+    try:
+        deployer.update_session()
+    except errors.Error as exception:
+        logger.error("%s", exception)
+        return 1
+    finally:
+        deployer.close()
+        METRICS.write(args.metrics_textfile, args.metrics_json)
+    return 0
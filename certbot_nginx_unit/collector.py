@@ -0,0 +1,154 @@
+"""Garbage collector of the Nginx Unit certificate bundles.
+
+Bundles of renamed lineages, of domains whose common name differs from the
+lineage name and of failed runs are never replaced by a deploy: they are
+found here by their expiry and by the references of every TLS listener.
+
+"""
+import logging
+from datetime import datetime, timezone
+from typing import Any, Collection, Dict, List, NamedTuple, Optional
+
+from .bundle_index import BundleIndex, parse_unit_certificate, slim_unit_certificate
+from .configuration import UnitConfiguration
+from .transaction import ConfigTransaction
+from .unitc import Unitc, run_calls
+
+logger = logging.getLogger(__name__)
+
+
+class CollectReport(NamedTuple):
+    """Result of a garbage collection."""
+    deleted: List[str]
+    failed: List[str]
+    kept: List[str]
+    reclaimed_bytes: int
+    unknown_size: int
+
+    def summary(self) -> str:
+        """Human readable summary."""
+        summary = "Removed {0} certificate bundles ({1} bytes".format(len(self.deleted), self.reclaimed_bytes)
+        if self.unknown_size:
+            summary += ", size of {0} unknown".format(self.unknown_size)
+        summary += ")"
+        if self.failed:
+            summary += ", {0} failed".format(len(self.failed))
+        return summary
+
+
+def expiry(certificate: Dict[str, Any]) -> Optional[datetime]:
+    """Expiry of the leaf certificate of a bundle described by the Unit ``/certificates`` API.
+
+    The intermediates and cross-signed roots of the chain are left out: clients build their own
+    path to a trusted root, an expired link does not make the leaf unusable.
+
+    """
+    not_after = parse_unit_certificate(certificate)["not_after"]
+    return datetime.fromisoformat(not_after) if not_after else None
+
+
+def find_garbage(certificates: Dict[str, Any], configuration: UnitConfiguration,
+                 now: datetime, pending: Collection[str] = ()) -> Dict[str, str]:
+    """Bundles to remove, with the reason: "expired" or "unreferenced".
+
+    The ``pending`` bundles, uploaded by the deploys not on the listeners yet, are kept.
+
+    """
+    garbage = {}
+    for bundle_name, certificate in certificates.items():
+        if bundle_name in pending:
+            continue
+        not_after = expiry(certificate)
+        if not_after is not None and not_after <= now:
+            garbage[bundle_name] = "expired"
+        elif not configuration.bundle_listeners(bundle_name):
+            garbage[bundle_name] = "unreferenced"
+    return garbage
+
+
+def release_bundles(configuration: UnitConfiguration, bundle_names: List[str]) -> List[str]:
+    """Remove ``bundle_names`` from the listeners and return those that cannot be released.
+
+    A listener is never left without certificates: its bundles are kept.
+
+    """
+    kept = []
+    for bundle_name in bundle_names:
+        addresses = configuration.bundle_listeners(bundle_name)
+        for address in addresses:
+            certificate = configuration["listeners"][address]["tls"]["certificate"]
+            if not isinstance(certificate, list) or certificate == [bundle_name]:
+                kept.append(bundle_name)
+                break
+        else:
+            for address in addresses:
+                tls = configuration["listeners"][address]["tls"]
+                tls["certificate"] = [item for item in tls["certificate"] if item != bundle_name]
+            configuration.reindex()
+    return kept
+
+
+def collect(unitc: Unitc, bundle_index: Optional[BundleIndex] = None, concurrency: int = 4,
+            dry_run: bool = False, now: Optional[datetime] = None,
+            pending: Collection[str] = ()) -> CollectReport:
+    """Delete in one pass every expired or unreferenced certificate bundle of Unit.
+
+    Expired bundles still used by a listener are first removed from the listeners with a
+    single configuration update. The ``pending`` bundles of the deploys in progress or
+    deferred are kept.
+
+    """
+    now = now or datetime.now(timezone.utc)
+    error_message = "nginx unit get configuration failed"
+    certificates = unitc.get_json("/certificates", "", error_message, slim_unit_certificate)
+    configuration = UnitConfiguration({"listeners": unitc.get_json("/config/listeners", "", error_message)})
+
+    garbage = find_garbage(certificates, configuration, now, pending)
+    for bundle_name, reason in sorted(garbage.items()):
+        logger.info("Certificate bundle %s is %s", bundle_name, reason)
+
+    transaction = ConfigTransaction()
+    transaction.begin(configuration)
+    kept = release_bundles(configuration, [name for name, reason in garbage.items() if reason == "expired"])
+    for bundle_name in kept:
+        logger.warning("Expired certificate bundle %s is the only one of a listener, keeping it", bundle_name)
+        del garbage[bundle_name]
+
+    bundle_names = sorted(garbage)
+    if dry_run:
+        return CollectReport(bundle_names, [], kept, *_reclaimed(bundle_names, bundle_index))
+
+    transaction.stage("/listeners", "", "nginx unit listeners update failed")
+    transaction.commit(unitc, configuration)
+
+    results = run_calls(unitc, [
+        ("DELETE", "/certificates/" + bundle_name, None, "", "nginx unit delete from /certificates failed")
+        for bundle_name in bundle_names
+    ], concurrency)
+    deleted = []
+    failed = []
+    for bundle_name, result in zip(bundle_names, results):
+        if isinstance(result, BaseException):
+            logger.error("Unable to delete the certificate bundle %s: %s", bundle_name, result)
+            failed.append(bundle_name)
+        else:
+            deleted.append(bundle_name)
+
+    report = CollectReport(deleted, failed, kept, *_reclaimed(deleted, bundle_index))
+    if bundle_index is not None:
+        for bundle_name in deleted:
+            bundle_index.remove(bundle_name)
+        bundle_index.save()
+    return report
+
+
+def _reclaimed(bundle_names: List[str], bundle_index: Optional[BundleIndex]):
+    reclaimed_bytes = 0
+    unknown_size = 0
+    for bundle_name in bundle_names:
+        size = bundle_index.bundles.get(bundle_name, {}).get("size") if bundle_index is not None else None
+        if size is None:
+            unknown_size += 1
+        else:
+            reclaimed_bytes += size
+    return reclaimed_bytes, unknown_size
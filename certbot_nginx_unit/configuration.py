@@ -0,0 +1,85 @@
+"""Nginx Unit configuration model."""
+from typing import Any, Dict, List, Optional, Tuple
+
+# "/" + acme.challenges.HTTP01.URI_ROOT_PATH + "/*", without importing acme
+ACME_CHALLENGE_URI = "/.well-known/acme-challenge/*"
+
+
+class UnitConfiguration(dict):
+    """Subtrees read from the Nginx Unit ``/config`` document, with lookup indexes.
+
+    Only the top-level subtrees the plugin works on (``listeners``, ``routes``)
+    are read. It is the plain JSON object, so it can be mutated and serialized as such;
+    the indexes are built on the first lookup and must be dropped with
+    :meth:`reindex` after every mutation.
+
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._routes_index: Optional[Dict[str, List[Any]]] = None
+        self._acme_route: Optional[Tuple[str, int]] = None
+        self._bundles_index: Optional[Dict[str, List[str]]] = None
+
+    def reindex(self) -> None:
+        """Drop the indexes, they are rebuilt on the next lookup."""
+        self._routes_index = None
+        self._bundles_index = None
+        self._acme_route = None
+
+    @property
+    def listeners(self) -> Dict[str, Any]:
+        """Listeners by address."""
+        return self.get("listeners", {})
+
+    def listener(self, address: str) -> Optional[Dict[str, Any]]:
+        """Listener on ``address`` ("*:80"), None if not configured."""
+        return self.listeners.get(address)
+
+    def _build_routes_index(self) -> None:
+        routes = self.get("routes")
+        self._routes_index = {}
+        if isinstance(routes, list):
+            self._routes_index["routes"] = routes
+        elif isinstance(routes, dict):
+            for name, steps in routes.items():
+                self._routes_index["routes/" + name] = steps
+
+        for name, steps in self._routes_index.items():
+            if not isinstance(steps, list):
+                continue
+            for position, step in enumerate(steps):
+                if isinstance(step, dict) and step.get("match", {}).get("uri") == ACME_CHALLENGE_URI:
+                    self._acme_route = (name, position)
+                    return
+
+    def route(self, name: str) -> Optional[List[Any]]:
+        """Route steps by the name used in a ``pass`` ("routes", "routes/acme"), None if missing."""
+        if self._routes_index is None:
+            self._build_routes_index()
+        return self._routes_index.get(name)
+
+    def acme_route_position(self) -> Optional[Tuple[str, int]]:
+        """Route name and step position of the ACME challenge share, None if missing."""
+        if self._routes_index is None:
+            self._build_routes_index()
+        return self._acme_route
+
+    def tls_listeners(self) -> Dict[str, List[str]]:
+        """Certificate bundle names by address of the listeners with TLS."""
+        tls_listeners = {}
+        for address, listener in self.listeners.items():
+            certificate = listener.get("tls", {}).get("certificate")
+            if certificate is None:
+                continue
+            tls_listeners[address] = certificate if isinstance(certificate, list) else [certificate]
+        return tls_listeners
+
+    def bundle_listeners(self, bundle_name: str) -> List[str]:
+        """Addresses of the listeners using the certificate bundle ``bundle_name``."""
+        if self._bundles_index is None:
+            self._bundles_index = {}
+            for address, bundle_names in self.tls_listeners().items():
+                for name in bundle_names:
+                    self._bundles_index.setdefault(name, []).append(address)
+        return self._bundles_index.get(bundle_name, [])
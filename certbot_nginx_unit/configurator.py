@@ -4,13 +4,11 @@ Authenticate and Install new o renewed certificates on Nginx Unit
 Authenticator is built on Certbot Webroot giant shoulders
 
 """
+import atexit
 import collections
-import copy
-import json
 import logging
-from datetime import datetime
 
-from typing import Any, Callable, Optional, List, Union, Iterable, DefaultDict, Set, Type
+from typing import Any, Callable, ClassVar, Dict, Optional, List, Union, Iterable, DefaultDict, Set, Type
 
 from acme import challenges
 from certbot import errors
@@ -23,14 +21,21 @@ from certbot.plugins import common
 from certbot.plugins.util import get_prefixes
 from certbot.util import safe_open
 
-from .unitc import Unitc
+from .configuration import ACME_CHALLENGE_URI
+from .deployer import UnitDeployer, split_addresses
+from .metrics import METRICS
+from .replication import ChallengeTarget, parse_targets, publish_everywhere, remove_everywhere
+from .scheduler import MaintenanceWindow
+from .selfcheck import ServedFile, listener_address, wait_until_served
+from .session import SessionSettings
+from .unitc import Unitc, create_unitc
 
 CONFIG_TLS_CERTIFICATE_PATH = "/listeners/*:443/tls/certificate"
 
 logger = logging.getLogger(__name__)
 
 
-class Configurator(common.Installer, interfaces.Authenticator, interfaces.RenewDeployer):
+class Configurator(common.Installer, interfaces.Authenticator, interfaces.RenewDeployer, UnitDeployer):
     """Nginx Unit certificate authenticator and installer plugin for Certbot"""
 
     description = """\
@@ -45,23 +50,27 @@ class Configurator(common.Installer, interfaces.Authenticator, interfaces.RenewD
     system. It expects that there is some other HTTP server configured
     to serve all files under specified web root ({0})."""
 
+    # the metrics of the whole run are written once, at exit
+    _metrics_export_registered: ClassVar[bool] = False
+
     def __init__(self, *args: Any, **kwargs: Any):
         super().__init__(*args, **kwargs)
         self._prepared = False
-        self._configuration = None
-        self.unitc = Unitc()
-        self._entropy = datetime.now().strftime("%Y%m%d%H%M%S")
 
         self._challenge_path: str = ""
         self._full_root: str = ""
         self._performed: DefaultDict[str, Set[AnnotatedChallenge]] = collections.defaultdict(set)
         self._created_dirs: List[str] = []
         self._to_remove: List[str] = []
-        self._backup_routes: List[str] = []
+        self._replaced_pass: Optional[str] = None
+        self._added_route_steps: List[Dict[str, Any]] = []
+        self._added_named_route = False
+        self._challenge_targets: Optional[List[ChallengeTarget]] = None
 
     def get_all_names(self) -> Iterable[str]:
         return []
 
+    @METRICS.timed("deploy_cert")
     def deploy_cert(self, domain: str, cert_path: str, key_path: str, chain_path: str, fullchain_path: str) -> None:
         """Deploy certificate.
 
@@ -76,68 +85,8 @@ class Configurator(common.Installer, interfaces.Authenticator, interfaces.RenewD
 
         """
         logger.debug("deploy cert for domain: %s", domain)
-
-        cert_bundle_name = domain + "_" + self._entropy
-        self._upload_certificates(fullchain_path, key_path, cert_bundle_name)
-
-        certificates_chains = self._get_unit_configuration("/certificates")
-
-        old_certificate_bundle_names = []
-        for bundle_name, certificate in certificates_chains.items():
-            for chain in certificate["chain"]:
-                # @todo check validity chain["validity"]["until"]?
-                if bundle_name == cert_bundle_name or chain["subject"]["common_name"] != domain:
-                    continue
-                old_certificate_bundle_names.append(bundle_name)
-
-        if self._configuration is None:
-            self._configuration = self._get_unit_configuration("/config")
-        self._update_certificate_name_list_to_config(cert_bundle_name, old_certificate_bundle_names)
-
-        display_util.notify(f"Remove old certificates for {domain}")
-        for old_bundle_name in old_certificate_bundle_names:
-            self._delete_certificates(old_bundle_name)
-
-    def _upload_certificates(self, fullchain_path: str, key_path: str, cert_bundle_name: str):
-        certificates = self._get_certificates_content(fullchain_path, key_path)
-        path = "/certificates/" + cert_bundle_name
-        success_message = "Certificate deployed"
-        error_message = "nginx unit copy to /certificates failed"
-        self.unitc.put(path, certificates, success_message, error_message)
-
-    def _delete_certificates(self, cert_bundle_name: str):
-        path = "/certificates/" + cert_bundle_name
-        success_message = "Certificate deleted"
-        error_message = "nginx unit delete from /certificates failed"
-        self.unitc.delete(path, None, success_message, error_message)
-
-    def _update_certificate_name_list_to_config(self, cert_bundle_name: str, bundle_names_to_remove):
-        self._ensure_tls_listener()
-
-        cert_bundle_names = self._configuration["listeners"]["*:443"]["tls"]["certificate"]
-        cert_bundle_names = [item for item in cert_bundle_names if item not in bundle_names_to_remove]
-        cert_bundle_names.append(cert_bundle_name)
-        self._configuration["listeners"]["*:443"]["tls"]["certificate"] = cert_bundle_names
-
-        path = "/config/listeners"
-        input_data = json.dumps(self._configuration["listeners"]).encode()
-        success_message = "Certificate deployed"
-        error_message = "nginx unit copy to /certificates failed"
-
-        self.unitc.put(path, input_data, success_message, error_message)
-
-    def _ensure_tls_listener(self):
-        if "listeners" not in self._configuration:
-            raise errors.PluginError("No listeners configured")
-        if "*:443" not in self._configuration["listeners"]:
-            if "*:80" not in self._configuration["listeners"]:
-                raise errors.PluginError("No '*:80' default listeners configured")
-            self._configuration["listeners"]["*:443"] = copy.deepcopy(self._configuration["listeners"]["*:80"])
-
-        if "tls" not in self._configuration["listeners"]["*:443"]:
-            self._configuration["listeners"]["*:443"]["tls"] = {}
-        if "certificate" not in self._configuration["listeners"]["*:443"]["tls"]:
-            self._configuration["listeners"]["*:443"]["tls"]["certificate"] = []
+        self.prepare()
+        self._queue_deploy(domain, key_path, fullchain_path)
 
     def _ensure_challenge_listener(self):
         success_message = "Updated listener for acme challenge"
@@ -145,52 +94,70 @@ class Configurator(common.Installer, interfaces.Authenticator, interfaces.RenewD
 
         if "listeners" not in self._configuration:
             raise errors.PluginError("No listeners configured")
-        if "*:80" not in self._configuration["listeners"]:
-            self._backup_routes = self._configuration.get("routes", [])
+        listener = self._configuration.listener("*:80")
+        if listener is None:
             default_route = self._ensure_acme_route("routes")
             self._configuration["listeners"]["*:80"] = {"pass": default_route}
-            listener_route = "/config/listeners/*:80"
-            listener80 = json.dumps(self._configuration["listeners"]["*:80"]).encode()
-            self.unitc.put(listener_route, listener80, success_message, error_message)
-            self._to_remove.append("/config/listeners/*:80")
+            self._stage("/listeners/*:80", success_message, error_message)
+            self._to_remove.append("/listeners/*:80")
             return
-        if "pass" not in self._configuration["listeners"]["*:80"]:
+        if "pass" not in listener:
             raise errors.PluginError("Cannot configure the route for the *:80 listener")
 
-        actual_route = self._configuration["listeners"]["*:80"]["pass"]
-        self._backup_routes = self._configuration.get("routes", [])
+        actual_route = listener["pass"]
         default_route = self._ensure_acme_route(actual_route)
         if actual_route == default_route:
             return
 
-        self._configuration["listeners"]["*:80"]["pass"] = default_route
-        listener_route = "/config/listeners/*:80/pass"
-        self.unitc.put(listener_route, json.dumps(default_route).encode(), success_message, error_message)
+        self._replaced_pass = actual_route
+        listener["pass"] = default_route
+        self._stage("/listeners/*:80/pass", success_message, error_message)
+
+    def _remove_challenge_configuration(self):
+        """Undo on the current configuration only what _ensure_challenge_listener added."""
+        listeners = self._configuration.get("listeners", {})
+        for config_path in self._to_remove:
+            listeners.pop(config_path.split("/")[-1], None)
+            self._stage(config_path, "", "Delete tmp configuration failed")
+        if self._replaced_pass is not None and "*:80" in listeners:
+            listeners["*:80"]["pass"] = self._replaced_pass
+            self._stage("/listeners/*:80/pass", "", "Restore listener after acme challenge failed")
+
+        routes = self._configuration.get("routes")
+        if self._added_named_route and isinstance(routes, dict) and "acme" in routes:
+            del routes["acme"]
+            self._stage("/routes/acme")
+        elif self._added_route_steps and isinstance(routes, list):
+            routes = list(routes)
+            for step in self._added_route_steps:
+                if step in routes:
+                    routes.remove(step)
+            self._configuration["routes"] = routes
+            self._stage("/routes")
 
     def _ensure_acme_route(self, actual_route: str) -> str:
-        acme_challenge_url = "/" + challenges.HTTP01.URI_ROOT_PATH + "/*"
         acme_route = [
             {
-                "match": {"uri": acme_challenge_url},
+                "match": {"uri": ACME_CHALLENGE_URI},
                 "action": {"share": self._challenge_path + "/$uri"},
             }
         ]
         if actual_route != "routes" and actual_route != "routes/acme":
             acme_route.append({"action": {"pass": actual_route}})
 
-        acme_route_json = json.dumps(acme_route)
-
         if "routes" not in self._configuration or not self._configuration["routes"]:
             self._configuration["routes"] = acme_route
-            self.unitc.put("/config/routes", acme_route_json.encode())
+            self._added_route_steps = acme_route
+            self._stage("/routes")
             return "routes"
 
         if isinstance(self._configuration["routes"], dict):
-            if "acme" in self._configuration["routes"]:
+            if self._configuration.route("routes/acme") is not None:
                 return "routes/acme"
 
             self._configuration["routes"]["acme"] = acme_route
-            self.unitc.put("/config/routes/acme", acme_route_json.encode())
+            self._added_named_route = True
+            self._stage("/routes/acme")
             return "routes/acme"
 
         if not isinstance(self._configuration["routes"], list):
@@ -199,46 +166,35 @@ class Configurator(common.Installer, interfaces.Authenticator, interfaces.RenewD
         if not isinstance(self._configuration["routes"][0], dict):
             raise errors.PluginError("Cannot configure the routes: unknown route[0] type")
 
-        first_route = self._configuration["routes"][0]
-        if ("match" in first_route and "uri" in first_route["match"]
-                and first_route["match"]["uri"] == acme_challenge_url):
+        if self._configuration.acme_route_position() == ("routes", 0):
             return "routes"
 
         routes = acme_route + self._configuration["routes"]
         self._configuration["routes"] = routes
-        self.unitc.put("/config/routes", json.dumps(routes).encode())
+        self._added_route_steps = acme_route
+        self._stage("/routes")
         return "routes"
 
-    @staticmethod
-    def _get_certificates_content(fullchain_path, key_path):
-        with open(key_path, "rb") as f:
-            certificates = f.read()
-        with open(fullchain_path, "rb") as f:
-            certificates += f.read()
-        return certificates
-
-    def _get_unit_configuration(self, path: str):
-        error_message = "nginx unit get configuration failed"
-        configuration_str = self.unitc.get(path, "Get configuration", error_message)
-        logger.debug("Conf str '%s'", configuration_str)
-
-        # @todo wrap configuration to a dedicated class
-        return json.loads(configuration_str)
-
     def enhance(self, domain: str, enhancement: str, options: Optional[Union[List[str], str]] = None) -> None:
         pass
 
     def supported_enhancements(self) -> List[str]:
         return []
 
+    @METRICS.timed("save")
     def save(self, title: Optional[str] = None, temporary: bool = False) -> None:
-        pass
+        """Commit the configuration changes staged by deploy_cert and remove the replaced bundles."""
+        self._save_deploys()
 
     def rollback_checkpoints(self, rollback: int = 1) -> None:
-        pass
+        """Undo the last ``rollback`` deploys recorded in the deploy journal."""
+        self.prepare()
+        self._rollback_deploys(rollback)
 
     def recovery_routine(self) -> None:
-        pass
+        """Undo the deploys of this run stopped by an error."""
+        if self._prepared:
+            self._recover_deploys()
 
     def config_test(self) -> None:
         pass
@@ -246,16 +202,75 @@ class Configurator(common.Installer, interfaces.Authenticator, interfaces.RenewD
     def restart(self) -> None:
         pass
 
+    @METRICS.timed("prepare")
     def prepare(self) -> None:
         """Prepare the authenticator/installer."""
         # @todo verify "unitc" executable
-        # @todo lock to prevent concurrent multi update
         if self._prepared:
             return
-        self._configuration = self._get_unit_configuration("/config")
-        self._backup_routes = self._configuration.get("routes", [])
+        if self.unitc is None:
+            self.unitc = self._create_unitc()
+        self._register_metrics_export()
+        self._load_configuration()
+        self._resume_interrupted_deploys()
         self._prepared = True
 
+    def _register_metrics_export(self) -> None:
+        textfile_path = self.conf("metrics-textfile")
+        json_path = self.conf("metrics-json")
+        if (textfile_path or json_path) and not Configurator._metrics_export_registered:
+            Configurator._metrics_export_registered = True
+            atexit.register(METRICS.write, textfile_path or "", json_path or "")
+
+    def _control_addresses(self) -> List[str]:
+        return split_addresses(self.conf("control"))
+
+    def _create_unitc(self) -> Unitc:
+        addresses = self._control_addresses()
+        return create_unitc(addresses[0] if addresses else None, self.conf("unitc"))
+
+    def _work_dir(self) -> str:
+        return self.config.work_dir
+
+    def _concurrency(self) -> int:
+        return self.conf("concurrency")
+
+    def _lock_path(self) -> Optional[str]:
+        return self.conf("lock-file")
+
+    def _max_reconfigurations(self) -> int:
+        return self.conf("max-reconfigurations")
+
+    def _reconfiguration_period(self) -> float:
+        return self.conf("reconfiguration-period")
+
+    def _maintenance_window(self) -> Optional[MaintenanceWindow]:
+        if not self.conf("maintenance-window"):
+            return None
+        try:
+            return MaintenanceWindow.parse(self.conf("maintenance-window"))
+        except ValueError as exception:
+            raise errors.PluginError(str(exception))
+
+    def _notify(self, message: str) -> None:
+        display_util.notify(message)
+
+    def _session_settings(self) -> SessionSettings:
+        ticket_keys_path = ""
+        if self.conf("session-tickets"):
+            ticket_keys_path = self.conf("ticket-keys-file") or os.path.join(
+                self._work_dir(), "nginx-unit", "ticket-keys.json")
+        return SessionSettings(self.conf("session-cache-size"), self.conf("session-timeout"), ticket_keys_path,
+                               self.conf("ticket-key-rotation") * 3600)
+
+    def _tls_profile(self) -> Optional[str]:
+        return self.conf("tls-profile")
+
+    def _get_challenge_targets(self) -> List[ChallengeTarget]:
+        if self._challenge_targets is None:
+            self._challenge_targets = parse_targets(self.conf("challenge-targets") or "")
+        return self._challenge_targets
+
     def more_info(self) -> str:  # pylint: disable=missing-function-docstring
         return self.MORE_INFO.format(self.conf("path"))
 
@@ -265,20 +280,88 @@ class Configurator(common.Installer, interfaces.Authenticator, interfaces.RenewD
         add("path", default="/srv/www/unit/", type=str,
             help="public_html / webroot path. Only one catch 'em all temporary "
                  "directory --nginx-unit-path /srv/www/unit/ (default: /srv/www/unit/)")
+        add("control", default=None, type=str,
+            help="Nginx Unit control socket path or TCP address host:port, or a comma separated "
+                 "list of them to deploy the certificates to several Unit instances "
+                 "(default: autodetect the unix control socket)")
+        add("unitc", action="store_true", default=False,
+            help="Use the unitc command instead of talking to the control socket directly")
+        add("lock-file", default=None, type=str,
+            help="Lock file serializing the Nginx Unit configuration updates of concurrent certbot "
+                 "processes (default: /run/lock/certbot-nginx-unit.lock)")
+        add("self-check-timeout", default=0, type=float,
+            help="Seconds to wait for Nginx Unit to serve the challenge files on the *:80 listener, "
+                 "fetched at the host of a TCP --nginx-unit-control address or at 127.0.0.1, before "
+                 "asking for the validation (default: 0, no check)")
+        add("persistent-acme-route", action="store_true", default=False,
+            help="Keep the acme challenge route in the configuration after the validation, so that "
+                 "the next renewals do not reconfigure Nginx Unit")
+        add("metrics-textfile", default=None, type=str,
+            help="Write the control API and phase timings of the run to this Prometheus textfile")
+        add("metrics-json", default=None, type=str,
+            help="Write the control API and phase timings of the run to this JSON file")
+        add("concurrency", default=4, type=int,
+            help="Maximum number of certificates uploaded or deleted at the same time (default: 4)")
+        add("deferred-deploy", action="store_true", default=False,
+            help="On renew only upload the certificate of each lineage: the listeners are updated and "
+                 "the old certificates removed once for all the lineages by certbot-nginx-unit-deploy "
+                 "--apply-deferred, run as a post hook")
+        add("max-reconfigurations", default=0, type=int,
+            help="Maximum Nginx Unit reconfigurations per --nginx-unit-reconfiguration-period, "
+                 "shared by the concurrent certbot runs, 0 for no limit (default: 0)")
+        add("reconfiguration-period", default=60, type=float,
+            help="Seconds of the --nginx-unit-max-reconfigurations window (default: 60)")
+        add("maintenance-window", default=None, type=str,
+            help="Daily local time range HH:MM-HH:MM in which the certificates are deployed, the deploys "
+                 "wait for it to open (default: any time)")
+        add("challenge-targets", default=None, type=str,
+            help="Comma separated webroots of the other nodes behind the load balancer, receiving the "
+                 "challenge files too: directories mounted on this host or ssh://[user@]host[:port]/path")
+        add("session-cache-size", default=None, type=int,
+            help="TLS sessions cached per Nginx Unit router process on the *:443 listener, set on each "
+                 "deploy (default: left as configured)")
+        add("session-timeout", default=None, type=int,
+            help="Seconds a cached TLS session or a session ticket stays valid (default: left as configured)")
+        add("session-tickets", action="store_true", default=False,
+            help="Manage the session ticket keys of the *:443 listener, rotated on the deploys once "
+                 "older than --nginx-unit-ticket-key-rotation hours")
+        add("ticket-keys-file", default=None, type=str,
+            help="Session ticket key ring, shared by the nodes resuming each other's sessions "
+                 "(default: <work-dir>/nginx-unit/ticket-keys.json)")
+        add("ticket-key-rotation", default=12, type=float,
+            help="Hours between two rotations of the session ticket key (default: 12)")
+        add("tls-profile", default=None, type=str,
+            help="TLS performance profile of the *:443 listener, applied with the deployed certificates: "
+                 "aes, chacha20, auto (aes or chacha20 following the CPU of this host), tls13 or compatible "
+                 "(default: the OpenSSL defaults of Nginx Unit)")
 
     def get_chall_pref(self, domain: str) -> Iterable[Type[challenges.Challenge]]:
         # pylint: disable=unused-argument,missing-function-docstring
         return [challenges.HTTP01]
 
+    @METRICS.timed("perform")
     def perform(self, achalls: List[AnnotatedChallenge]) -> List[challenges.ChallengeResponse]:
 
         self.prepare()
+        # the deploys only read the listeners
+        self._require_sections("routes")
         self._set_webroot(achalls)
         self._create_challenge_dir()
 
-        self._ensure_challenge_listener()
+        # the files exist before the route serving them is committed
+        responses = self._write_validation_files(achalls)
+        self._replicate_validation_files(achalls)
+        self._update_configuration(self._prepare_challenge_configuration)
+        self._self_check(achalls)
 
-        return [self._perform_single(achall) for achall in achalls]
+        return responses
+
+    def _prepare_challenge_configuration(self) -> None:
+        self._to_remove = []
+        self._replaced_pass = None
+        self._added_route_steps = []
+        self._added_named_route = False
+        self._ensure_challenge_listener()
 
     def _set_webroot(self, achalls: Iterable[AnnotatedChallenge]) -> None:
         webroot_path = '/srv/www/unit/'
@@ -337,31 +420,64 @@ class Configurator(common.Installer, interfaces.Authenticator, interfaces.RenewD
     def _get_validation_path(self, root_path: str, achall: AnnotatedChallenge) -> str:
         return os.path.join(root_path, achall.chall.encode("token"))
 
-    def _perform_single(self, achall: AnnotatedChallenge) -> challenges.ChallengeResponse:
-        response, validation = achall.response_and_validation()
-
+    def _write_validation_files(self, achalls: List[AnnotatedChallenge]) -> List[challenges.ChallengeResponse]:
+        """Write the validation file of every challenge in a single pass."""
         root_path = self._full_root
-        validation_path = self._get_validation_path(root_path, achall)
-        logger.debug("Attempting to save validation to %s", validation_path)
-
+        responses = []
         # Change permissions to be world-readable, owner-writable (certbot GH #1795)
         old_umask = filesystem.umask(0o022)
         try:
-            with safe_open(validation_path, mode="wb", chmod=0o644) as validation_file:
-                validation_file.write(validation.encode())
+            for achall in achalls:
+                response, validation = achall.response_and_validation()
+                validation_path = self._get_validation_path(root_path, achall)
+                logger.debug("Attempting to save validation to %s", validation_path)
+                with safe_open(validation_path, mode="wb", chmod=0o644) as validation_file:
+                    validation_file.write(validation.encode())
+                self._performed[root_path].add(achall)
+                responses.append(response)
         finally:
             filesystem.umask(old_umask)
+        return responses
 
-        self._performed[root_path].add(achall)
-        return response
+    def _replicate_validation_files(self, achalls: List[AnnotatedChallenge]) -> None:
+        """Publish the validation files to the webroots of every other node, confirmed on each one."""
+        targets = self._get_challenge_targets()
+        if not targets:
+            return
+        files = {achall.chall.encode("token"): achall.validation(achall.account_key).encode() for achall in achalls}
+        display_util.notify("Publishing the challenge files to {0} other nodes".format(len(targets)))
+        publish_everywhere(targets, files)
+
+    def _self_check(self, achalls: List[AnnotatedChallenge]) -> None:
+        """Wait until the *:80 listener serves every validation file, PluginError after the timeout."""
+        timeout = self.conf("self-check-timeout")
+        if not timeout:
+            return
+        served_files = []
+        for achall in achalls:
+            path = "/" + challenges.HTTP01.URI_ROOT_PATH + "/" + achall.chall.encode("token")
+            served_files.append(ServedFile(achall.domain, path, achall.validation(achall.account_key).encode()))
+        addresses = self._control_addresses()
+        address, port = listener_address("*:80", addresses[0] if addresses else None)
+        display_util.notify("Waiting for Nginx Unit to serve the challenge files")
+        not_served = wait_until_served(served_files, timeout, address, port)
+        if not_served:
+            raise errors.PluginError(
+                "Nginx Unit does not serve the challenge files of {0} after {1} seconds".format(
+                    ", ".join(served_file.domain for served_file in not_served), timeout))
 
+    @METRICS.timed("cleanup")
     def cleanup(self, achalls: List[AnnotatedChallenge]) -> None:  # pylint: disable=missing-function-docstring
-        for config_path in self._to_remove:
-            self.unitc.delete(config_path, None, "Delete tmp configuration failed")
-
-        if self._configuration["routes"] != self._backup_routes:
-            self.unitc.put("/config/routes", json.dumps(self._backup_routes).encode())
-
+        # a persistent route is left in place: the next perform finds it and writes nothing
+        if not self.conf("persistent-acme-route"):
+            self._require_sections("routes")
+            self._update_configuration(self._remove_challenge_configuration)
+        self._to_remove = []
+        self._replaced_pass = None
+        self._added_route_steps = []
+        self._added_named_route = False
+
+        remove_everywhere(self._get_challenge_targets(), [achall.chall.encode("token") for achall in achalls])
         for achall in achalls:
             root_path = self._full_root
             if root_path is not None:
@@ -403,3 +519,5 @@ class Configurator(common.Installer, interfaces.Authenticator, interfaces.RenewD
             lineage.chain_path,
             lineage.fullchain_path
         )
+        # deferred: the listeners are updated by certbot-nginx-unit-deploy --apply-deferred, run as a post hook
+        self._save_deploys(defer=bool(self.conf("deferred-deploy")))
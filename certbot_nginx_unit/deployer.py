@@ -0,0 +1,1017 @@
+"""Deploys of certificate bundles to Nginx Unit.
+
+The upload of the bundles, the update of the listeners and the removal of the
+replaced bundles are shared by the certbot plugin and by the standalone
+``certbot-nginx-unit-deploy`` command, which must not import the certbot
+plugin machinery (acme, requests and the display) to start quickly.
+
+"""
+import abc
+import copy
+import logging
+import re
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from certbot import errors
+from certbot.compat import filesystem
+from certbot.compat import os
+
+from .bundle_index import (BundleIndex, bundle_fingerprint, parse_certificate, parse_unit_certificate,
+                           slim_unit_certificate, unit_key_type)
+from .configuration import UnitConfiguration
+from .journal import (APPLIED, DEFERRED, RUNNING, ROLLED_BACK, Journal, listener_certificates, load_journals,
+                      prune_journals)
+from .lock import UnitLock, default_lock_path
+from .notify import notify
+from .profiles import profile_commands
+from .diff import MISSING
+from .scheduler import MaintenanceWindow, ReconfigurationScheduler
+from .session import SessionSettings, session_options
+from .transaction import ConfigTransaction, split_path, store
+from .unitc import AsyncUnitc, Call, Unitc, UnitError, create_unitc, raise_first_error, run_calls
+
+CAS_ATTEMPTS = 5
+# seconds to wait for the lock held by another process, plus the pacing period when paced
+LOCK_TIMEOUT = 60.0
+
+logger = logging.getLogger(__name__)
+
+
+def split_addresses(control: Optional[str]) -> List[str]:
+    """Control addresses of a comma separated ``--control`` value."""
+    return [address.strip() for address in (control or "").split(",") if address.strip()]
+
+
+class UnitDeployer(abc.ABC):
+    """Certificate bundle deploys to the Nginx Unit read through ``unitc``.
+
+    The settings are read through :meth:`_work_dir`, :meth:`_concurrency`,
+    :meth:`_lock_path`, :meth:`_control_addresses`, :meth:`_create_unitc`,
+    :meth:`_max_reconfigurations`, :meth:`_reconfiguration_period`,
+    :meth:`_maintenance_window`, :meth:`_session_settings` and
+    :meth:`_tls_profile`, overridden by the subclasses.
+
+    When several control addresses are given, the first one is read through
+    ``unitc`` and every deploy is replayed on the other Unit instances by a
+    :class:`Deployer` per address, saved concurrently.
+
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.unitc: Optional[Unitc] = None
+        self._configuration: Optional[UnitConfiguration] = None
+        self._cache: Dict[str, Any] = {}
+        self._transaction = ConfigTransaction()
+        # unique across concurrent certbot processes deploying the same domain
+        self._entropy = datetime.now().strftime("%Y%m%d%H%M%S") + "_" + secrets.token_hex(3)
+        self._lock: Optional[UnitLock] = None
+        self._scheduler: Optional[ReconfigurationScheduler] = None
+        self._session_options: Optional[Dict[str, Any]] = None
+        self._conf_commands: Optional[Dict[str, str]] = None
+        # bundles of Unit read by _scan_certificates(), None when not read
+        self._existing_bundles: Optional[Set[str]] = None
+        self._bundles_to_delete: List[str] = []
+        self._bundle_index: Optional[BundleIndex] = None
+        self._uploaded_bundle_names: Set[str] = set()
+        self._pending_deploys: List[Tuple[str, List[str]]] = []
+        self._pending_uploads: List[Tuple[str, bytes, Dict[str, Any]]] = []
+        # index entries of the bundles put back on the listener without an upload
+        self._restored_bundles: Dict[str, Dict[str, Any]] = {}
+        self._pool: Optional[AsyncUnitc] = None
+        self._targets: Optional[List[Tuple[str, "Deployer"]]] = None
+        self._target_errors: Dict[str, str] = {}
+        self._journal_count = 0
+        # the /config subtrees read: applications, upstreams and settings are never needed
+        self._sections: Set[str] = {"listeners"}
+
+    @abc.abstractmethod
+    def _work_dir(self) -> str:
+        """certbot working directory, holding the bundle index and the deploy journals."""
+
+    def _concurrency(self) -> int:
+        return 4
+
+    def _lock_path(self) -> Optional[str]:
+        return None
+
+    def _bundle_index_path(self) -> str:
+        return os.path.join(self._work_dir(), "nginx-unit", "bundles.json")
+
+    def _control_addresses(self) -> List[str]:
+        return []
+
+    def _journal_dir(self) -> str:
+        return os.path.splitext(self._bundle_index_path())[0] + ".journal"
+
+    def _max_reconfigurations(self) -> int:
+        return 0
+
+    def _reconfiguration_period(self) -> float:
+        return 60.0
+
+    def _maintenance_window(self) -> Optional[MaintenanceWindow]:
+        return None
+
+    def _session_settings(self) -> SessionSettings:
+        return SessionSettings()
+
+    def _tls_profile(self) -> Optional[str]:
+        return None
+
+    def _create_unitc(self) -> Unitc:
+        addresses = self._control_addresses()
+        return create_unitc(addresses[0] if addresses else None)
+
+    def _notify(self, message: str) -> None:
+        notify(message)
+
+    def _connect(self) -> None:
+        """Create the control API client and read the configuration, if not done yet."""
+        if self.unitc is None:
+            self.unitc = self._create_unitc()
+        if self._configuration is None:
+            self._load_configuration()
+            self._resume_interrupted_deploys()
+
+    def _get_targets(self) -> List[Tuple[str, "Deployer"]]:
+        """Deployers of the other Unit instances, each with its own bundle index."""
+        if self._targets is None:
+            self._targets = []
+            for address in self._control_addresses()[1:]:
+                index_name = "bundles-{0}.json".format(re.sub(r"[^A-Za-z0-9]+", "_", address).strip("_"))
+                target = Deployer(create_unitc(address), self._work_dir(), self._concurrency(), self._lock_path(),
+                                  os.path.join(self._work_dir(), "nginx-unit", index_name),
+                                  max_reconfigurations=self._max_reconfigurations(),
+                                  reconfiguration_period=self._reconfiguration_period(),
+                                  session_settings=self._session_settings(), tls_profile=self._tls_profile())
+                # same bundle names everywhere, and the lock is taken once for all the instances
+                target._entropy = self._entropy
+                target._lock = self._get_lock()
+                self._targets.append((address, target))
+        return self._targets
+
+    def _instance_label(self) -> str:
+        addresses = self._control_addresses()
+        return addresses[0] if addresses else "local Nginx Unit"
+
+    def _queue_deploy(self, domain: str, key_path: str, fullchain_path: str) -> None:
+        """Upload the bundle of ``domain`` on :meth:`_save_deploys` and replace its previous bundles."""
+        for address, target in self._get_targets():
+            if address in self._target_errors:
+                continue
+            try:
+                target.deploy(domain, key_path, fullchain_path)
+            except errors.Error as exception:
+                # reported by _save_deploys(), the other instances are still deployed
+                self._target_errors[address] = str(exception)
+        self._queue_own_deploy(domain, key_path, fullchain_path)
+
+    def _queue_own_deploy(self, domain: str, key_path: str, fullchain_path: str) -> None:
+        self._ensure_tls_listener()
+
+        certificates = self._get_certificates_content(fullchain_path, key_path)
+        fingerprint = bundle_fingerprint(certificates)
+        entry = self._bundle_entry(certificates, fullchain_path, domain, fingerprint, key_path)
+        self._fingerprint_bundles(entry)
+        deployed_bundle_name = self._find_deployed_bundle(fingerprint)
+        if deployed_bundle_name is not None:
+            self._notify(f"Certificate for {domain} is already deployed as {deployed_bundle_name}")
+            return
+
+        cert_bundle_name = self._find_unused_bundle(fingerprint)
+        if cert_bundle_name is not None:
+            # still in Unit but no longer on the listener: it only has to be put back
+            self._uploaded_bundle_names.add(cert_bundle_name)
+            self._restored_bundles[cert_bundle_name] = entry
+        else:
+            cert_bundle_name = domain + "_" + self._entropy
+            if cert_bundle_name in self._uploaded_bundle_names and entry["key_type"]:
+                # the lineages of the other key types of the domain deployed in the same run
+                cert_bundle_name += "-" + entry["key_type"].lower()
+            self._upload_certificates(certificates, cert_bundle_name, entry)
+
+        old_certificate_bundle_names = self._find_old_bundle_names(domain, entry["key_type"])
+        if entry["common_name"] and domain.startswith(entry["common_name"] + "-"):
+            # the lineage of another key type is named after its domain, like www.example.org-ecdsa
+            old_certificate_bundle_names.extend(
+                bundle_name for bundle_name in self._find_old_bundle_names(entry["common_name"], entry["key_type"])
+                if bundle_name not in old_certificate_bundle_names)
+
+        # listeners are updated by _save_deploys(), once for all the deployed certificates
+        self._pending_deploys.append((cert_bundle_name, old_certificate_bundle_names))
+
+    def _save_deploys(self, defer: bool = False) -> None:
+        """Upload the queued bundles, update the listeners once and remove the replaced bundles.
+
+        The target Unit instances are saved concurrently, a failure on one of them does not stop the
+        others and raises a PluginError listing the failed instances once all of them are done.
+
+        :param bool defer: only upload the bundles, the rest is left to :meth:`_apply_deferred_deploys`
+
+        """
+        targets = self._get_targets()
+        if not defer and (self._pending_deploys or any(target._pending_deploys for _, target in targets)):
+            # not holding the lock: the other processes go on meanwhile
+            self._get_scheduler().wait_for_window()
+        if not targets:
+            self._save_own_deploys(defer)
+            return
+
+        failures = dict(self._target_errors)
+        self._target_errors = {}
+        with self._get_lock(), ThreadPoolExecutor(len(targets) + 1) as executor:
+            futures = [(self._instance_label(), executor.submit(self._save_own_deploys, defer))]
+            futures.extend((address, executor.submit(target._save_deploys, defer))
+                           for address, target in targets if address not in failures)
+            for address, future in futures:
+                try:
+                    future.result()
+                except errors.Error as exception:
+                    failures[address] = str(exception)
+
+        deployed = [address for address, _ in futures if address not in failures]
+        if deployed:
+            self._notify("Certificates deployed to {0}".format(", ".join(deployed)))
+        if failures:
+            raise errors.PluginError("Deploy failed on {0} of {1} Nginx Unit instances: {2}".format(
+                len(failures), len(targets) + 1,
+                "; ".join("{0}: {1}".format(address, error) for address, error in failures.items())))
+
+    def _save_own_deploys(self, defer: bool = False) -> None:
+        try:
+            if self._pending_deploys:
+                journal = self._create_journal(self._plan())
+                if defer:
+                    self._defer_journal(journal)
+                else:
+                    self._run_journal(journal)
+                prune_journals(self._journal_dir())
+        finally:
+            self._close_pool()
+
+    def _create_journal(self, deploys: List[Dict[str, Any]]) -> Journal:
+        self._journal_count += 1
+        return Journal.create(self._journal_dir(), "{0}-{1}".format(self._entropy, self._journal_count), deploys)
+
+    def _plan(self) -> List[Dict[str, Any]]:
+        # a resumed run uploads the restored bundles again if Unit lost them meanwhile
+        entries = dict(self._restored_bundles)
+        entries.update((cert_bundle_name, entry) for cert_bundle_name, _, entry in self._pending_uploads)
+        return [
+            {"bundle": cert_bundle_name, "key": entries.get(cert_bundle_name, {}).get("key"),
+             "fullchain": entries.get(cert_bundle_name, {}).get("fullchain"), "replaces": old_bundle_names}
+            for cert_bundle_name, old_bundle_names in self._pending_deploys
+        ]
+
+    def _run_journal(self, journal: Journal, resumed: bool = False) -> None:
+        """Run the steps of ``journal`` not completed yet, journaling each one once done.
+
+        A resumed journal is run from its plan, the steps that may have completed just before
+        the interruption are checked against Unit.
+
+        """
+        if resumed:
+            uploaded = set(journal.uploaded)
+            for deploy in journal.deploys:
+                cert_bundle_name = deploy["bundle"]
+                if cert_bundle_name in uploaded:
+                    continue
+                if self._bundle_exists(cert_bundle_name):
+                    journal.append("upload", bundle=cert_bundle_name)
+                    continue
+                self._queue_upload_from(cert_bundle_name, deploy)
+            self._pending_deploys = [(deploy["bundle"], deploy["replaces"]) for deploy in journal.deploys]
+
+        # a concurrent garbage collection must not see the uploaded bundles before the listeners use them
+        with self._get_lock():
+            self._upload_pending_certificates(journal)
+            if not journal.configured:
+                self._update_configuration(
+                    self._apply_pending_deploys,
+                    lambda current: journal.append("configure", listeners=listener_certificates(current)))
+                journal.append("configured", delete=self._bundles_to_delete,
+                               sources=self._bundle_sources(self._bundles_to_delete))
+            self._pending_deploys = []
+            self._bundles_to_delete = []
+
+        deleted = set(journal.deleted)
+        bundles_to_delete = [bundle_name for bundle_name in journal.to_delete if bundle_name not in deleted]
+        if resumed:
+            bundles_to_delete = [bundle_name for bundle_name in bundles_to_delete if self._bundle_exists(bundle_name)]
+        if bundles_to_delete:
+            self._notify("Remove old certificates")
+            self._delete_certificates(bundles_to_delete, journal)
+        journal.append("end")
+        for name in journal.applies:
+            source = Journal.load(os.path.join(self._journal_dir(), name + ".jsonl"))
+            if source is not None and source.status == DEFERRED:
+                source.append("applied", journal=journal.name)
+
+    def _defer_journal(self, journal: Journal) -> None:
+        """Upload the bundles of ``journal`` and leave the listeners untouched until the run is applied."""
+        with self._get_lock():
+            self._upload_pending_certificates(journal)
+        journal.append("deferred")
+        self._pending_deploys = []
+
+    def _apply_deferred_deploys(self, abandoned_only: bool = False) -> None:
+        """Apply the deferred runs with a single listeners update, journaled as a new run.
+
+        :param bool abandoned_only: only apply the deferred runs whose process is gone
+
+        """
+        with self._get_lock():
+            journals = load_journals(self._journal_dir())
+            # the runs being applied by another run, marked as applied once it is finished
+            claimed = {name for journal in journals if journal.status == RUNNING for name in journal.applies}
+            deferred = [journal for journal in journals
+                        if journal.status == DEFERRED and journal.name not in claimed
+                        and (journal.abandoned() or not abandoned_only)]
+            if not deferred:
+                return
+            journal = self._create_journal([deploy for source in deferred for deploy in source.deploys])
+            journal.append("apply", journals=[source.name for source in deferred])
+        self._notify("Applying the deferred deploys {0}".format(", ".join(source.name for source in deferred)))
+        try:
+            # as a resumed run: the bundles lost since their upload are uploaded again from their files
+            self._run_journal(journal, resumed=True)
+        finally:
+            self._close_pool()
+        prune_journals(self._journal_dir())
+
+    def _queue_upload_from(self, cert_bundle_name: str, source: Dict[str, Any]) -> None:
+        """Queue the upload of ``cert_bundle_name`` from its key and fullchain files."""
+        if not source.get("key") or not source.get("fullchain"):
+            raise errors.PluginError("The certificate files of {0} are not journaled".format(cert_bundle_name))
+        certificates = self._get_certificates_content(source["fullchain"], source["key"])
+        domain = cert_bundle_name.rsplit("_", 2)[0]
+        self._upload_certificates(certificates, cert_bundle_name, self._bundle_entry(
+            certificates, source["fullchain"], domain, bundle_fingerprint(certificates), source["key"]))
+
+    def _bundle_sources(self, bundle_names: List[str]) -> Dict[str, Dict[str, str]]:
+        """Key and fullchain files of the indexed bundles, to upload them again on rollback."""
+        bundle_index = self._get_bundle_index()
+        sources = {}
+        for bundle_name in bundle_names:
+            entry = bundle_index.bundles.get(bundle_name, {})
+            if entry.get("key") and entry.get("fullchain"):
+                sources[bundle_name] = {"key": entry["key"], "fullchain": entry["fullchain"]}
+        return sources
+
+    def _resume_interrupted_deploys(self) -> None:
+        """Finish the deploys of the runs interrupted by a crash, from their last completed step.
+
+        The deferred runs whose process is gone without applying them are applied too.
+
+        """
+        journals = load_journals(self._journal_dir())
+        interrupted = [journal for journal in journals if journal.interrupted()]
+        abandoned = any(journal.abandoned() for journal in journals)
+        if not interrupted and not abandoned:
+            return
+        with self._get_lock():
+            own_uploads, own_deploys = self._pending_uploads, self._pending_deploys
+            self._pending_uploads, self._pending_deploys = [], []
+            try:
+                for journal in interrupted:
+                    # another process may have resumed it while this one waited for the lock
+                    journal = Journal.load(journal.path)
+                    if journal is None or not journal.interrupted():
+                        continue
+                    self._notify("Resuming the interrupted deploy {0}".format(journal.name))
+                    try:
+                        self._run_journal(journal, resumed=True)
+                    except Exception as exception:  # pylint: disable=broad-except
+                        # a journal left running would be resumed, and would fail, by every later run
+                        logger.error("Unable to resume the interrupted deploy %s: %s", journal.name, exception)
+                        self._pending_uploads, self._pending_deploys = [], []
+                        journal.append("failed", error=str(exception))
+                if abandoned:
+                    try:
+                        self._apply_deferred_deploys(abandoned_only=True)
+                    except errors.Error as exception:
+                        # the run applying them is left running, resumed by the next deployer
+                        logger.error("Unable to apply the deferred deploys: %s", exception)
+                        self._pending_uploads, self._pending_deploys = [], []
+            finally:
+                self._pending_uploads, self._pending_deploys = own_uploads, own_deploys
+                self._close_pool()
+
+    def _rollback_deploys(self, count: int) -> None:
+        """Undo the last ``count`` journaled runs, newest first, on this Unit and on the targets."""
+        with self._get_lock():
+            journals = [journal for journal in load_journals(self._journal_dir())
+                        if journal.status not in (ROLLED_BACK, APPLIED) and not journal.in_progress()]
+            for journal in reversed(journals[-count:] if count > 0 else []):
+                self._rollback_journal(journal)
+        for _, target in self._get_targets():
+            target._connect()
+            target._rollback_deploys(count)
+
+    def _recover_deploys(self) -> None:
+        """Undo the runs of this deployer stopped by an error, drop its queued deploys."""
+        self._pending_uploads = []
+        self._pending_deploys = []
+        self._bundles_to_delete = []
+        self._transaction.rollback()
+        with self._get_lock():
+            for journal in load_journals(self._journal_dir()):
+                if journal.status == RUNNING and journal.name.startswith(self._entropy + "-"):
+                    self._rollback_journal(journal)
+        for _, target in self._get_targets():
+            target._recover_deploys()
+
+    def _rollback_journal(self, journal: Journal) -> None:
+        """Restore the listeners and the bundles as they were before the run of ``journal``."""
+        self._notify("Rolling back the deploy {0}".format(journal.name))
+        sources = journal.sources
+        deleted = [bundle_name for bundle_name in journal.deleted if not self._bundle_exists(bundle_name)]
+        lost = [bundle_name for bundle_name in deleted
+                if bundle_name not in sources
+                or not all(path and os.path.exists(path) for path in sources[bundle_name].values())]
+        if lost:
+            raise errors.PluginError("Unable to roll back the deploy {0}: the certificate files of {1} are gone".format(
+                journal.name, ", ".join(lost)))
+        try:
+            for bundle_name in deleted:
+                self._queue_upload_from(bundle_name, sources[bundle_name])
+            self._upload_pending_certificates()
+
+            listeners_before = journal.listeners_before
+            if listeners_before is not None:
+                added = set(journal.uploaded)
+                self._update_configuration(lambda: self._restore_listeners(listeners_before, added))
+
+            uploaded = [bundle_name for bundle_name in journal.uploaded if self._bundle_exists(bundle_name)]
+            if uploaded:
+                self._delete_certificates(uploaded)
+        finally:
+            self._close_pool()
+        journal.append("rollback")
+
+    def _restore_listeners(self, listeners_before: Dict[str, Optional[List[str]]], added: Set[str]) -> None:
+        listeners = self._configuration["listeners"]
+        for address in list(listeners):
+            listener = listeners[address]
+            certificate = listener.get("tls", {}).get("certificate") if isinstance(listener, dict) else None
+            if certificate is None:
+                continue
+            current = certificate if isinstance(certificate, list) else [certificate]
+            # the bundles deployed since then by other runs are kept
+            previous = listeners_before.get(address) or []
+            restored = previous + [item for item in current if item not in previous and item not in added]
+            if restored or listeners_before.get(address) is not None:
+                listener["tls"]["certificate"] = restored
+            elif address not in listeners_before:
+                del listeners[address]
+            else:
+                del listener["tls"]
+        self._stage("/listeners", "Listeners restored", "nginx unit restore listeners failed")
+
+    def _apply_pending_deploys(self) -> None:
+        self._bundles_to_delete = []
+        for cert_bundle_name, old_certificate_bundle_names in self._pending_deploys:
+            released_bundle_names = self._update_certificate_name_list_to_config(
+                cert_bundle_name, old_certificate_bundle_names)
+            # old bundles are still referenced by the listener until the transaction is committed
+            self._bundles_to_delete.extend(released_bundle_names)
+        # in the same write as the certificates
+        self._apply_tls_session()
+        self._apply_tls_profile()
+
+    def _get_session_options(self) -> Dict[str, Any]:
+        """Managed ``tls.session`` options, read (and the ticket keys rotated) once per run."""
+        if self._session_options is None:
+            settings = self._session_settings()
+            self._session_options = session_options(settings) if settings.managed else {}
+        return self._session_options
+
+    def _get_conf_commands(self) -> Dict[str, str]:
+        """OpenSSL commands of the TLS profile, checked against the local OpenSSL once per run."""
+        if self._conf_commands is None:
+            profile = self._tls_profile()
+            self._conf_commands = profile_commands(profile) if profile else {}
+        return self._conf_commands
+
+    def _apply_tls_profile(self) -> None:
+        """Replace the ``conf_commands`` of the TLS ``*:443`` listener with those of the TLS profile."""
+        commands = self._get_conf_commands()
+        listener = self._configuration.listener("*:443")
+        if not commands or not isinstance(listener, dict) or not isinstance(listener.get("tls"), dict):
+            return
+        if listener["tls"].get("conf_commands") != commands:
+            listener["tls"]["conf_commands"] = dict(commands)
+            self._stage("/listeners/*:443/tls/conf_commands", "TLS profile applied",
+                        "nginx unit tls profile update failed")
+
+    def _apply_tls_session(self) -> None:
+        """Set the managed session resumption options on the TLS ``*:443`` listener."""
+        options = self._get_session_options()
+        listener = self._configuration.listener("*:443")
+        if not options or not isinstance(listener, dict) or not isinstance(listener.get("tls"), dict):
+            return
+        session = listener["tls"].get("session")
+        updated = dict(session if isinstance(session, dict) else {}, **options)
+        if updated != session:
+            listener["tls"]["session"] = updated
+            self._stage("/listeners/*:443/tls/session", "TLS session options updated",
+                        "nginx unit tls session update failed")
+
+    def _get_bundle_index(self) -> BundleIndex:
+        if self._bundle_index is None:
+            self._bundle_index = BundleIndex(self._bundle_index_path())
+            if not self._bundle_index.load():
+                logger.debug("Building the certificate bundle index from /certificates")
+                # thousands of bundles: only the indexed fields are kept while the response is read
+                self._bundle_index.rebuild(self.unitc.get_json("/certificates", "Get configuration",
+                                                               "nginx unit get configuration failed",
+                                                               slim_unit_certificate))
+                self._save_bundle_index()
+        return self._bundle_index
+
+    def _save_bundle_index(self) -> None:
+        """Merge the changes of the bundle index into the one on disk, under the inter-process lock."""
+        if self._bundle_index is not None:
+            with self._get_lock():
+                self._bundle_index.save()
+
+    def _find_old_bundle_names(self, domain: str, key_type: Optional[str] = None) -> List[str]:
+        """Bundles of previous deploys for ``domain``, checked against Unit one by one.
+
+        The bundles of another key type are kept: an ECDSA certificate does not replace the
+        RSA one of the same domain, served to the clients without ECDSA support.
+
+        """
+        bundle_index = self._get_bundle_index()
+        old_bundle_names = []
+        for bundle_name in bundle_index.by_common_name(domain):
+            if bundle_name in self._uploaded_bundle_names:
+                continue
+            if not self._bundle_exists(bundle_name):
+                logger.debug("Certificate bundle %s is not in Unit anymore", bundle_name)
+                bundle_index.remove(bundle_name)
+                continue
+            old_key_type = self._bundle_key_type(bundle_name)
+            if key_type and old_key_type and old_key_type != key_type:
+                logger.debug("Keeping the %s certificate bundle %s", old_key_type, bundle_name)
+                continue
+            old_bundle_names.append(bundle_name)
+        return old_bundle_names
+
+    def _bundle_key_type(self, bundle_name: str) -> Optional[str]:
+        """Key type of an existing bundle, from the index or from its Unit description."""
+        key_type = self._get_bundle_index().key_type(bundle_name)
+        if key_type is None:
+            # indexed before the key types were: the description was just read by _bundle_exists()
+            description = self._get_unit_configuration("/certificates/" + bundle_name)
+            key_type = unit_key_type(description.get("key")) if isinstance(description, dict) else None
+        return key_type
+
+    def _fingerprint_bundles(self, entry: Dict[str, Any]) -> None:
+        """Index with the fingerprint of ``entry`` the bundles indexed from Unit with its certificate."""
+        bundle_index = self._get_bundle_index()
+        for bundle_name in bundle_index.by_certificate(entry):
+            logger.debug("Certificate bundle %s has the certificate of %s", bundle_name, entry["fullchain"])
+            bundle_index.add(bundle_name, dict(bundle_index.bundles[bundle_name], fingerprint=entry["fingerprint"]))
+
+    def _find_deployed_bundle(self, fingerprint: str) -> Optional[str]:
+        """Bundle with the same content served by the *:443 listener or uploaded by this run."""
+        for cert_bundle_name, _, entry in self._pending_uploads:
+            if entry.get("fingerprint") == fingerprint:
+                return cert_bundle_name
+        for bundle_name in self._get_bundle_index().by_fingerprint(fingerprint):
+            # Unit refuses listeners with missing bundles: a referenced bundle is live
+            if "*:443" in self._configuration.bundle_listeners(bundle_name):
+                return bundle_name
+        return None
+
+    def _find_unused_bundle(self, fingerprint: str) -> Optional[str]:
+        """Bundle with the same content found in Unit by :meth:`_scan_certificates`, unused by the listener."""
+        if self._existing_bundles is None:
+            return None
+        for bundle_name in self._get_bundle_index().by_fingerprint(fingerprint):
+            if bundle_name in self._existing_bundles:
+                return bundle_name
+        return None
+
+    def _scan_certificates(self) -> None:
+        """Read ``/certificates`` once and align the bundle index with it.
+
+        The bundles the index lost are indexed from their Unit description, those Unit lost are
+        forgotten, and every existence check of the deploys is answered without a request.
+
+        """
+        certificates = self.unitc.get_json("/certificates", "Get configuration",
+                                           "nginx unit get configuration failed", slim_unit_certificate)
+        bundle_index = BundleIndex(self._bundle_index_path())
+        if not bundle_index.load():
+            bundle_index.rebuild(certificates)
+        for bundle_name in list(bundle_index.bundles):
+            if bundle_name not in certificates:
+                bundle_index.remove(bundle_name)
+        for bundle_name, description in certificates.items():
+            if bundle_name not in bundle_index.bundles:
+                bundle_index.add(bundle_name, parse_unit_certificate(description))
+            self._cache["/certificates/" + bundle_name] = description
+        self._bundle_index = bundle_index
+        self._save_bundle_index()
+        self._existing_bundles = set(certificates)
+        for address, target in self._get_targets():
+            if address in self._target_errors:
+                continue
+            try:
+                target._connect()
+                target._scan_certificates()
+            except errors.Error as exception:
+                self._target_errors[address] = str(exception)
+
+    def _bundle_exists(self, bundle_name: str) -> bool:
+        """Whether Unit has the bundle, the errors other than a missing bundle are raised."""
+        try:
+            description = self._get_unit_configuration("/certificates/" + bundle_name)
+        except UnitError as exception:
+            if not exception.not_found:
+                raise
+            return False
+        return description is not None
+
+    @staticmethod
+    def _bundle_entry(certificates: bytes, fullchain_path: str, domain: str, fingerprint: str,
+                      key_path: str) -> Dict[str, Any]:
+        """Index entry of the bundle of ``certificates``, read from ``key_path`` and ``fullchain_path``."""
+        with open(fullchain_path, "rb") as f:
+            fullchain = f.read()
+        try:
+            entry = parse_certificate(fullchain)
+        except ValueError:
+            logger.warning("Unable to read the certificate %s", fullchain_path)
+            entry = {"common_name": domain, "alt_names": [], "not_after": None, "key_type": None}
+        entry["fingerprint"] = fingerprint
+        entry["size"] = len(certificates)
+        # the live symlinks move on renewal, the archive files stay for the rollbacks
+        entry["key"] = filesystem.realpath(key_path)
+        entry["fullchain"] = filesystem.realpath(fullchain_path)
+        return entry
+
+    def _upload_certificates(self, certificates: bytes, cert_bundle_name: str, entry: Dict[str, Any]) -> None:
+        """Queue the upload of a bundle: save() uploads all the queued bundles concurrently."""
+        self._uploaded_bundle_names.add(cert_bundle_name)
+        self._pending_uploads.append((cert_bundle_name, certificates, entry))
+
+    def _upload_pending_certificates(self, journal: Optional[Journal] = None) -> None:
+        pending_uploads, self._pending_uploads = self._pending_uploads, []
+        success_message = "Certificate deployed"
+        error_message = "nginx unit copy to /certificates failed"
+        results = self._run_concurrently([
+            ("PUT", "/certificates/" + cert_bundle_name, certificates, success_message, error_message)
+            for cert_bundle_name, certificates, _ in pending_uploads
+        ])
+        bundle_index = self._get_bundle_index()
+        for (cert_bundle_name, _, entry), result in zip(pending_uploads, results):
+            self._invalidate_cache("/certificates/" + cert_bundle_name)
+            if not isinstance(result, BaseException):
+                bundle_index.add(cert_bundle_name, entry)
+                if journal is not None:
+                    journal.append("upload", bundle=cert_bundle_name)
+        self._save_bundle_index()
+        raise_first_error(results)
+
+    def _delete_certificates(self, cert_bundle_names: List[str], journal: Optional[Journal] = None) -> None:
+        success_message = "Certificate deleted"
+        error_message = "nginx unit delete from /certificates failed"
+        results = self._run_concurrently([
+            ("DELETE", "/certificates/" + cert_bundle_name, None, success_message, error_message)
+            for cert_bundle_name in cert_bundle_names
+        ])
+        bundle_index = self._get_bundle_index()
+        for cert_bundle_name, result in zip(cert_bundle_names, results):
+            self._invalidate_cache("/certificates/" + cert_bundle_name)
+            if not isinstance(result, BaseException):
+                bundle_index.remove(cert_bundle_name)
+                if journal is not None:
+                    journal.append("delete", bundle=cert_bundle_name)
+        self._save_bundle_index()
+        raise_first_error(results)
+
+    def _run_concurrently(self, calls: List[Call]) -> List[Union[str, BaseException]]:
+        # the connections of the uploads are reused by the deletes
+        if self._pool is None:
+            self._pool = AsyncUnitc(self.unitc.clone, self._concurrency())
+        return run_calls(self.unitc, calls, self._concurrency(), self._pool)
+
+    def _close_pool(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def _update_certificate_name_list_to_config(self, cert_bundle_name: str, bundle_names_to_remove) -> List[str]:
+        """Replace the old bundles with the new one and return the old bundles no listener uses anymore."""
+        self._ensure_tls_listener()
+
+        # a bundle still used by any listener cannot be deleted
+        released_bundle_names = []
+        for bundle_name in bundle_names_to_remove:
+            released = True
+            for address in self._configuration.bundle_listeners(bundle_name):
+                tls = self._configuration["listeners"][address]["tls"]
+                if isinstance(tls["certificate"], list):
+                    tls["certificate"] = [item for item in tls["certificate"] if item != bundle_name]
+                else:
+                    released = False
+            if released:
+                released_bundle_names.append(bundle_name)
+
+        cert_bundle_names = self._configuration["listeners"]["*:443"]["tls"]["certificate"]
+        # a resumed deploy may have been applied already
+        cert_bundle_names = [item for item in cert_bundle_names
+                             if item not in bundle_names_to_remove and item != cert_bundle_name]
+        cert_bundle_names.append(cert_bundle_name)
+        self._configuration["listeners"]["*:443"]["tls"]["certificate"] = cert_bundle_names
+
+        success_message = "Certificate deployed"
+        error_message = "nginx unit copy to /certificates failed"
+        self._stage("/listeners", success_message, error_message)
+
+        return released_bundle_names
+
+    def _ensure_tls_listener(self):
+        if "listeners" not in self._configuration:
+            raise errors.PluginError("No listeners configured")
+        listener = self._configuration.listener("*:443")
+        if listener is None:
+            if self._configuration.listener("*:80") is None:
+                raise errors.PluginError("No '*:80' default listeners configured")
+            listener = copy.deepcopy(self._configuration.listener("*:80"))
+            self._configuration["listeners"]["*:443"] = listener
+
+        tls = listener.setdefault("tls", {})
+        if "certificate" not in tls:
+            tls["certificate"] = []
+        elif not isinstance(tls["certificate"], list):
+            tls["certificate"] = [tls["certificate"]]
+
+    @staticmethod
+    def _get_certificates_content(fullchain_path, key_path):
+        with open(key_path, "rb") as f:
+            certificates = f.read()
+        with open(fullchain_path, "rb") as f:
+            certificates += f.read()
+        return certificates
+
+    def _get_unit_configuration(self, path: str):
+        """Parsed value at ``path`` of the control API, read once until a write invalidates it."""
+        if path in self._cache:
+            return self._cache[path]
+        error_message = "nginx unit get configuration failed"
+        self._cache[path] = self.unitc.get_json(path, "Get configuration", error_message)
+        return self._cache[path]
+
+    def _invalidate_cache(self, path: str) -> None:
+        for cached_path in list(self._cache):
+            if (cached_path + "/").startswith(path + "/") or (path + "/").startswith(cached_path + "/"):
+                del self._cache[cached_path]
+
+    def _get_config_subtree(self, path: str) -> Any:
+        """Value at ``path`` of the configuration (cached), ``MISSING`` if Unit does not have it."""
+        try:
+            return self._get_unit_configuration("/config" + path)
+        except UnitError as exception:
+            # any other error would make a configuration written from nothing
+            if not exception.not_found:
+                raise
+            return MISSING
+
+    def _load_configuration(self) -> None:
+        """Read the subtrees of ``/config`` used so far, see :meth:`_require_sections`."""
+        configuration = UnitConfiguration()
+        for section in sorted(self._sections):
+            value = self._get_config_subtree("/" + section)
+            if value is not MISSING:
+                configuration[section] = value
+        self._configuration = configuration
+        self._transaction.begin(self._configuration)
+
+    def _require_sections(self, *sections: str) -> None:
+        """Read the top-level ``/config`` subtrees of ``sections`` not read yet."""
+        for section in sections:
+            if section in self._sections:
+                continue
+            self._sections.add(section)
+            if self._configuration is None:
+                continue
+            value = self._get_config_subtree("/" + section)
+            if value is not MISSING:
+                self._configuration[section] = value
+                self._transaction.record("/" + section, value)
+        if self._configuration is not None:
+            self._configuration.reindex()
+
+    def _stage(self, path: str, success_message: str = "", error_message: str = "") -> None:
+        self._configuration.reindex()
+        self._transaction.stage(path, success_message, error_message)
+
+    def _commit(self) -> None:
+        for path in self._transaction.staged_paths():
+            self._invalidate_cache("/config" + path)
+        self._get_scheduler().throttle(len(self._transaction.operations(self._configuration)))
+        self._transaction.commit(self.unitc, self._configuration)
+
+    def _get_lock(self) -> UnitLock:
+        if self._lock is None:
+            scheduler = self._get_scheduler()
+            # a paced process may hold the lock while waiting for its reconfiguration
+            timeout = LOCK_TIMEOUT + (scheduler.period if scheduler.limited else 0)
+            self._lock = UnitLock(self._lock_path() or default_lock_path(), timeout)
+        return self._lock
+
+    def _get_scheduler(self) -> ReconfigurationScheduler:
+        if self._scheduler is None:
+            self._scheduler = ReconfigurationScheduler(
+                os.path.splitext(self._bundle_index_path())[0] + ".reconfigurations.json",
+                self._max_reconfigurations(), self._reconfiguration_period(), self._maintenance_window())
+            # fewer and larger writes when they are paced
+            self._transaction.merge = self._scheduler.limited
+        return self._scheduler
+
+    def _update_configuration(self, mutate: Callable[[], None],
+                              before_commit: Optional[Callable[[Dict[str, Any]], None]] = None) -> None:
+        """Apply ``mutate`` to the configuration and commit it as a compare-and-swap.
+
+        It runs under the inter-process lock. When another process has changed the staged
+        subtrees since they were read, the configuration is read again and ``mutate``,
+        which must only depend on the configuration and on the plugin state, is replayed.
+        ``before_commit`` is called with the configuration read from Unit just before writing.
+
+        """
+        # the scheduler decides whether the staged paths are merged
+        self._get_scheduler()
+        with self._get_lock():
+            for _ in range(CAS_ATTEMPTS):
+                if self._configuration is None:
+                    self._load_configuration()
+                mutate()
+                if not self._transaction.operations(self._configuration):
+                    self._transaction.rollback()
+                    return
+                # only the staged subtrees are read again
+                current: Dict[str, Any] = {}
+                for path in self._transaction.staged_paths():
+                    self._invalidate_cache("/config" + path)
+                    store(current, path, self._get_config_subtree(path))
+                changed_paths = self._transaction.changed_paths(current)
+                if not changed_paths:
+                    if before_commit is not None:
+                        before_commit(current)
+                    self._commit()
+                    return
+                logger.info("Nginx Unit configuration %s changed by another process, updating it again",
+                            ", ".join(changed_paths))
+                self._transaction.rollback()
+                for path in changed_paths:
+                    self._invalidate_cache("/config/" + split_path(path)[0])
+                self._configuration = None
+        raise errors.PluginError("Nginx Unit configuration keeps changing, update not applied")
+
+
+class Deployer(UnitDeployer):
+    """Deploys outside of a certbot run.
+
+    :param unitc: control API client
+    :param str work_dir: certbot working directory, holding the certificate bundle index
+    :param int concurrency: maximum number of bundles uploaded or deleted at the same time
+    :param str lock_path: lock file shared with the certbot runs, None for the default one
+    :param str index_path: certificate bundle index, None for the one of ``work_dir``
+    :param control_addresses: address of ``unitc`` followed by those of the other Unit instances
+        receiving the same deploys
+    :param int max_reconfigurations: maximum configuration writes per ``reconfiguration_period``
+        seconds, 0 for no limit
+    :param maintenance_window: daily window outside which the deploys wait, None for always
+    :param session_settings: session resumption options managed on the ``*:443`` listener
+    :param str tls_profile: TLS performance profile of the ``*:443`` listener, None to leave it alone
+
+    """
+
+    def __init__(self, unitc: Unitc, work_dir: str, concurrency: int = 4, lock_path: Optional[str] = None,
+                 index_path: Optional[str] = None, control_addresses: Optional[List[str]] = None,
+                 max_reconfigurations: int = 0, reconfiguration_period: float = 60.0,
+                 maintenance_window: Optional[MaintenanceWindow] = None,
+                 session_settings: Optional[SessionSettings] = None, tls_profile: Optional[str] = None):
+        super().__init__()
+        self.unitc = unitc
+        self.work_dir = work_dir
+        self.concurrency = concurrency
+        self.lock_path = lock_path
+        self.index_path = index_path
+        self.control_addresses = control_addresses or []
+        self.max_reconfigurations = max_reconfigurations
+        self.reconfiguration_period = reconfiguration_period
+        self.maintenance_window = maintenance_window
+        self.session_settings = session_settings or SessionSettings()
+        self.tls_profile = tls_profile
+
+    def _work_dir(self) -> str:
+        return self.work_dir
+
+    def _concurrency(self) -> int:
+        return self.concurrency
+
+    def _lock_path(self) -> Optional[str]:
+        return self.lock_path
+
+    def _bundle_index_path(self) -> str:
+        return self.index_path or super()._bundle_index_path()
+
+    def _control_addresses(self) -> List[str]:
+        return self.control_addresses
+
+    def _max_reconfigurations(self) -> int:
+        return self.max_reconfigurations
+
+    def _reconfiguration_period(self) -> float:
+        return self.reconfiguration_period
+
+    def _maintenance_window(self) -> Optional[MaintenanceWindow]:
+        return self.maintenance_window
+
+    def _session_settings(self) -> SessionSettings:
+        return self.session_settings
+
+    def _tls_profile(self) -> Optional[str]:
+        return self.tls_profile
+
+    def deploy(self, domain: str, key_path: str, fullchain_path: str) -> None:
+        """Queue the deploy of a certificate for ``domain``, applied by :meth:`save`."""
+        self._connect()
+        self._queue_deploy(domain, key_path, fullchain_path)
+
+    def save(self) -> None:
+        """Apply the queued deploys."""
+        self._save_deploys()
+
+    def apply_deferred(self) -> None:
+        """Apply the deploys deferred by the renewals, with a single listeners update per Unit instance.
+
+        A failure on one instance does not stop the others and raises a PluginError listing the
+        failed instances once all of them are done.
+
+        """
+        instances: List[Tuple[str, UnitDeployer]] = [(self._instance_label(), self)]
+        instances.extend(self._get_targets())
+        failures: Dict[str, str] = {}
+        for address, instance in instances:
+            try:
+                instance._connect()
+                if any(journal.status == DEFERRED for journal in load_journals(instance._journal_dir())):
+                    # not holding the lock: the other processes go on meanwhile
+                    instance._get_scheduler().wait_for_window()
+                instance._apply_deferred_deploys()
+            except errors.Error as exception:
+                failures[address] = str(exception)
+        if failures:
+            raise errors.PluginError("Deferred deploys failed on {0} of {1} Nginx Unit instances: {2}".format(
+                len(failures), len(instances),
+                "; ".join("{0}: {1}".format(address, error) for address, error in failures.items())))
+
+    def reconcile(self, lineages: List[Tuple[str, str, str]]) -> Dict[str, List[str]]:
+        """Bring Unit to the certificates of ``lineages`` in one pass and a single listeners update.
+
+        Only the missing or outdated certificates are uploaded, those still in Unit are put back
+        on the listener.
+
+        :param lineages: name, key path and fullchain path of every lineage
+        :returns: the lineage names by outcome: "uploaded", "restored" and "unchanged"
+
+        """
+        self._connect()
+        self._scan_certificates()
+        outcomes: Dict[str, List[str]] = {"uploaded": [], "restored": [], "unchanged": []}
+        for name, key_path, fullchain_path in lineages:
+            uploads, deploys = len(self._pending_uploads), len(self._pending_deploys)
+            self._queue_deploy(name, key_path, fullchain_path)
+            if len(self._pending_uploads) > uploads:
+                outcomes["uploaded"].append(name)
+            elif len(self._pending_deploys) > deploys:
+                outcomes["restored"].append(name)
+            else:
+                outcomes["unchanged"].append(name)
+        self._save_deploys()
+        return outcomes
+
+    def update_session(self) -> None:
+        """Apply the session resumption options, with the ticket keys rotated when due, to every instance."""
+        self._connect()
+        self._update_configuration(self._apply_tls_session)
+        for _, target in self._get_targets():
+            target._session_options = self._get_session_options()
+            target.update_session()
+
+    def close(self) -> None:
+        """Close the control API connections."""
+        for _, target in self._get_targets():
+            target.close()
+        if self.unitc is not None:
+            self.unitc.close()
@@ -0,0 +1,70 @@
+"""Minimal-subtree diff of Nginx Unit configurations.
+
+Each write to the control API makes Unit parse and validate the sent value and
+reconfigure the router, so a change is sent as the single operation on the
+deepest subtree that contains it: the changed value itself, an append to an
+array (POST) or the removal of one array item (DELETE).
+
+"""
+import urllib.parse
+from typing import Any, List, NamedTuple, Optional
+
+MISSING: Any = object()
+
+
+class Operation(NamedTuple):
+    """Control API operation: ``method`` on ``path`` with the JSON ``value`` (PUT and POST)."""
+    method: str
+    path: str
+    value: Any = None
+
+
+def join_path(path: str, segment: Any) -> str:
+    """Append a key or an array index to a configuration path."""
+    return path + "/" + urllib.parse.quote(str(segment), safe="*:")
+
+
+def _list_operation(old: List[Any], new: List[Any], path: str) -> Optional[Operation]:
+    if len(new) == len(old) + 1 and new[:len(old)] == old:
+        return Operation("POST", path, new[-1])
+    if len(new) == len(old) - 1:
+        for index, item in enumerate(new):
+            if item != old[index]:
+                if new[index:] == old[index + 1:]:
+                    return Operation("DELETE", join_path(path, index))
+                return None
+        return Operation("DELETE", join_path(path, len(new)))
+    return None
+
+
+def diff(old: Any, new: Any, path: str = "") -> List[Operation]:
+    """Operations to turn the ``old`` value at ``path`` into ``new``.
+
+    :param old: current value, ``MISSING`` if it does not exist
+    :param new: desired value, ``MISSING`` to remove it
+    :param str path: path of the values
+    :returns: no operation when the values are equal, a single one otherwise
+
+    """
+    if old is not MISSING and new is not MISSING and type(old) is type(new) and old == new:
+        return []
+    if new is MISSING:
+        return [Operation("DELETE", path)]
+    if isinstance(old, dict) and isinstance(new, dict):
+        changed = [key for key in new if key not in old or old[key] != new[key]]
+        changed += [key for key in old if key not in new]
+        if len(changed) == 1:
+            key = changed[0]
+            return diff(old.get(key, MISSING), new.get(key, MISSING), join_path(path, key))
+    elif isinstance(old, list) and isinstance(new, list):
+        if len(old) == len(new):
+            changed = [index for index, item in enumerate(new)
+                       if type(item) is not type(old[index]) or item != old[index]]
+            if len(changed) == 1:
+                index = changed[0]
+                return diff(old[index], new[index], join_path(path, index))
+        else:
+            operation = _list_operation(old, new, path)
+            if operation is not None:
+                return [operation]
+    return [Operation("PUT", path, new)]
@@ -0,0 +1,239 @@
+"""Write-ahead journal of the deploys to Nginx Unit.
+
+Every save of queued deploys writes its plan (the bundles to upload, with the
+certificate files they are read from, and the bundles they replace) to a
+journal before touching Unit, then one entry per completed step: each upload,
+the listener certificates just before the listeners update, the bundles to
+remove once it is applied, each removal, and the end of the run. Entries are
+JSON lines flushed to the disk one by one.
+
+A run interrupted by a crash is resumed from its last completed step by the
+next deployer, and a finished run can be undone precisely by a rollback.
+
+A deferred run stops after its uploads. The deferred runs are applied together
+by a new run planning all their deploys, each one is marked as applied once the
+new run is finished.
+
+"""
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from certbot import errors
+from certbot.compat import filesystem
+from certbot.compat import os
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_VERSION = 1
+# finished journals kept for the rollbacks
+JOURNALS_KEPT = 20
+
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+ROLLED_BACK = "rolled back"
+DEFERRED = "deferred"
+APPLIED = "applied"
+
+# journals of the runs of this process: the other ones are foreign even when they carry its PID,
+# left by a crashed run of an earlier container or by a process whose PID was reused
+_own_journals: Set[str] = set()
+
+
+def listener_certificates(configuration: Dict[str, Any]) -> Dict[str, Optional[List[str]]]:
+    """Certificate bundles of every listener of ``configuration``, None for the listeners without TLS."""
+    certificates: Dict[str, Optional[List[str]]] = {}
+    for address, listener in configuration.get("listeners", {}).items():
+        certificate = listener.get("tls", {}).get("certificate") if isinstance(listener, dict) else None
+        if certificate is None:
+            certificates[address] = None
+        else:
+            certificates[address] = list(certificate) if isinstance(certificate, list) else [certificate]
+    return certificates
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Journal:
+    """Entries of one deploy run, appended to the JSON lines file ``path``."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: List[Dict[str, Any]] = []
+
+    @property
+    def name(self) -> str:
+        return os.path.splitext(os.path.basename(self.path))[0]
+
+    @classmethod
+    def create(cls, directory: str, name: str, deploys: List[Dict[str, Any]]) -> "Journal":
+        """Start the journal of a run with its plan.
+
+        :param deploys: bundle, key and fullchain paths, and replaced bundles of each deploy
+
+        """
+        journal = cls(os.path.join(directory, name + ".jsonl"))
+        _own_journals.add(os.path.abspath(journal.path))
+        journal.append("plan", version=JOURNAL_VERSION, pid=os.getpid(), started=time.time(), deploys=deploys)
+        return journal
+
+    @classmethod
+    def load(cls, path: str) -> Optional["Journal"]:
+        """Journal of ``path``, None when it is unreadable."""
+        journal = cls(path)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        journal.entries.append(json.loads(line))
+                    except ValueError:
+                        # the last entry was being written when the run was interrupted
+                        break
+        except OSError as exception:
+            logger.warning("Ignoring unreadable deploy journal %s: %s", path, exception)
+            return None
+        if not journal.entries or journal.entries[0].get("version") != JOURNAL_VERSION:
+            return None
+        return journal
+
+    def append(self, operation: str, **fields: Any) -> None:
+        """Write the entry durably before going on."""
+        entry = dict(op=operation, **fields)
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                filesystem.makedirs(directory, 0o700)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as exception:
+            raise errors.PluginError("Unable to write the deploy journal {0}: {1}".format(self.path, exception))
+        self.entries.append(entry)
+
+    def _values(self, operation: str, field: str) -> List[Any]:
+        return [entry[field] for entry in self.entries if entry["op"] == operation]
+
+    @property
+    def pid(self) -> int:
+        return self.entries[0]["pid"]
+
+    @property
+    def deploys(self) -> List[Dict[str, Any]]:
+        return self.entries[0]["deploys"]
+
+    @property
+    def uploaded(self) -> List[str]:
+        """Bundles uploaded by the run."""
+        return self._values("upload", "bundle")
+
+    @property
+    def listeners_before(self) -> Optional[Dict[str, Optional[List[str]]]]:
+        """Listener certificates just before the listeners update, None before it starts."""
+        values = self._values("configure", "listeners")
+        return values[-1] if values else None
+
+    @property
+    def configured(self) -> bool:
+        return bool(self._values("configured", "delete"))
+
+    @property
+    def to_delete(self) -> List[str]:
+        """Replaced bundles to remove once the listeners are updated."""
+        values = self._values("configured", "delete")
+        return values[-1] if values else []
+
+    @property
+    def applies(self) -> List[str]:
+        """Names of the deferred runs applied by the run."""
+        return [name for names in self._values("apply", "journals") for name in names]
+
+    @property
+    def deleted(self) -> List[str]:
+        return self._values("delete", "bundle")
+
+    @property
+    def sources(self) -> Dict[str, Dict[str, str]]:
+        """Key and fullchain files of the bundles uploaded or removed by the run."""
+        sources = {deploy["bundle"]: {"key": deploy["key"], "fullchain": deploy["fullchain"]}
+                   for deploy in self.deploys}
+        for values in self._values("configured", "sources"):
+            sources.update(values)
+        return sources
+
+    @property
+    def status(self) -> str:
+        operations = [entry["op"] for entry in self.entries]
+        if "rollback" in operations:
+            return ROLLED_BACK
+        if "applied" in operations:
+            return APPLIED
+        if "end" in operations:
+            return FINISHED
+        if "failed" in operations:
+            return FAILED
+        if "deferred" in operations:
+            return DEFERRED
+        return RUNNING
+
+    def own(self) -> bool:
+        """Whether the journal was created by a run of this process."""
+        return os.path.abspath(self.path) in _own_journals
+
+    def _foreign_process_alive(self) -> bool:
+        # a foreign run carrying the PID of this process is gone
+        return self.pid != os.getpid() and _pid_alive(self.pid)
+
+    def in_progress(self) -> bool:
+        """Whether the run is going on in another process."""
+        return self.status == RUNNING and not self.own() and self._foreign_process_alive()
+
+    def interrupted(self) -> bool:
+        """Whether the run stopped before its end and its process is gone."""
+        return self.status == RUNNING and not self.own() and not self._foreign_process_alive()
+
+    def abandoned(self) -> bool:
+        """Whether the run was deferred and its process is gone without applying it."""
+        return self.status == DEFERRED and not self.own() and not self._foreign_process_alive()
+
+
+def load_journals(directory: str) -> List[Journal]:
+    """Readable journals of ``directory``, oldest first."""
+    try:
+        file_names = sorted(name for name in os.listdir(directory) if name.endswith(".jsonl"))
+    except FileNotFoundError:
+        return []
+    journals = [Journal.load(os.path.join(directory, file_name)) for file_name in file_names]
+    # the names only order the runs started in different seconds
+    return sorted((journal for journal in journals if journal is not None),
+                  key=lambda journal: journal.entries[0].get("started", 0))
+
+
+def pending_bundles(directory: str) -> Set[str]:
+    """Bundles planned or uploaded by the deferred runs and the runs not finished, not on a listener yet."""
+    bundles: Set[str] = set()
+    for journal in load_journals(directory):
+        if journal.status in (RUNNING, DEFERRED):
+            bundles.update(deploy["bundle"] for deploy in journal.deploys)
+            bundles.update(journal.uploaded)
+    return bundles
+
+
+def prune_journals(directory: str, kept: int = JOURNALS_KEPT) -> None:
+    """Remove the oldest finished, rolled back or applied journals, keeping the last ``kept`` ones."""
+    done = [journal for journal in load_journals(directory) if journal.status in (FINISHED, ROLLED_BACK, APPLIED)]
+    for journal in done[:max(len(done) - kept, 0)]:
+        try:
+            os.remove(journal.path)
+        except OSError as exception:
+            logger.debug("Unable to remove the deploy journal %s: %s", journal.path, exception)
@@ -0,0 +1,148 @@
+"""Incremental decoding of the JSON objects returned by the Nginx Unit control API.
+
+``GET /certificates`` on a host with thousands of bundles returns megabytes of
+JSON, of which the plugin only needs a few fields per bundle. The members of
+the top-level object are decoded one at a time while the response is read, so
+that neither the whole body nor its whole decoded tree is held in memory.
+
+"""
+import codecs
+import json
+import re
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# error responses of Unit are small objects whose first member is the error message
+_ERROR_PREFIX = re.compile(rb'\s*\{\s*"error"\s*:\s*"')
+ERROR_BODY_LIMIT = 64 * 1024
+
+Select = Callable[[str, Any], Any]
+
+
+class _Reader:
+    """Text buffer filled from byte chunks, consumed from the front."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def fill(self, size: int = 1) -> bool:
+        """Read until ``size`` more characters are buffered, False at the end of the input."""
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+        wanted = len(self.buffer) + size
+        while len(self.buffer) < wanted:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self.buffer += self._decoder.decode(b"", final=True)
+                self.eof = True
+                return len(self.buffer) >= wanted
+            self.buffer += self._decoder.decode(chunk)
+        return True
+
+    def skip_whitespace(self) -> str:
+        """Next significant character, "" at the end of the input."""
+        while True:
+            self.position = _WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return ""
+
+    def decode_value(self) -> Any:
+        """Decode the JSON value at the current position.
+
+        A value is complete once a character follows it: a number at the end of the buffer
+        may go on in the next chunk.
+
+        """
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            else:
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            # grow geometrically: a large value is decoded again only a few times
+            if not self.fill(max(len(self.buffer) - self.position, 4096)) and not self.buffer[self.position:]:
+                raise ValueError("Truncated JSON document")
+
+
+def iter_members(chunks: Iterable[bytes], select: Optional[Select] = None) -> Iterator[Tuple[str, Any]]:
+    """Members of the JSON object read from ``chunks``, decoded one at a time.
+
+    :param select: reduces each member value as soon as it is decoded, e.g. to the fields needed
+    :raises ValueError: when the document is not a valid JSON object
+
+    """
+    reader = _Reader(chunks)
+    if reader.skip_whitespace() != "{":
+        raise ValueError("Not a JSON object")
+    reader.position += 1
+    if reader.skip_whitespace() == "}":
+        reader.position += 1
+    else:
+        while True:
+            if reader.skip_whitespace() != '"':
+                raise ValueError("Expected a member name at character {0}".format(reader.position))
+            name = reader.decode_value()
+            if reader.skip_whitespace() != ":":
+                raise ValueError("Expected ':' after the member name {0!r}".format(name))
+            reader.position += 1
+            reader.skip_whitespace()
+            value = reader.decode_value()
+            yield name, select(name, value) if select is not None else value
+            separator = reader.skip_whitespace()
+            reader.position += 1
+            if separator == "}":
+                break
+            if separator != ",":
+                raise ValueError("Expected ',' or '}}' after the member {0!r}".format(name))
+    if reader.skip_whitespace():
+        raise ValueError("Extra data after the JSON object")
+
+
+def decode(chunks: Iterable[bytes], select: Optional[Select] = None) -> Any:
+    """JSON value read from ``chunks``, an object being decoded member by member."""
+    chunks = iter(chunks)
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if head.strip():
+            break
+    if not head.lstrip().startswith(b"{"):
+        return json.loads(head + b"".join(chunks))
+    return dict(iter_members(_prepend(head, chunks), select))
+
+
+def _prepend(head: bytes, chunks: Iterator[bytes]) -> Iterator[bytes]:
+    yield head
+    yield from chunks
+
+
+def response_error(status: int, body: bytes) -> Optional[str]:
+    """Error reported by a control API response, None on success.
+
+    Unit answers errors with a 4xx or 5xx status and an ``error`` member, the only
+    member checked in a successful response: certificates or routes may contain the
+    word anywhere else.
+
+    """
+    if status < 400 and not _ERROR_PREFIX.match(body[:ERROR_BODY_LIMIT]):
+        return None
+    if len(body) <= ERROR_BODY_LIMIT:
+        try:
+            value = json.loads(body)
+        except ValueError:
+            value = None
+        if isinstance(value, dict) and isinstance(value.get("error"), str):
+            detail = value.get("detail")
+            return value["error"] + (" ({0})".format(detail) if detail else "")
+    return "HTTP status {0}".format(status) if status >= 400 else None
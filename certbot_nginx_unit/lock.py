@@ -0,0 +1,120 @@
+"""Inter-process lock around the read-modify-write of the Nginx Unit configuration.
+
+The lock is a ``lockf`` record lock on a lock file. Record locks belong to the
+process, the locks of the same process on a lock file are serialized by a
+thread lock per path.
+
+"""
+import errno
+import fcntl
+import logging
+import tempfile
+import threading
+import time
+from types import TracebackType
+from typing import Dict, Optional, Type
+
+from certbot import errors
+from certbot.compat import filesystem
+from certbot.compat import os
+
+logger = logging.getLogger(__name__)
+
+_process_locks: Dict[str, threading.Lock] = {}
+_process_locks_guard = threading.Lock()
+
+
+def _process_lock(path: str) -> threading.Lock:
+    with _process_locks_guard:
+        return _process_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+def default_lock_path() -> str:
+    """Lock file shared by every certbot process on the host, whatever their work dirs."""
+    directory = "/run/lock" if os.path.isdir("/run/lock") else tempfile.gettempdir()
+    return os.path.join(directory, "certbot-nginx-unit.lock")
+
+
+class UnitLock:
+    """Reentrant inter-process lock, held only for the short configuration updates.
+
+    Once held, the threads of the process deploying to several Unit instances share it.
+
+    :param str path: lock file path
+    :param float timeout: seconds to wait for another process to release the lock
+
+    """
+
+    def __init__(self, path: str, timeout: float = 60.0):
+        self.path = path
+        self.timeout = timeout
+        self._fd: Optional[int] = None
+        self._depth = 0
+        self._guard = threading.Lock()
+
+    def acquire(self) -> None:
+        """Wait for the lock, PluginError after ``timeout`` seconds."""
+        with self._guard:
+            self._acquire()
+
+    def _timeout_error(self) -> errors.PluginError:
+        return errors.PluginError("Another certbot process is updating Nginx Unit, lock {0} still held after "
+                                  "{1} seconds".format(self.path, self.timeout))
+
+    def _acquire(self) -> None:
+        if self._depth:
+            self._depth += 1
+            return
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            filesystem.makedirs(directory, 0o755)
+        deadline = time.monotonic() + self.timeout
+        process_lock = _process_lock(self.path)
+        if not process_lock.acquire(timeout=max(self.timeout, 0)):
+            raise self._timeout_error()
+        try:
+            self._fd = self._lock_file(deadline)
+        finally:
+            if self._fd is None:
+                process_lock.release()
+        logger.debug("Acquired lock %s", self.path)
+        self._depth = 1
+
+    def _lock_file(self, deadline: float) -> int:
+        try:
+            fd = filesystem.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError as exception:
+            raise errors.PluginError("Unable to open the lock file {0}: {1}".format(self.path, exception))
+        while True:
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError as exception:
+                if exception.errno not in (errno.EACCES, errno.EAGAIN) or time.monotonic() >= deadline:
+                    os.close(fd)
+                    if exception.errno in (errno.EACCES, errno.EAGAIN):
+                        raise self._timeout_error()
+                    raise errors.PluginError("Unable to lock {0}: {1}".format(self.path, exception))
+            time.sleep(0.1)
+
+    def release(self) -> None:
+        """Release the lock."""
+        with self._guard:
+            self._release()
+
+    def _release(self) -> None:
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            # the lock file is kept: removing it would let another process lock a new file meanwhile
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+            _process_lock(self.path).release()
+
+    def __enter__(self) -> "UnitLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]], exc_value: Optional[BaseException],
+                 traceback: Optional[TracebackType]) -> None:
+        self.release()
@@ -0,0 +1,171 @@
+"""Timings and counters of the control API calls and of the plugin phases.
+
+Every control API call of the process is recorded in :data:`METRICS`, grouped by
+method, path and error kind, together with the duration of the plugin phases
+(``prepare``, ``perform``, ``deploy_cert``, ...). The totals can be written at
+the end of the run as a Prometheus textfile (node_exporter textfile collector)
+and as a JSON summary.
+
+"""
+import functools
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Tuple, TypeVar
+
+from certbot.compat import filesystem
+from certbot.compat import os
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "certbot_nginx_unit"
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def path_label(path: str) -> str:
+    """Path without the bundle names, so that the number of label values stays bounded."""
+    segments = path.split("/")
+    if len(segments) > 2 and segments[1] == "certificates":
+        return "/certificates/{bundle}"
+    return path
+
+
+class _CallStats:
+    __slots__ = ("count", "seconds", "max_seconds", "request_bytes", "response_bytes")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Metrics:
+    """Thread-safe registry of the control API calls and phase timings of the run."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[Tuple[str, str, str], _CallStats] = {}
+        self._phases: Dict[str, _CallStats] = {}
+
+    def record_call(self, method: str, path: str, request_bytes: int, response_bytes: int, seconds: float,
+                    error: str = "") -> None:
+        """Record a control API call.
+
+        :param str error: ``""`` on success, ``"unit"`` when Unit answered with an error,
+            ``"connection"`` when it could not be reached
+
+        """
+        with self._lock:
+            stats = self._calls.setdefault((method, path_label(path), error), _CallStats())
+            stats.count += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.request_bytes += request_bytes
+            stats.response_bytes += response_bytes
+
+    def record_phase(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            stats = self._phases.setdefault(phase, _CallStats())
+            stats.count += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+    def timed(self, phase: str) -> Callable[[F], F]:
+        """Decorator recording the duration of each call of the decorated function as ``phase``."""
+        def decorator(function: F) -> F:
+            @functools.wraps(function)
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                start = time.monotonic()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record_phase(phase, time.monotonic() - start)
+            return wrapper  # type: ignore[return-value]
+        return decorator
+
+    def reset(self) -> None:
+        with self._lock:
+            self._calls.clear()
+            self._phases.clear()
+
+    def summary(self) -> Dict[str, Any]:
+        """JSON serializable totals."""
+        with self._lock:
+            return {
+                "timestamp": time.time(),
+                "api_calls": [
+                    dict(method=method, path=path, error=error, **stats.as_dict())
+                    for (method, path, error), stats in sorted(self._calls.items())
+                ],
+                "phases": {phase: {"count": stats.count, "seconds": stats.seconds, "max_seconds": stats.max_seconds}
+                           for phase, stats in sorted(self._phases.items())},
+            }
+
+    def prometheus(self) -> str:
+        """Totals in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = []
+
+        def metric(name: str, metric_type: str, description: str, samples: Any) -> None:
+            lines.append("# HELP {0}_{1} {2}".format(PREFIX, name, description))
+            lines.append("# TYPE {0}_{1} {2}".format(PREFIX, name, metric_type))
+            for labels, value in samples:
+                label_text = ",".join('{0}="{1}"'.format(key, _escape(str(label_value)))
+                                      for key, label_value in labels.items())
+                lines.append("{0}_{1}{{{2}}} {3}".format(PREFIX, name, label_text, value))
+
+        def call_labels(call: Dict[str, Any]) -> Dict[str, Any]:
+            return {"method": call["method"], "path": call["path"], "error": call["error"]}
+
+        calls = summary["api_calls"]
+        metric("api_calls_total", "counter", "Nginx Unit control API calls.",
+               [(call_labels(call), call["count"]) for call in calls])
+        metric("api_call_seconds_total", "counter", "Time spent in Nginx Unit control API calls.",
+               [(call_labels(call), call["seconds"]) for call in calls])
+        metric("api_call_seconds_max", "gauge", "Slowest Nginx Unit control API call of the run.",
+               [(call_labels(call), call["max_seconds"]) for call in calls])
+        metric("api_request_bytes_total", "counter", "Bytes sent to the Nginx Unit control API.",
+               [(call_labels(call), call["request_bytes"]) for call in calls])
+        metric("api_response_bytes_total", "counter", "Bytes received from the Nginx Unit control API.",
+               [(call_labels(call), call["response_bytes"]) for call in calls])
+        phases = summary["phases"]
+        metric("phase_calls_total", "counter", "Calls of the plugin phases.",
+               [({"phase": phase}, stats["count"]) for phase, stats in phases.items()])
+        metric("phase_seconds_total", "counter", "Time spent in the plugin phases.",
+               [({"phase": phase}, stats["seconds"]) for phase, stats in phases.items()])
+        lines.append("# HELP {0}_last_run_timestamp_seconds End of the last certbot run.".format(PREFIX))
+        lines.append("# TYPE {0}_last_run_timestamp_seconds gauge".format(PREFIX))
+        lines.append("{0}_last_run_timestamp_seconds {1}".format(PREFIX, summary["timestamp"]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, textfile_path: str = "", json_path: str = "") -> None:
+        """Write the Prometheus textfile and/or the JSON summary, each replaced atomically."""
+        if textfile_path:
+            _write_atomically(textfile_path, self.prometheus())
+        if json_path:
+            _write_atomically(json_path, json.dumps(self.summary(), indent=2) + "\n")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomically(path: str, content: str) -> None:
+    # node_exporter must never read a partially written textfile
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        filesystem.replace(tmp_path, path)
+    except OSError as exception:
+        logger.warning("Unable to write the metrics to %s: %s", path, exception)
+
+
+METRICS = Metrics()
@@ -0,0 +1,25 @@
+"""User notifications.
+
+The certbot display pulls acme and requests in: it is only imported when a
+message is shown during a certbot run. The standalone commands, which run
+without the certbot display, print the messages instead.
+
+"""
+from typing import Callable, Optional
+
+_printer: Optional[Callable[[str], None]] = None
+
+
+def use_printer(printer: Optional[Callable[[str], None]]) -> None:
+    """Show the messages with ``printer`` instead of the certbot display (None to restore it)."""
+    global _printer  # pylint: disable=global-statement
+    _printer = printer
+
+
+def notify(message: str) -> None:
+    """Show ``message`` to the user."""
+    if _printer is not None:
+        _printer(message)
+        return
+    from certbot.display import util as display_util  # pylint: disable=import-outside-toplevel
+    display_util.notify(message)
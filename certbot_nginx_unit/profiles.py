@@ -0,0 +1,122 @@
+"""TLS performance profiles of the Nginx Unit ``*:443`` listener.
+
+A profile is a set of OpenSSL configuration commands (``SSL_CONF_cmd``, in
+the case insensitive configuration file form Unit uses) written to
+``tls.conf_commands``: the protocol floor, the cipher order and the
+key exchange groups. AES-GCM is the fastest cipher on the CPUs with AES
+instructions, ChaCha20-Poly1305 on the others.
+
+Before being applied, a profile is checked against the OpenSSL of this host:
+the ciphers and groups it does not know are left out, and a profile without
+any usable cipher is refused. Unit may be linked to another OpenSSL build, so
+this only catches the typos and the ciphers missing everywhere.
+
+"""
+import logging
+import ssl
+from typing import Callable, Dict, List
+
+from certbot import errors
+
+logger = logging.getLogger(__name__)
+
+_TLS13_AES = "TLS_AES_128_GCM_SHA256:TLS_AES_256_GCM_SHA384:TLS_CHACHA20_POLY1305_SHA256"
+_TLS13_CHACHA = "TLS_CHACHA20_POLY1305_SHA256:TLS_AES_128_GCM_SHA256:TLS_AES_256_GCM_SHA384"
+_TLS12_AES = ("ECDHE-ECDSA-AES128-GCM-SHA256:ECDHE-RSA-AES128-GCM-SHA256:ECDHE-ECDSA-AES256-GCM-SHA384:"
+              "ECDHE-RSA-AES256-GCM-SHA384:ECDHE-ECDSA-CHACHA20-POLY1305:ECDHE-RSA-CHACHA20-POLY1305")
+_TLS12_CHACHA = ("ECDHE-ECDSA-CHACHA20-POLY1305:ECDHE-RSA-CHACHA20-POLY1305:ECDHE-ECDSA-AES128-GCM-SHA256:"
+                 "ECDHE-RSA-AES128-GCM-SHA256:ECDHE-ECDSA-AES256-GCM-SHA384:ECDHE-RSA-AES256-GCM-SHA384")
+_GROUPS = "X25519:prime256v1:secp384r1"
+
+# the "auto" profile is "aes" or "chacha20" depending on the CPU of this host
+PROFILES: Dict[str, Dict[str, str]] = {
+    "aes": {
+        "minprotocol": "TLSv1.2",
+        "cipherstring": _TLS12_AES,
+        "ciphersuites": _TLS13_AES,
+        "groups": _GROUPS,
+        "options": "ServerPreference",
+    },
+    "chacha20": {
+        "minprotocol": "TLSv1.2",
+        "cipherstring": _TLS12_CHACHA,
+        "ciphersuites": _TLS13_CHACHA,
+        "groups": _GROUPS,
+        "options": "ServerPreference,PrioritizeChaCha",
+    },
+    "tls13": {
+        "minprotocol": "TLSv1.3",
+        "ciphersuites": _TLS13_AES,
+        "groups": _GROUPS,
+    },
+    "compatible": {
+        "minprotocol": "TLSv1.2",
+        "cipherstring": _TLS12_AES + ":ECDHE-RSA-AES128-SHA:ECDHE-RSA-AES256-SHA:AES128-GCM-SHA256:AES128-SHA",
+        "ciphersuites": _TLS13_AES,
+        "groups": _GROUPS,
+    },
+}
+
+
+def has_aes_instructions(cpuinfo_path: str = "/proc/cpuinfo") -> bool:
+    """Whether the CPU of this host has AES instructions (aes flag on x86 and ARM), True when unknown."""
+    try:
+        with open(cpuinfo_path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name.strip().lower() in ("flags", "features"):
+                    return "aes" in value.split()
+    except OSError:
+        pass
+    return True
+
+
+def _supported_ciphers() -> List[str]:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.set_ciphers("ALL")
+    return [cipher["name"] for cipher in context.get_ciphers()]
+
+
+def _supported_group(group: str) -> bool:
+    try:
+        ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER).set_ecdh_curve(group)
+    except (ValueError, ssl.SSLError):
+        return False
+    return True
+
+
+def _filter(value: str, supported: Callable[[str], bool], kind: str, profile: str) -> str:
+    items = value.split(":")
+    kept = [item for item in items if supported(item)]
+    for item in items:
+        if item not in kept:
+            logger.warning("Leaving out the %s %s of the TLS profile %s, unknown to %s", kind, item, profile,
+                           ssl.OPENSSL_VERSION)
+    if not kept:
+        raise errors.PluginError("None of the {0}s of the TLS profile {1} is supported by {2}".format(
+            kind, profile, ssl.OPENSSL_VERSION))
+    return ":".join(kept)
+
+
+def profile_commands(name: str, cpuinfo_path: str = "/proc/cpuinfo") -> Dict[str, str]:
+    """``tls.conf_commands`` of the profile ``name``, checked against the local OpenSSL.
+
+    :raises .PluginError: when the profile is unknown or not supported at all
+
+    """
+    if name == "auto":
+        name = "aes" if has_aes_instructions(cpuinfo_path) else "chacha20"
+    if name not in PROFILES:
+        raise errors.PluginError("Unknown TLS profile {0}, known ones: auto, {1}".format(
+            name, ", ".join(sorted(PROFILES))))
+    commands = dict(PROFILES[name])
+    if commands.get("minprotocol") == "TLSv1.3" and not ssl.HAS_TLSv1_3:
+        raise errors.PluginError("The TLS profile {0} needs TLS 1.3, not supported by {1}".format(
+            name, ssl.OPENSSL_VERSION))
+    ciphers = set(_supported_ciphers())
+    for command in ("cipherstring", "ciphersuites"):
+        if command in commands:
+            commands[command] = _filter(commands[command], ciphers.__contains__, "cipher", name)
+    if "groups" in commands:
+        commands["groups"] = _filter(commands["groups"], _supported_group, "group", name)
+    return commands
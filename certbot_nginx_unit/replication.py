@@ -0,0 +1,227 @@
+"""Replication of the http-01 challenge files to the other nodes of a cluster.
+
+Behind a load balancer the validation request of the CA may reach any node:
+every challenge file is published to the webroot of each node before the
+validation is asked for, and read back to confirm it is there. A target is a
+local directory (the webroot of a node mounted on this host) or a remote
+webroot reached through a transport registered in :data:`TRANSPORTS`, like
+``ssh://[user@]host[:port]/path``.
+
+"""
+import abc
+import io
+import logging
+import shlex
+import subprocess
+import tarfile
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Sequence
+
+from acme import challenges
+from certbot import errors
+from certbot.compat import filesystem
+from certbot.compat import os
+
+logger = logging.getLogger(__name__)
+
+SSH_TIMEOUT = 30.0
+
+
+class ChallengeTarget(abc.ABC):
+    """Webroot of one node, receiving the challenge files under ``.well-known/acme-challenge``."""
+
+    def __init__(self, label: str):
+        self.label = label
+
+    @abc.abstractmethod
+    def publish(self, files: Dict[str, bytes]) -> None:
+        """Write the challenge ``files`` (content by token), PluginError on failure."""
+
+    @abc.abstractmethod
+    def missing(self, files: Dict[str, bytes]) -> List[str]:
+        """Tokens of ``files`` not found with their content."""
+
+    @abc.abstractmethod
+    def remove(self, tokens: Sequence[str]) -> None:
+        """Remove the challenge files of ``tokens``, PluginError on failure."""
+
+
+class DirectoryTarget(ChallengeTarget):
+    """Webroot mounted on this host, for example over NFS."""
+
+    def __init__(self, webroot: str):
+        super().__init__(webroot)
+        self.directory = os.path.join(webroot, os.path.normcase(challenges.HTTP01.URI_ROOT_PATH))
+
+    def publish(self, files: Dict[str, bytes]) -> None:
+        try:
+            if not os.path.isdir(self.directory):
+                filesystem.makedirs(self.directory, 0o755)
+            for token, content in files.items():
+                # the file appears complete: a validation may read it as soon as it exists
+                temporary_path = os.path.join(self.directory, "." + token + ".tmp")
+                with open(temporary_path, "wb") as f:
+                    f.write(content)
+                filesystem.chmod(temporary_path, 0o644)
+                filesystem.replace(temporary_path, os.path.join(self.directory, token))
+        except OSError as exception:
+            raise errors.PluginError("Unable to write the challenge files to {0}: {1}".format(
+                self.directory, exception))
+
+    def missing(self, files: Dict[str, bytes]) -> List[str]:
+        missing = []
+        for token, content in files.items():
+            try:
+                with open(os.path.join(self.directory, token), "rb") as f:
+                    if f.read() == content:
+                        continue
+            except OSError:
+                pass
+            missing.append(token)
+        return missing
+
+    def remove(self, tokens: Sequence[str]) -> None:
+        for token in tokens:
+            try:
+                os.remove(os.path.join(self.directory, token))
+            except FileNotFoundError:
+                pass
+            except OSError as exception:
+                raise errors.PluginError("Unable to remove the challenge file {0} from {1}: {2}".format(
+                    token, self.directory, exception))
+
+
+class SshTarget(ChallengeTarget):
+    """Webroot of a node reached with the ssh command, one connection per operation.
+
+    :param str url: ``ssh://[user@]host[:port]/path`` of the webroot
+
+    """
+
+    def __init__(self, url: str):
+        super().__init__(url)
+        parsed = urllib.parse.urlsplit(url)
+        if not parsed.hostname or not parsed.path:
+            raise errors.PluginError("Invalid challenge target {0}, expected ssh://[user@]host[:port]/path".format(url))
+        self.destination = (parsed.username + "@" if parsed.username else "") + parsed.hostname
+        self.port = parsed.port
+        self.directory = parsed.path.rstrip("/") + "/" + challenges.HTTP01.URI_ROOT_PATH
+
+    def _run(self, script: str, stdin: bytes = b"") -> bytes:
+        command = ["ssh", "-o", "BatchMode=yes"]
+        if self.port:
+            command.extend(["-p", str(self.port)])
+        command.extend([self.destination, script])
+        try:
+            process = subprocess.run(command, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     timeout=SSH_TIMEOUT, check=False)
+        except (OSError, subprocess.TimeoutExpired) as exception:
+            raise errors.PluginError("Unable to reach {0}: {1}".format(self.label, exception))
+        if process.returncode != 0:
+            raise errors.PluginError("{0} failed on {1}: {2}".format(
+                script, self.label, process.stderr.decode(errors="replace").strip()))
+        return process.stdout
+
+    def publish(self, files: Dict[str, bytes]) -> None:
+        # a single connection writes every file
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode="w") as tar:
+            for token, content in files.items():
+                info = tarfile.TarInfo(token)
+                info.size = len(content)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(content))
+        directory = shlex.quote(self.directory)
+        self._run("mkdir -p {0} && tar -x -m -o -f - -C {0}".format(directory), archive.getvalue())
+
+    def missing(self, files: Dict[str, bytes]) -> List[str]:
+        # a single connection reads every file back, each one after a "<token> <size>" line
+        script = ("cd {0} 2>/dev/null || exit 0; for token in {1}; do if [ -f \"$token\" ]; then "
+                  "echo \"$token $(wc -c < \"$token\")\"; cat -- \"$token\"; fi; done").format(
+                      shlex.quote(self.directory), " ".join(shlex.quote(token) for token in files))
+        try:
+            found = _read_files(self._run(script))
+        except errors.PluginError:
+            found = {}
+        return [token for token, content in files.items() if found.get(token) != content]
+
+    def remove(self, tokens: Sequence[str]) -> None:
+        if tokens:
+            self._run("cd {0} && rm -f -- {1}".format(
+                shlex.quote(self.directory), " ".join(shlex.quote(token) for token in tokens)))
+
+
+def _read_files(output: bytes) -> Dict[str, bytes]:
+    """Content by token of the files read back by :meth:`SshTarget.missing`."""
+    files = {}
+    position = 0
+    while position < len(output):
+        end = output.find(b"\n", position)
+        header = output[position:end].split() if end >= 0 else []
+        if len(header) != 2 or not header[1].isdigit():
+            break
+        position = end + 1 + int(header[1])
+        files[header[0].decode(errors="replace")] = output[end + 1:position]
+    return files
+
+
+# transports of the challenge targets by URL scheme, the targets without one are directories
+TRANSPORTS: Dict[str, Callable[[str], ChallengeTarget]] = {
+    "ssh": SshTarget,
+}
+
+
+def parse_targets(value: str) -> List[ChallengeTarget]:
+    """Challenge targets of a comma separated list of webroots and URLs."""
+    targets = []
+    for item in (item.strip() for item in value.split(",")):
+        if not item:
+            continue
+        scheme = urllib.parse.urlsplit(item).scheme
+        if scheme in TRANSPORTS:
+            targets.append(TRANSPORTS[scheme](item))
+        elif "://" in item:
+            raise errors.PluginError("Unknown challenge target transport {0}://, known ones: {1}".format(
+                scheme, ", ".join(sorted(TRANSPORTS))))
+        else:
+            targets.append(DirectoryTarget(item))
+    return targets
+
+
+def _on_every_target(targets: Sequence[ChallengeTarget],
+                     operation: Callable[[ChallengeTarget], None]) -> Dict[str, str]:
+    """Run ``operation`` on all the targets at once, return the errors by target label."""
+    failures: Dict[str, str] = {}
+    if not targets:
+        return failures
+    with ThreadPoolExecutor(len(targets)) as executor:
+        futures = [(target, executor.submit(operation, target)) for target in targets]
+        for target, future in futures:
+            try:
+                future.result()
+            except errors.Error as exception:
+                failures[target.label] = str(exception)
+    return failures
+
+
+def publish_everywhere(targets: Sequence[ChallengeTarget], files: Dict[str, bytes]) -> None:
+    """Publish ``files`` to every target and confirm they are there, PluginError listing the failed targets."""
+    def publish(target: ChallengeTarget) -> None:
+        target.publish(files)
+        missing = target.missing(files)
+        if missing:
+            raise errors.PluginError("challenge files {0} not found after being written".format(", ".join(missing)))
+
+    failures = _on_every_target(targets, publish)
+    if failures:
+        raise errors.PluginError("Challenge files not published on {0} of {1} nodes: {2}".format(
+            len(failures), len(targets),
+            "; ".join("{0}: {1}".format(label, error) for label, error in failures.items())))
+
+
+def remove_everywhere(targets: Sequence[ChallengeTarget], tokens: Sequence[str]) -> None:
+    """Remove the challenge files of ``tokens`` from every target, the failures are only logged."""
+    failures = _on_every_target(targets, lambda target: target.remove(tokens))
+    for label, error in failures.items():
+        logger.warning("Unable to remove the challenge files from %s: %s", label, error)
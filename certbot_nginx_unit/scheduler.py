@@ -0,0 +1,133 @@
+"""Pacing of the Nginx Unit reconfigurations.
+
+Every write to ``/config`` makes Unit validate the new configuration and
+reconfigure its router, which briefly delays the requests being served. A mass
+renewal firing deploys back to back would reconfigure Unit many times per
+second: the scheduler caps the configuration writes per time window for all
+the processes sharing its state file, and holds the deploys until an optional
+daily maintenance window opens.
+
+"""
+import datetime
+import json
+import logging
+import re
+import time
+from typing import Callable, List, NamedTuple, Optional
+
+from certbot import errors
+from certbot.compat import filesystem
+from certbot.compat import os
+
+logger = logging.getLogger(__name__)
+
+_WINDOW = re.compile(r"^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$")
+
+
+class MaintenanceWindow(NamedTuple):
+    """Daily local time range, ending the next day when ``end`` is before ``start``."""
+    start: datetime.time
+    end: datetime.time
+
+    @classmethod
+    def parse(cls, value: str) -> "MaintenanceWindow":
+        """Window of a "HH:MM-HH:MM" value, ValueError when it is not one."""
+        match = _WINDOW.match(value)
+        if not match:
+            raise ValueError("Invalid maintenance window {0!r}, expected HH:MM-HH:MM".format(value))
+        hours, minutes, end_hours, end_minutes = (int(group) for group in match.groups())
+        return cls(datetime.time(hours, minutes), datetime.time(end_hours, end_minutes))
+
+    def seconds_until_open(self, now: datetime.datetime) -> float:
+        """Seconds from ``now`` to the next opening of the window, 0 when it is open."""
+        current = now.time()
+        if self.start <= self.end:
+            is_open = self.start <= current < self.end
+        else:
+            is_open = current >= self.start or current < self.end
+        if is_open or self.start == self.end:
+            return 0.0
+        opening = datetime.datetime.combine(now.date(), self.start, now.tzinfo)
+        if opening <= now:
+            opening += datetime.timedelta(days=1)
+        return (opening - now).total_seconds()
+
+
+class ReconfigurationScheduler:
+    """Configuration writes paced across the processes sharing ``state_path``.
+
+    The caller serializes the writes (with the inter-process lock): the times of the
+    recent writes are kept in the state file, with those reserved by a waiting process.
+
+    :param str state_path: JSON file of the recent write times
+    :param int max_writes: maximum configuration writes per ``period``, 0 for no limit
+    :param float period: seconds of the sliding window of ``max_writes``
+    :param maintenance_window: daily window outside which the deploys wait, None for always
+
+    """
+
+    def __init__(self, state_path: str, max_writes: int = 0, period: float = 60.0,
+                 maintenance_window: Optional[MaintenanceWindow] = None,
+                 clock: Callable[[], float] = time.time, sleep: Callable[[float], None] = time.sleep):
+        self.state_path = state_path
+        self.max_writes = max_writes
+        self.period = period
+        self.maintenance_window = maintenance_window
+        self._clock = clock
+        self._sleep = sleep
+
+    @property
+    def limited(self) -> bool:
+        return self.max_writes > 0
+
+    def wait_for_window(self) -> None:
+        """Wait for the maintenance window to open."""
+        if self.maintenance_window is None:
+            return
+        delay = self.maintenance_window.seconds_until_open(datetime.datetime.fromtimestamp(self._clock()))
+        if delay > 0:
+            logger.info("Waiting %.0f seconds for the Nginx Unit maintenance window %s-%s", delay,
+                        self.maintenance_window.start.strftime("%H:%M"),
+                        self.maintenance_window.end.strftime("%H:%M"))
+            self._sleep(delay)
+
+    def throttle(self, count: int) -> None:
+        """Wait until ``count`` configuration writes can be sent back to back, and reserve them."""
+        if not self.limited or count <= 0:
+            return
+        now = self._clock()
+        times = sorted(t for t in self._load() if t > now - self.period)
+        # more writes than the limit are sent once the window is empty
+        allowed = self.max_writes - min(count, self.max_writes)
+        start = now
+        if len(times) > allowed:
+            start = max(now, times[len(times) - allowed - 1] + self.period)
+        self._save(times + [start] * count)
+        if start > now:
+            logger.info("Waiting %.1f seconds before reconfiguring Nginx Unit, %d reconfigurations per "
+                        "%.0f seconds at most", start - now, self.max_writes, self.period)
+            self._sleep(start - now)
+
+    def _load(self) -> List[float]:
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                times = json.load(f)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as exception:
+            logger.warning("Ignoring the unreadable reconfiguration times %s: %s", self.state_path, exception)
+            return []
+        return [t for t in times if isinstance(t, (int, float))] if isinstance(times, list) else []
+
+    def _save(self, times: List[float]) -> None:
+        directory = os.path.dirname(self.state_path)
+        temporary_path = self.state_path + ".tmp"
+        try:
+            if not os.path.isdir(directory):
+                filesystem.makedirs(directory, 0o700)
+            with open(temporary_path, "w", encoding="utf-8") as f:
+                json.dump(times, f)
+            filesystem.replace(temporary_path, self.state_path)
+        except OSError as exception:
+            raise errors.PluginError("Unable to write the reconfiguration times {0}: {1}".format(
+                self.state_path, exception))
@@ -0,0 +1,79 @@
+"""Local check that Nginx Unit serves the http-01 challenge files.
+
+Unit applies a new route asynchronously: asking the CA to validate before the
+``*:80`` listener serves the tokens wastes the CA retries and the failed
+validation rate limit. Every token is fetched concurrently through the
+listener until it is served or the timeout expires.
+
+The listener is reached at its own address, or for a wildcard listener at the
+host of a TCP control address, the local host otherwise.
+
+"""
+import asyncio
+import http.client
+import logging
+from typing import List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SELF_CHECK_ADDRESS = "127.0.0.1"
+SELF_CHECK_PORT = 80
+
+
+def listener_address(listener: str, control: Optional[str] = None) -> Tuple[str, int]:
+    """Address and port the ``listener`` ("*:80") of the Unit reached at ``control`` is fetched at."""
+    host, _, port = listener.rpartition(":")
+    if host == "*":
+        host = SELF_CHECK_ADDRESS
+        if control and not control.startswith(("/", "unix:")):
+            control = control[len("http://"):] if control.startswith("http://") else control
+            host = control.rstrip("/").rsplit(":", 1)[0]
+    return host.strip("[]"), int(port)
+
+
+class ServedFile(NamedTuple):
+    """Content expected at ``path`` for the virtual host ``domain``."""
+    domain: str
+    path: str
+    content: bytes
+
+
+def fetch(served_file: ServedFile, address: str = SELF_CHECK_ADDRESS, port: int = SELF_CHECK_PORT,
+          timeout: float = 5.0) -> bool:
+    """Whether the listener at ``address``:``port`` serves ``served_file`` right now."""
+    connection = http.client.HTTPConnection(address, port, timeout=timeout)
+    try:
+        connection.request("GET", served_file.path, headers={"Host": served_file.domain})
+        response = connection.getresponse()
+        return response.status == 200 and response.read().strip() == served_file.content
+    except (OSError, http.client.HTTPException) as exception:
+        logger.debug("Self check of %s%s failed: %s", served_file.domain, served_file.path, exception)
+        return False
+    finally:
+        connection.close()
+
+
+async def _wait_served(served_file: ServedFile, address: str, port: int, deadline: float, interval: float) -> bool:
+    loop = asyncio.get_running_loop()
+    while True:
+        if await loop.run_in_executor(None, fetch, served_file, address, port):
+            return True
+        if loop.time() + interval > deadline:
+            return False
+        await asyncio.sleep(interval)
+
+
+async def _wait_all_served(served_files: List[ServedFile], address: str, port: int, timeout: float,
+                           interval: float) -> List[bool]:
+    deadline = asyncio.get_running_loop().time() + timeout
+    return await asyncio.gather(*(_wait_served(served_file, address, port, deadline, interval)
+                                  for served_file in served_files))
+
+
+def wait_until_served(served_files: List[ServedFile], timeout: float, address: str = SELF_CHECK_ADDRESS,
+                      port: int = SELF_CHECK_PORT, interval: float = 0.5) -> List[ServedFile]:
+    """Poll every file concurrently for at most ``timeout`` seconds and return the ones not served."""
+    if not served_files:
+        return []
+    results = asyncio.run(_wait_all_served(served_files, address, port, timeout, interval))
+    return [served_file for served_file, served in zip(served_files, results) if not served]
@@ -0,0 +1,107 @@
+"""TLS session resumption settings of the Nginx Unit ``*:443`` listener.
+
+A resumed session skips the key exchange and the certificate signature of a
+full handshake. Unit resumes sessions from its per-process session cache
+(``tls.session.cache_size`` and ``timeout``) and from session tickets
+encrypted with ``tls.session.tickets`` keys: the last key encrypts the new
+tickets, all of them decrypt the tickets already handed out.
+
+The ticket keys are rotated once they are older than the rotation period and
+the previous keys are kept, so that the tickets issued before a rotation are
+still resumed. The key ring is a JSON file: Unit instances given the same
+file, on shared storage, resume each other's tickets.
+
+"""
+import base64
+import json
+import logging
+import secrets
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from certbot import errors
+from certbot.compat import filesystem
+from certbot.compat import os
+
+logger = logging.getLogger(__name__)
+
+# AES-256 ticket keys, the larger of the two sizes accepted by Unit
+TICKET_KEY_SIZE = 80
+# the previous keys still decrypting the tickets issued before the rotations, then the current one
+TICKET_KEYS_KEPT = 3
+
+
+class SessionSettings(NamedTuple):
+    """Managed ``tls.session`` options, None for those left as configured.
+
+    :param cache_size: number of sessions cached per Unit router process
+    :param timeout: seconds a cached session or a ticket stays valid
+    :param ticket_keys_path: key ring of the session ticket keys, empty to leave the tickets alone
+    :param rotation: seconds between two rotations of the ticket key
+
+    """
+    cache_size: Optional[int] = None
+    timeout: Optional[int] = None
+    ticket_keys_path: str = ""
+    rotation: float = 12 * 3600.0
+
+    @property
+    def managed(self) -> bool:
+        return self.cache_size is not None or self.timeout is not None or bool(self.ticket_keys_path)
+
+
+class TicketKeyRing:
+    """Session ticket keys kept in the JSON file ``path``, oldest first as Unit expects them."""
+
+    def __init__(self, path: str, clock: Callable[[], float] = time.time):
+        self.path = path
+        self._clock = clock
+
+    def _load(self) -> List[Dict[str, Any]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                keys = json.load(f).get("keys", [])
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError, AttributeError) as exception:
+            logger.warning("Ignoring the unreadable session ticket keys %s: %s", self.path, exception)
+            return []
+        return [key for key in keys if isinstance(key, dict) and isinstance(key.get("key"), str)]
+
+    def _save(self, keys: List[Dict[str, Any]]) -> None:
+        directory = os.path.dirname(self.path)
+        temporary_path = self.path + ".tmp"
+        try:
+            if not os.path.isdir(directory):
+                filesystem.makedirs(directory, 0o700)
+            # the keys decrypt every ticket: readable by root only, from the creation of the file
+            fd = filesystem.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"keys": keys}, f)
+            filesystem.replace(temporary_path, self.path)
+        except OSError as exception:
+            raise errors.PluginError("Unable to write the session ticket keys {0}: {1}".format(
+                self.path, exception))
+
+    def keys(self, rotation: float) -> List[str]:
+        """Current keys (base64), after a rotation when the newest one is older than ``rotation`` seconds."""
+        keys = self._load()
+        now = self._clock()
+        if not keys or now - keys[-1].get("created", 0) >= rotation:
+            logger.info("Rotating the session ticket keys %s", self.path)
+            new_key = base64.b64encode(secrets.token_bytes(TICKET_KEY_SIZE)).decode()
+            keys = keys[len(keys) - TICKET_KEYS_KEPT + 1:] + [{"key": new_key, "created": now}]
+            self._save(keys)
+        return [key["key"] for key in keys]
+
+
+def session_options(settings: SessionSettings) -> Dict[str, Any]:
+    """``tls.session`` options of ``settings``, with the ticket keys rotated when due."""
+    options: Dict[str, Any] = {}
+    if settings.cache_size is not None:
+        options["cache_size"] = settings.cache_size
+    if settings.timeout is not None:
+        options["timeout"] = settings.timeout
+    if settings.ticket_keys_path:
+        options["tickets"] = TicketKeyRing(settings.ticket_keys_path).keys(settings.rotation)
+    return options
@@ -0,0 +1,237 @@
+"""Benchmarks of the plugin operations against the fake Unit control API.
+
+Each scenario runs the configurator on a Unit serving ``listeners`` TLS
+listeners, ``routes`` route steps and ``bundles`` certificate bundles, and
+measures the wall time, the number of requests and writes, the
+reconfigurations and the bytes transferred::
+
+    python -m certbot_nginx_unit.tests.benchmark --domains 50 --bundles 1000 --latency 0.002
+    python -m certbot_nginx_unit.tests.benchmark --json bench.json
+    python -m certbot_nginx_unit.tests.benchmark --baseline bench.json
+
+With ``--baseline`` the run fails when a scenario makes more requests, writes
+or reconfigurations than the baseline, or when its time or its transferred
+bytes exceed those of the baseline multiplied by ``--tolerance``.
+
+"""
+import argparse
+import copy
+import datetime
+import json
+import logging
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import josepy as jose
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import NameOID
+from unittest import mock
+
+from acme import challenges
+from acme import messages
+from certbot import achallenges
+from certbot import configuration
+from certbot._internal import constants
+from certbot.compat import filesystem
+from certbot.compat import os
+from certbot.tests import acme_util
+from certbot_nginx_unit.configurator import Configurator
+from certbot_nginx_unit.tests.fake_unit import FakeUnit, generated_configuration
+from certbot_nginx_unit.unitc import UnitControl
+
+COUNTERS = ("requests", "writes", "reconfigurations")
+# the size of the generated keys and signatures varies slightly between runs
+VOLUMES = ("bytes_sent", "bytes_received")
+
+
+def write_certificate(directory: str, domain: str, key_type: str = "ecdsa", name: str = "") -> str:
+    """Write a fresh self-signed key and certificate for ``domain`` and return its path.
+
+    :param str key_type: "ecdsa" or "rsa"
+    :param str name: file name without the extension, ``domain`` by default
+
+    """
+    key: Any = ec.generate_private_key(ec.SECP256R1())
+    if key_type == "rsa":
+        key = rsa.generate_private_key(65537, 2048)
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domain)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder().subject_name(subject).issuer_name(subject).public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=90))
+                   .add_extension(x509.SubjectAlternativeName([x509.DNSName(domain)]), critical=False)
+                   .sign(key, hashes.SHA256()))
+    path = os.path.join(directory, (name or domain) + ".pem")
+    with open(path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    return path
+
+
+class Benchmark:
+    """Configurators of consecutive certbot runs talking to one fake Unit."""
+
+    def __init__(self, fake_unit: FakeUnit, directory: str):
+        self.fake_unit = fake_unit
+        self.directory = directory
+        self.webroot = os.path.join(directory, "webroot")
+        filesystem.mkdir(self.webroot)
+
+    def configurator(self) -> Configurator:
+        """Configurator of a new certbot run."""
+        config = configuration.NamespaceConfig(mock.MagicMock(**copy.deepcopy(constants.CLI_DEFAULTS)))
+        config.set_argument_sources({})
+        config.namespace.config_dir = os.path.join(self.directory, "config")
+        config.namespace.work_dir = os.path.join(self.directory, "work")
+        config.namespace.logs_dir = os.path.join(self.directory, "logs")
+        config.namespace.nginx_unit_path = self.webroot
+        config.namespace.nginx_unit_control = self.fake_unit.socket_path
+        config.namespace.nginx_unit_unitc = False
+        config.namespace.nginx_unit_lock_file = os.path.join(self.directory, "unit.lock")
+        config.namespace.nginx_unit_self_check_timeout = 0
+        config.namespace.nginx_unit_persistent_acme_route = False
+        config.namespace.nginx_unit_deferred_deploy = False
+        config.namespace.nginx_unit_concurrency = 4
+        config.namespace.nginx_unit_max_reconfigurations = 0
+        config.namespace.nginx_unit_reconfiguration_period = 60.0
+        config.namespace.nginx_unit_maintenance_window = None
+        config.namespace.nginx_unit_challenge_targets = None
+        config.namespace.nginx_unit_session_cache_size = None
+        config.namespace.nginx_unit_session_timeout = None
+        config.namespace.nginx_unit_session_tickets = False
+        config.namespace.nginx_unit_ticket_keys_file = None
+        config.namespace.nginx_unit_ticket_key_rotation = 12.0
+        config.namespace.nginx_unit_tls_profile = None
+        config.namespace.nginx_unit_metrics_textfile = None
+        config.namespace.nginx_unit_metrics_json = None
+        configurator = Configurator(config, name="nginx_unit")
+        configurator.unitc = UnitControl(self.fake_unit.socket_path)
+        return configurator
+
+    def measure(self, name: str, operation: Callable[[], None]) -> Dict[str, Any]:
+        self.fake_unit.reset_counters()
+        start = time.monotonic()
+        operation()
+        seconds = time.monotonic() - start
+        requests = self.fake_unit.requests
+        return {
+            "scenario": name,
+            "seconds": seconds,
+            "requests": len(requests),
+            "writes": len([method for method, _ in requests if method != "GET"]),
+            "reconfigurations": self.fake_unit.reconfigurations,
+            "bytes_sent": self.fake_unit.bytes_received,
+            "bytes_received": self.fake_unit.bytes_sent,
+        }
+
+    def issue(self, domains: List[str]) -> None:
+        """Write new certificates for ``domains``, as a renewal does."""
+        for domain in domains:
+            write_certificate(self.directory, domain)
+
+    def deploy(self, domains: List[str]) -> None:
+        configurator = self.configurator()
+        for domain in domains:
+            path = os.path.join(self.directory, domain + ".pem")
+            configurator.deploy_cert(domain, path, path, path, path)
+        configurator.save()
+        configurator.unitc.close()
+
+    def challenge(self, domains: List[str]) -> None:
+        account_key = jose.JWKEC(key=ec.generate_private_key(ec.SECP256R1()))
+        achalls = [
+            achallenges.KeyAuthorizationAnnotatedChallenge(
+                challb=acme_util.chall_to_challb(challenges.HTTP01(token=os.urandom(16)), messages.STATUS_PENDING),
+                domain=domain, account_key=account_key)
+            for domain in domains
+        ]
+        configurator = self.configurator()
+        configurator.perform(achalls)
+        configurator.cleanup(achalls)
+        configurator.unitc.close()
+
+
+def run_benchmarks(domains: int = 10, listeners: int = 1, routes: int = 10, bundles: int = 10,
+                   latency: float = 0.0) -> List[Dict[str, Any]]:
+    """Run every scenario and return their measures."""
+    unit_configuration, certificates = generated_configuration(listeners, routes, bundles)
+    names = ["new{0}.example.org".format(index) for index in range(domains)]
+    results = []
+    with FakeUnit(unit_configuration, certificates, latency) as fake_unit, mock.patch(
+            "certbot.display.util.notify"):
+        benchmark = Benchmark(fake_unit, tempfile.mkdtemp())
+        benchmark.issue(names)
+        results.append(benchmark.measure("deploy", lambda: benchmark.deploy(names)))
+        benchmark.issue(names)
+        results.append(benchmark.measure("renew", lambda: benchmark.deploy(names)))
+        results.append(benchmark.measure("unchanged", lambda: benchmark.deploy(names)))
+        results.append(benchmark.measure("challenge", lambda: benchmark.challenge(names)))
+    return results
+
+
+def regressions(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    """Measures of ``results`` worse than those of the same scenario in ``baseline``."""
+    found = []
+    baseline_by_scenario = {result["scenario"]: result for result in baseline}
+    for result in results:
+        reference = baseline_by_scenario.get(result["scenario"])
+        if reference is None:
+            continue
+        for counter in COUNTERS:
+            if result[counter] > reference[counter]:
+                found.append("{0}: {1} {2} > {3}".format(result["scenario"], counter, result[counter],
+                                                         reference[counter]))
+        for volume in VOLUMES:
+            if result[volume] > reference[volume] * tolerance:
+                found.append("{0}: {1} {2} > {3} x {4}".format(result["scenario"], volume, result[volume],
+                                                               reference[volume], tolerance))
+        if result["seconds"] > reference["seconds"] * tolerance:
+            found.append("{0}: {1:.3f}s > {2:.3f}s x {3}".format(result["scenario"], result["seconds"],
+                                                                 reference["seconds"], tolerance))
+    return found
+
+
+def _print_table(results: List[Dict[str, Any]]) -> None:
+    print("{0:<12} {1:>9} {2:>9} {3:>7} {4:>9} {5:>11} {6:>11}".format(
+        "scenario", "seconds", "requests", "writes", "reconfig", "bytes sent", "bytes recv"))
+    for result in results:
+        print("{scenario:<12} {seconds:>9.3f} {requests:>9} {writes:>7} {reconfigurations:>9} "
+              "{bytes_sent:>11} {bytes_received:>11}".format(**result))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the plugin against a fake Nginx Unit control API.")
+    parser.add_argument("--domains", type=int, default=10, help="Domains deployed and validated per run")
+    parser.add_argument("--listeners", type=int, default=1, help="TLS listeners of the Unit configuration")
+    parser.add_argument("--routes", type=int, default=10, help="Route steps of the Unit configuration")
+    parser.add_argument("--bundles", type=int, default=10, help="Certificate bundles already in Unit")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every control API request")
+    parser.add_argument("--json", default="", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default="", help="Fail on regressions against this JSON results file")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="Factor over the baseline time and bytes considered a regression (default: 1.5)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+
+    results = run_benchmarks(args.domains, args.listeners, args.routes, args.bundles, args.latency)
+    _print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print("regression: " + regression)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+"""Test for certbot_nginx_unit.tests.benchmark: the write counts are part of the contract."""
+import unittest
+
+from certbot_nginx_unit.tests.benchmark import regressions, run_benchmarks
+
+
+class BenchmarkTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.tests.benchmark.run_benchmarks"""
+
+    def test_reconfigurations(self):
+        results = {result["scenario"]: result for result in run_benchmarks(
+            domains=3, listeners=2, routes=5, bundles=6)}
+
+        # one upload per domain and a single listeners update
+        assert results["deploy"]["writes"] == 4
+        assert results["deploy"]["reconfigurations"] == 1
+        # the replaced bundles are deleted after the listeners update
+        assert results["renew"]["writes"] == 7
+        assert results["renew"]["reconfigurations"] == 1
+        assert results["unchanged"]["writes"] == 0
+        # the acme route is added then removed
+        assert results["challenge"]["reconfigurations"] == 2
+
+    def test_regressions(self):
+        baseline = [{"scenario": "deploy", "seconds": 1.0, "requests": 4, "writes": 4, "reconfigurations": 1,
+                     "bytes_sent": 1000, "bytes_received": 1000}]
+        result = dict(baseline[0], seconds=1.2, reconfigurations=2, bytes_sent=1100)
+
+        assert regressions([result], baseline, 1.5) == ["deploy: reconfigurations 2 > 1"]
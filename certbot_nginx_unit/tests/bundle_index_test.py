@@ -0,0 +1,97 @@
+"""Test for certbot_nginx_unit.bundle_index."""
+import tempfile
+import unittest
+
+from certbot.compat import os
+from certbot.tests import util as test_util
+from certbot_nginx_unit.bundle_index import BundleIndex, parse_certificate, unit_key_type
+
+
+class BundleIndexTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.bundle_index.BundleIndex"""
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "nginx-unit", "bundles.json")
+
+    def test_rebuild_from_unit_certificates(self):
+        bundle_index = BundleIndex(self.path)
+        assert not bundle_index.load()
+        bundle_index.rebuild({
+            "www.example.com_20240202145800": {
+                "key": "RSA (2048 bits)",
+                "chain": [{
+                    "subject": {"common_name": "www.example.com", "alt_names": ["www.example.com", "example.com"]},
+                    "validity": {"since": "Feb  2 13:58:00 2024 GMT", "until": "May  2 13:57:59 2024 GMT"},
+                }],
+            },
+        })
+        bundle_index.save()
+
+        bundle_index = BundleIndex(self.path)
+        assert bundle_index.load()
+        assert bundle_index.by_common_name("www.example.com") == ["www.example.com_20240202145800"]
+        assert bundle_index.by_name("example.com") == ["www.example.com_20240202145800"]
+        assert bundle_index.by_common_name("example.com") == []
+        assert bundle_index.not_after("www.example.com_20240202145800").isoformat() == "2024-05-02T13:57:59+00:00"
+        assert bundle_index.key_type("www.example.com_20240202145800") == "RSA"
+
+        bundle_index.remove("www.example.com_20240202145800")
+        assert bundle_index.by_name("example.com") == []
+
+    def test_by_certificate(self):
+        bundle_index = BundleIndex(self.path)
+        bundle_index.rebuild({
+            "www.example.com_20240202145800": {
+                "key": "ECDH (prime256v1)",
+                "chain": [{
+                    "subject": {"common_name": "www.example.com", "alt_names": ["www.example.com", "example.com"]},
+                    "validity": {"since": "Feb  2 13:58:00 2024 GMT", "until": "May  2 13:57:59 2024 GMT"},
+                }],
+            },
+        })
+        entry = {"common_name": "www.example.com", "alt_names": ["example.com", "www.example.com"],
+                 "not_before": "2024-02-02T13:58:00+00:00", "not_after": "2024-05-02T13:57:59+00:00",
+                 "key_type": "EC", "fingerprint": "sha256:aa"}
+        assert bundle_index.by_certificate(entry) == ["www.example.com_20240202145800"]
+        # a renewal of the same names
+        assert bundle_index.by_certificate(dict(entry, not_before="2024-03-02T13:58:00+00:00")) == []
+        assert bundle_index.by_certificate(dict(entry, key_type="RSA")) == []
+
+        # the bundles with a fingerprint are matched by it
+        bundle_index.add("www.example.com_20240202145800", entry)
+        assert bundle_index.by_certificate(entry) == []
+        assert bundle_index.by_fingerprint("sha256:aa") == ["www.example.com_20240202145800"]
+
+    def test_save_merges_the_changes_of_other_processes(self):
+        bundle_index = BundleIndex(self.path)
+        bundle_index.add("a.example.com_1", {"common_name": "a.example.com"})
+        bundle_index.add("b.example.com_1", {"common_name": "b.example.com"})
+        bundle_index.save()
+
+        first, second = BundleIndex(self.path), BundleIndex(self.path)
+        assert first.load() and second.load()
+        first.add("a.example.com_2", {"common_name": "a.example.com"})
+        first.remove("a.example.com_1")
+        second.add("c.example.com_1", {"common_name": "c.example.com"})
+        first.save()
+        second.save()
+
+        assert sorted(second.bundles) == ["a.example.com_2", "b.example.com_1", "c.example.com_1"]
+        assert second.by_common_name("a.example.com") == ["a.example.com_2"]
+        bundle_index = BundleIndex(self.path)
+        assert bundle_index.load()
+        assert sorted(bundle_index.bundles) == ["a.example.com_2", "b.example.com_1", "c.example.com_1"]
+
+    def test_parse_certificate(self):
+        with open(test_util.vector_path("cert-san_512.pem"), "rb") as f:
+            entry = parse_certificate(f.read())
+        assert entry["common_name"] == "example.com"
+        assert entry["alt_names"] == ["example.com", "www.example.com"]
+        assert entry["not_before"] < entry["not_after"]
+        assert entry["key_type"] == "RSA"
+
+    def test_unit_key_type(self):
+        assert unit_key_type("RSA (2048 bits)") == "RSA"
+        assert unit_key_type("ECDH (prime256v1)") == "EC"
+        assert unit_key_type("EC (256 bits)") == "EC"
+        assert unit_key_type(None) is None
@@ -0,0 +1,261 @@
+"""Test for certbot_nginx_unit.cli."""
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from certbot.compat import filesystem
+from certbot.compat import os
+from certbot_nginx_unit.cli import deploy_main, gc_main, session_main
+from certbot_nginx_unit.deployer import Deployer
+from certbot_nginx_unit.journal import DEFERRED, RUNNING, load_journals
+from certbot_nginx_unit.notify import use_printer
+from certbot_nginx_unit.tests.benchmark import write_certificate
+from certbot_nginx_unit.tests.fake_unit import FakeUnit, generated_configuration
+from certbot_nginx_unit.unitc import UnitControl
+
+
+class DeployMainTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.cli.deploy_main"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.lineages = []
+        for name in ("www.example.org", "api.example.org"):
+            lineage = os.path.join(self.tempdir, "live", name)
+            filesystem.makedirs(lineage)
+            path = write_certificate(self.tempdir, name)
+            shutil.copy(path, os.path.join(lineage, "privkey.pem"))
+            shutil.copy(path, os.path.join(lineage, "fullchain.pem"))
+            self.lineages.append(lineage)
+
+    def tearDown(self):
+        use_printer(None)
+
+    def test_deploy_lineages(self):
+        configuration, certificates = generated_configuration(listeners=1, routes=1, bundles=1)
+        with FakeUnit(configuration, certificates) as fake_unit:
+            argv = ["--control", fake_unit.socket_path, "--work-dir", os.path.join(self.tempdir, "work"),
+                    "--lock-file", os.path.join(self.tempdir, "unit.lock")]
+            assert deploy_main(argv + self.lineages) == 0
+
+            bundle_names = fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"]
+            assert [name.split("_")[0] for name in bundle_names] == [
+                "site0.example.org", "www.example.org", "api.example.org"]
+            assert fake_unit.reconfigurations == 1
+
+            # the certificates are already served: nothing to write
+            fake_unit.reset_counters()
+            assert deploy_main(argv + self.lineages) == 0
+            assert [method for method, _ in fake_unit.requests] == ["GET"]
+
+    def test_reconcile_after_unit_state_loss(self):
+        configuration, certificates = generated_configuration(listeners=1, routes=1, bundles=1)
+        with FakeUnit(configuration, certificates) as fake_unit:
+            argv = ["--control", fake_unit.socket_path, "--work-dir", os.path.join(self.tempdir, "work"),
+                    "--lock-file", os.path.join(self.tempdir, "unit.lock")]
+            assert deploy_main(argv + self.lineages) == 0
+            www_bundle, api_bundle = fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"][1:]
+
+            # Unit lost its listener certificates and one of the bundles
+            fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"] = ["site0.example.org_20240101000000"]
+            del fake_unit.certificates[api_bundle]
+            fake_unit.reset_counters()
+            assert deploy_main(argv + ["--reconcile", "--config-dir", self.tempdir]) == 0
+
+            # the lineages are reconciled in name order
+            site_bundle, new_api_bundle, restored_bundle = fake_unit.configuration["listeners"]["*:443"]["tls"][
+                "certificate"]
+            assert (site_bundle, restored_bundle) == ("site0.example.org_20240101000000", www_bundle)
+            assert new_api_bundle.startswith("api.example.org_") and new_api_bundle != api_bundle
+            assert fake_unit.reconfigurations == 1
+            assert [request for request in fake_unit.requests if request[0] == "PUT"] == [
+                ("PUT", "/certificates/" + new_api_bundle), ("PUT", "/config/listeners/*:443/tls/certificate")]
+            # the bundles are checked with a single read of /certificates
+            assert [path for method, path in fake_unit.requests if path.startswith("/certificates/")
+                    and method == "GET"] == []
+
+            fake_unit.reset_counters()
+            assert deploy_main(argv + ["--reconcile", "--config-dir", self.tempdir]) == 0
+            assert [method for method, _ in fake_unit.requests] == ["GET", "GET"]
+
+    def test_reconcile_after_bundle_index_loss(self):
+        configuration, certificates = generated_configuration(listeners=1, routes=1, bundles=1)
+        with FakeUnit(configuration, certificates) as fake_unit:
+            work_dir = os.path.join(self.tempdir, "work")
+            argv = ["--control", fake_unit.socket_path, "--work-dir", work_dir,
+                    "--lock-file", os.path.join(self.tempdir, "unit.lock")]
+            assert deploy_main(argv + self.lineages) == 0
+            bundle_names = fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"]
+
+            # the bundle index is rebuilt from /certificates, without the fingerprints of the bundles
+            os.remove(os.path.join(work_dir, "nginx-unit", "bundles.json"))
+            fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"] = bundle_names[:1]
+            fake_unit.reset_counters()
+            assert deploy_main(argv + ["--reconcile", "--config-dir", self.tempdir]) == 0
+
+            # the bundles still in Unit are recognized by their certificate and put back
+            assert sorted(fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"]) == sorted(bundle_names)
+            assert [request for request in fake_unit.requests if request[0] != "GET"] == [
+                ("PUT", "/config/listeners/*:443/tls/certificate")]
+
+    def test_deploy_to_several_instances(self):
+        configuration, certificates = generated_configuration(listeners=1, routes=1, bundles=1)
+        with FakeUnit(configuration, certificates) as first, FakeUnit(configuration, certificates) as second:
+            missing = os.path.join(self.tempdir, "missing.sock")
+            argv = ["--control", ",".join((first.socket_path, second.socket_path, missing)),
+                    "--work-dir", os.path.join(self.tempdir, "work"),
+                    "--lock-file", os.path.join(self.tempdir, "unit.lock")]
+            # the unreachable instance fails the run, after the others are deployed
+            assert deploy_main(argv + self.lineages) == 1
+
+            for fake_unit in (first, second):
+                bundle_names = fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"]
+                assert len(bundle_names) == 3
+                assert fake_unit.reconfigurations == 1
+            assert (first.configuration["listeners"]["*:443"]["tls"]["certificate"]
+                    == second.configuration["listeners"]["*:443"]["tls"]["certificate"])
+            # one bundle index per deployed instance
+            index_names = sorted(name for name in os.listdir(os.path.join(self.tempdir, "work", "nginx-unit"))
+                                 if name.endswith(".json"))
+            assert len(index_names) == 2 and index_names[0].endswith("control_unit_sock.json")
+
+    def test_deploy_one_bundle_per_key_type(self):
+        configuration, certificates = generated_configuration(listeners=1, routes=1, bundles=1)
+        lineages = []
+        for name, key_type in (("www.example.org", "rsa"), ("www.example.org-ecdsa", "ecdsa")):
+            lineage = os.path.join(self.tempdir, "live", name)
+            if not os.path.isdir(lineage):
+                filesystem.makedirs(lineage)
+            path = write_certificate(self.tempdir, "www.example.org", key_type, name)
+            shutil.copy(path, os.path.join(lineage, "privkey.pem"))
+            shutil.copy(path, os.path.join(lineage, "fullchain.pem"))
+            lineages.append(lineage)
+        with FakeUnit(configuration, certificates) as fake_unit:
+            argv = ["--control", fake_unit.socket_path, "--work-dir", os.path.join(self.tempdir, "work"),
+                    "--lock-file", os.path.join(self.tempdir, "unit.lock")]
+            assert deploy_main(argv + lineages) == 0
+            rsa_bundle, ecdsa_bundle = fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"][1:]
+            assert fake_unit.certificates[rsa_bundle]["key"].startswith("RSA")
+            assert fake_unit.certificates[ecdsa_bundle]["key"].startswith("ECDH")
+
+            # the renewed ECDSA certificate only replaces the ECDSA bundle
+            path = write_certificate(self.tempdir, "www.example.org", "ecdsa", "www.example.org-ecdsa")
+            shutil.copy(path, os.path.join(lineages[1], "privkey.pem"))
+            shutil.copy(path, os.path.join(lineages[1], "fullchain.pem"))
+            assert deploy_main(argv + lineages[1:]) == 0
+            bundle_names = fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"]
+            assert bundle_names[:2] == ["site0.example.org_20240101000000", rsa_bundle]
+            assert bundle_names[2] != ecdsa_bundle
+            assert ecdsa_bundle not in fake_unit.certificates
+
+    def test_apply_deferred_deploys(self):
+        configuration, certificates = generated_configuration(listeners=1, routes=1, bundles=1)
+        with FakeUnit(configuration, certificates) as fake_unit:
+            argv = ["--control", fake_unit.socket_path, "--work-dir", os.path.join(self.tempdir, "work"),
+                    "--lock-file", os.path.join(self.tempdir, "unit.lock"), "--apply-deferred"]
+            # nothing deferred yet
+            assert deploy_main(argv) == 0
+
+            # the renewals of two lineages with --nginx-unit-deferred-deploy
+            for domain in ("www.example.org", "api.example.org"):
+                deployer = Deployer(UnitControl(fake_unit.socket_path), os.path.join(self.tempdir, "work"),
+                                    lock_path=os.path.join(self.tempdir, "unit.lock"))
+                path = write_certificate(self.tempdir, domain)
+                deployer.deploy(domain, path, path)
+                deployer._save_deploys(defer=True)
+                deployer.close()
+            assert fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"] == [
+                "site0.example.org_20240101000000"]
+
+            fake_unit.failures["/config/listeners/*:443/tls/certificate"] = 500
+            assert deploy_main(argv) == 1
+            # left running, for the next deployer to resume it, the deferred runs are applied once it is finished
+            journal_dir = os.path.join(self.tempdir, "work", "nginx-unit", "bundles.journal")
+            assert [journal.status for journal in load_journals(journal_dir)] == [DEFERRED, DEFERRED, RUNNING]
+            # and not applied again meanwhile
+            assert deploy_main(argv) == 0
+            assert len(load_journals(journal_dir)) == 3
+
+    def test_gc_keeps_the_deferred_bundles(self):
+        use_printer(lambda message: None)
+        configuration, certificates = generated_configuration(listeners=1, routes=1, bundles=1)
+        with FakeUnit(configuration, certificates) as fake_unit:
+            argv = ["--control", fake_unit.socket_path, "--work-dir", os.path.join(self.tempdir, "work"),
+                    "--lock-file", os.path.join(self.tempdir, "unit.lock")]
+            for domain in ("www.example.org", "api.example.org"):
+                deployer = Deployer(UnitControl(fake_unit.socket_path), os.path.join(self.tempdir, "work"),
+                                    lock_path=os.path.join(self.tempdir, "unit.lock"))
+                path = write_certificate(self.tempdir, domain)
+                deployer.deploy(domain, path, path)
+                deployer._save_deploys(defer=True)
+                deployer.close()
+            deferred_bundles = set(fake_unit.certificates) - {"site0.example.org_20240101000000"}
+            assert len(deferred_bundles) == 2
+
+            # a timer collecting the bundles between the renewals and their post hook
+            assert gc_main(argv) == 0
+            assert deferred_bundles <= set(fake_unit.certificates)
+
+            assert deploy_main(argv + ["--apply-deferred"]) == 0
+            assert set(fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"][1:]) == deferred_bundles
+
+    def test_deploy_sets_tls_session(self):
+        configuration, certificates = generated_configuration(listeners=1, routes=1, bundles=1)
+        with FakeUnit(configuration, certificates) as fake_unit:
+            argv = ["--control", fake_unit.socket_path, "--work-dir", os.path.join(self.tempdir, "work"),
+                    "--lock-file", os.path.join(self.tempdir, "unit.lock"), "--session-cache-size", "10240",
+                    "--ticket-keys-file", os.path.join(self.tempdir, "ticket-keys.json")]
+            assert deploy_main(argv + self.lineages) == 0
+
+            session = fake_unit.configuration["listeners"]["*:443"]["tls"]["session"]
+            assert session["cache_size"] == 10240
+            assert len(session["tickets"]) == 1
+            # in the same write as the certificates
+            assert fake_unit.reconfigurations == 1
+
+    def test_deploy_applies_tls_profile(self):
+        configuration, certificates = generated_configuration(listeners=1, routes=1, bundles=1)
+        with FakeUnit(configuration, certificates) as fake_unit:
+            argv = ["--control", fake_unit.socket_path, "--work-dir", os.path.join(self.tempdir, "work"),
+                    "--lock-file", os.path.join(self.tempdir, "unit.lock"), "--tls-profile", "chacha20"]
+            assert deploy_main(argv + self.lineages) == 0
+
+            conf_commands = fake_unit.configuration["listeners"]["*:443"]["tls"]["conf_commands"]
+            assert conf_commands["options"] == "ServerPreference,PrioritizeChaCha"
+            assert fake_unit.reconfigurations == 1
+
+    def test_session_keys_are_shared_and_rotated(self):
+        configuration, certificates = generated_configuration(listeners=1, routes=1, bundles=1)
+        with FakeUnit(configuration, certificates) as first, FakeUnit(configuration, certificates) as second:
+            argv = ["--control", first.socket_path + "," + second.socket_path,
+                    "--work-dir", os.path.join(self.tempdir, "work"),
+                    "--lock-file", os.path.join(self.tempdir, "unit.lock"),
+                    "--ticket-keys-file", os.path.join(self.tempdir, "ticket-keys.json")]
+            assert session_main(argv) == 0
+            tickets = first.configuration["listeners"]["*:443"]["tls"]["session"]["tickets"]
+            assert second.configuration["listeners"]["*:443"]["tls"]["session"]["tickets"] == tickets
+
+            # not due: nothing to write
+            first.reset_counters()
+            assert session_main(argv) == 0
+            assert first.reconfigurations == 0
+
+            assert session_main(argv + ["--ticket-key-rotation", "0"]) == 0
+            rotated = first.configuration["listeners"]["*:443"]["tls"]["session"]["tickets"]
+            assert rotated[:-1] == tickets and rotated[-1] not in tickets
+            # the new key is appended to the keys Unit already has
+            assert first.requests[-1] == ("POST", "/config/listeners/*:443/tls/session/tickets")
+
+    def test_does_not_import_certbot_plugins(self):
+        code = ("import sys, certbot_nginx_unit.cli; "
+                "print(' '.join(m for m in ('acme', 'requests', 'certbot.plugins.common') if m in sys.modules))")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, check=True, text=True).stdout
+        assert output.strip() == ""
+
+    def test_does_not_import_cryptography_and_asyncio(self):
+        code = ("import sys, certbot_nginx_unit.cli; "
+                "print(' '.join(m for m in ('cryptography', 'asyncio') if m in sys.modules))")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, check=True, text=True).stdout
+        assert output.strip() == ""
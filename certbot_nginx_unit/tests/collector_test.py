@@ -0,0 +1,61 @@
+"""Test for certbot_nginx_unit.collector."""
+import unittest
+from datetime import datetime, timezone
+
+from certbot_nginx_unit.collector import collect, expiry
+from certbot_nginx_unit.tests.fake_unit import FakeUnit
+from certbot_nginx_unit.unitc import UnitControl
+
+
+def certificate(common_name, until):
+    return {
+        "key": "RSA (2048 bits)",
+        "chain": [{
+            "subject": {"common_name": common_name},
+            "validity": {"since": "Jan  1 00:00:00 2024 GMT", "until": until},
+        }],
+    }
+
+
+class CollectTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.collector.collect"""
+
+    def setUp(self):
+        self.certificates = {
+            "live": certificate("www.example.com", "Dec 31 00:00:00 2099 GMT"),
+            "expired": certificate("www.example.com", "Feb  1 00:00:00 2024 GMT"),
+            "expired_alone": certificate("api.example.com", "Feb  1 00:00:00 2024 GMT"),
+            "orphan": certificate("old.example.com", "Dec 31 00:00:00 2099 GMT"),
+        }
+        self.configuration = {"listeners": {
+            "*:443": {"pass": "routes", "tls": {"certificate": ["live", "expired"]}},
+            "127.0.0.1:8443": {"pass": "routes", "tls": {"certificate": "expired_alone"}},
+        }}
+        self.now = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+    def test_collect(self):
+        with FakeUnit(self.configuration, self.certificates) as fake_unit:
+            report = collect(UnitControl(fake_unit.socket_path), now=self.now)
+
+            assert report.deleted == ["expired", "orphan"]
+            assert report.kept == ["expired_alone"]
+            assert report.summary() == "Removed 2 certificate bundles (0 bytes, size of 2 unknown)"
+            writes = [request for request in fake_unit.requests if request[0] != "GET"]
+            assert writes[0] == ("DELETE", "/config/listeners/*:443/tls/certificate/1")
+            assert sorted(writes[1:]) == [("DELETE", "/certificates/expired"), ("DELETE", "/certificates/orphan")]
+            assert sorted(fake_unit.certificates) == ["expired_alone", "live"]
+            assert fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"] == ["live"]
+
+    def test_dry_run(self):
+        with FakeUnit(self.configuration, self.certificates) as fake_unit:
+            report = collect(UnitControl(fake_unit.socket_path), dry_run=True, now=self.now)
+
+            assert report.deleted == ["expired", "orphan"]
+            assert [method for method, _ in fake_unit.requests] == ["GET", "GET"]
+
+    def test_expiry_is_the_leaf_one(self):
+        bundle = certificate("www.example.com", "Dec 31 00:00:00 2099 GMT")
+        # an expired cross-signed root
+        bundle["chain"].append({"subject": {}, "validity": {"until": "Sep 30 14:01:15 2021 GMT"}})
+
+        assert expiry(bundle) == datetime(2099, 12, 31, tzinfo=timezone.utc)
@@ -0,0 +1,38 @@
+"""Test for certbot_nginx_unit.configuration."""
+import unittest
+
+from certbot_nginx_unit.configuration import UnitConfiguration
+
+
+class UnitConfigurationTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.configuration.UnitConfiguration"""
+
+    def setUp(self):
+        self.configuration = UnitConfiguration({
+            "listeners": {
+                "*:80": {"pass": "routes/main"},
+                "*:443": {"pass": "routes/main", "tls": {"certificate": ["a", "b"]}},
+                "127.0.0.1:8443": {"pass": "routes/main", "tls": {"certificate": "b"}},
+            },
+            "routes": {
+                "main": [{"action": {"share": "/srv/www/unit/index.html"}}],
+                "acme": [{"match": {"uri": "/.well-known/acme-challenge/*"}, "action": {"share": "/srv/$uri"}}],
+            },
+        })
+
+    def test_lookups(self):
+        assert self.configuration.listener("*:80") == {"pass": "routes/main"}
+        assert self.configuration.listener("*:8080") is None
+        assert self.configuration.route("routes/main") == [{"action": {"share": "/srv/www/unit/index.html"}}]
+        assert self.configuration.route("routes") is None
+        assert self.configuration.acme_route_position() == ("routes/acme", 0)
+        assert self.configuration.tls_listeners() == {"*:443": ["a", "b"], "127.0.0.1:8443": ["b"]}
+        assert self.configuration.bundle_listeners("b") == ["*:443", "127.0.0.1:8443"]
+        assert self.configuration.bundle_listeners("c") == []
+
+    def test_reindex(self):
+        assert self.configuration.acme_route_position() == ("routes/acme", 0)
+        self.configuration["routes"] = [{"action": {"pass": "applications/app"}}]
+        self.configuration.reindex()
+        assert self.configuration.acme_route_position() is None
+        assert self.configuration.route("routes") == [{"action": {"pass": "applications/app"}}]
@@ -1,5 +1,4 @@
 """Test for certbot_nginx.installer."""
-import json
 import tempfile
 
 from unittest import mock
@@ -7,7 +6,12 @@ from unittest import mock
 from certbot import errors
 from certbot.compat import os
 from certbot.tests import util as test_util
+from certbot_nginx_unit.bundle_index import BundleIndex, bundle_fingerprint
 from certbot_nginx_unit.configurator import Configurator
+from certbot_nginx_unit.deployer import Deployer
+from certbot_nginx_unit.journal import APPLIED, DEFERRED, FINISHED, load_journals
+from certbot_nginx_unit.tests.fake_unit import FakeUnit
+from certbot_nginx_unit.unitc import UnitControl
 
 
 def empty_configuration():
@@ -71,27 +75,8 @@ def only_80_listener_configuration_after_cert_list():
     }
 
 
-def get_configuration_side_effect(*args):
-    if args[0] == "/config":
-        return json.dumps(empty_configuration())
-    if args[0] == "/certificates":
-        return '{}'
-    return 'invalid json'
-
-
-def get_configuration_side_effect_80_listener(*args):
-    if args[0] == "/config":
-        return json.dumps(only_80_listener_configuration())
-    if args[0] == "/certificates":
-        return '{}'
-    return 'invalid json'
-
-
-def put_configuration_side_effect_80_listener(*args):
-    if args[0] == "/config/listeners":
-        return json.dumps(only_80_listener_configuration()['listeners'])
-
-    return '{}'
+def bundle_description(common_name):
+    return {"key": "RSA (2048 bits)", "chain": [{"subject": {"common_name": common_name}, "validity": {}}]}
 
 
 class ConfiguratorTest(test_util.ConfigTestCase):
@@ -111,15 +96,46 @@ class ConfiguratorTest(test_util.ConfigTestCase):
         backups = os.path.join(logs_dir, "backups")
         self.configuration.backup_dir = backups
         self.configuration.nginx_unit_path = logs_dir
+        self.configuration.nginx_unit_control = None
+        self.configuration.nginx_unit_unitc = False
+        self.configuration.nginx_unit_deferred_deploy = False
+        self.configuration.nginx_unit_concurrency = 4
+        self.configuration.nginx_unit_max_reconfigurations = 0
+        self.configuration.nginx_unit_reconfiguration_period = 60.0
+        self.configuration.nginx_unit_maintenance_window = None
+        self.configuration.nginx_unit_challenge_targets = None
+        self.configuration.nginx_unit_session_cache_size = None
+        self.configuration.nginx_unit_session_timeout = None
+        self.configuration.nginx_unit_session_tickets = False
+        self.configuration.nginx_unit_ticket_keys_file = None
+        self.configuration.nginx_unit_ticket_key_rotation = 12.0
+        self.configuration.nginx_unit_tls_profile = None
+        self.configuration.nginx_unit_self_check_timeout = 0
+        self.configuration.nginx_unit_persistent_acme_route = False
+        self.configuration.nginx_unit_metrics_textfile = None
+        self.configuration.nginx_unit_metrics_json = None
+        self.configuration.nginx_unit_lock_file = os.path.join(logs_dir, "unit.lock")
 
         return Configurator(self.configuration, name="nginx_unit")
 
-    @mock.patch('certbot_nginx_unit.unitc')
-    def test_empty_configuration(self, unitc_mock):
-        unitc_mock.get.side_effect = get_configuration_side_effect
+    def _start_unit(self, configuration, certificates=None):
+        """Fake Unit serving ``configuration``, read by the configurator."""
+        fake_unit = FakeUnit(configuration, certificates)
+        fake_unit.start()
+        self.addCleanup(fake_unit.stop)
+        # the control API client notifies its successful reads
+        notify = mock.patch('certbot.display.util.notify')
+        notify.start()
+        self.addCleanup(notify.stop)
+        self.configuration.nginx_unit_control = fake_unit.socket_path
+        self.config.unitc = UnitControl(fake_unit.socket_path)
+        self.addCleanup(self.config.unitc.close)
+        return fake_unit
+
+    def test_empty_configuration(self):
+        self._start_unit(empty_configuration())
 
         installer = self.config
-        installer.unitc = unitc_mock
         installer.prepare()
 
         with tempfile.NamedTemporaryFile() as cert_file:
@@ -130,13 +146,19 @@ class ConfiguratorTest(test_util.ConfigTestCase):
             expected_msg = "No '*:80' default listeners configured"
             self.assertEqual(str(ctx.exception), expected_msg)
 
-    @mock.patch('certbot_nginx_unit.unitc')
-    def test_only_80_listener_configuration(self, unitc_mock):
-        unitc_mock.get.side_effect = get_configuration_side_effect_80_listener
-        unitc_mock.put.side_effect = put_configuration_side_effect_80_listener
+    def test_configuration_read_failure_is_raised(self):
+        fake_unit = self._start_unit(only_80_listener_configuration())
+        fake_unit.failures["/config/listeners"] = 500
+
+        # an unreadable section is not an absent one
+        with self.assertRaises(errors.Error):
+            self.config.prepare()
+        assert fake_unit.reconfigurations == 0
+
+    def test_only_80_listener_configuration(self):
+        fake_unit = self._start_unit(only_80_listener_configuration())
 
         installer = self.config
-        installer.unitc = unitc_mock
         installer.prepare()
 
         notify = mock.patch('certbot.display.util.notify')
@@ -147,65 +169,316 @@ class ConfiguratorTest(test_util.ConfigTestCase):
             cert_file.seek(0)
             assert [] == installer.get_all_names()
             installer.deploy_cert("domain", "cert.pem", cert_file.name, "chain_path", cert_file.name)
-
-        get_success_message = 'Get configuration'
-        get_error_message = 'nginx unit get configuration failed'
-
-        put_success_message = 'Certificate deployed'
-        put_error_message = 'nginx unit copy to /certificates failed'
+            installer.save()
 
         entropy = installer._entropy
 
-        unitc_mock.get.assert_any_call("/config", get_success_message, get_error_message)
-        unitc_mock.get.assert_any_call('/certificates', get_success_message, get_error_message)
-        unitc_mock.put.assert_any_call(
-            "/certificates/domain_" + entropy,
-            b'certificate contentcertificate content',
-            'Certificate deployed',
-            'nginx unit copy to /certificates failed'
-        )
-
-        unitc_mock.put.assert_any_call(
-            '/config/listeners',
-            b'{"*:80": {"pass": "routes"}, "*:443": {"pass": "routes", "tls": {"certificate": ["domain_' +
-            entropy.encode() + b'"]}}}',
-            put_success_message,
-            put_error_message
-        )
+        assert fake_unit.requests == [
+            ("GET", "/config/listeners"),
+            ("GET", "/certificates"),
+            ("PUT", "/certificates/domain_" + entropy),
+            # read again just before the write, to detect the concurrent changes
+            ("GET", "/config/listeners"),
+            ("PUT", "/config/listeners/*:443"),
+        ]
+        assert fake_unit.configuration["listeners"]["*:443"] == {
+            "pass": "routes", "tls": {"certificate": ["domain_" + entropy]}}
 
         notify.stop()
 
-    @mock.patch('certbot_nginx_unit.unitc')
     @mock.patch('certbot.achallenges.AnnotatedChallenge')
-    def test_authenticate(self, unitc_mock, challenge_mock):
-        unitc_mock.get.side_effect = get_configuration_side_effect_80_listener
-        unitc_mock.put.side_effect = put_configuration_side_effect_80_listener
+    def test_authenticate(self, challenge_mock):
+        fake_unit = self._start_unit(only_80_listener_configuration())
 
         challenge_mock.response_and_validation.return_value = ("response", "validation")
         challenge_mock.chall.encode.return_value = "token"
 
-        webroot = self.configuration.nginx_unit_path.encode()
+        webroot = self.configuration.nginx_unit_path
         configurator = self.config
-        configurator.unitc = unitc_mock
         notify = mock.patch('certbot.display.util.notify')
         notify.start()
 
         assert ["response"] == configurator.perform([challenge_mock])
 
-        get_success_message = 'Get configuration'
-        get_error_message = 'nginx unit get configuration failed'
-
-        unitc_mock.get.assert_any_call("/config", get_success_message, get_error_message)
-        unitc_mock.put.assert_any_call(
-            '/config/routes',
-            b'[{"match": {"uri": "/.well-known/acme-challenge/*"}, "action": {"share": "' +
-            webroot + b'/$uri"}}, {"action": {"share": "/srv/www/unit/index.html"}}]'
-        )
+        assert ("GET", "/config/listeners") in fake_unit.requests
+        assert ("GET", "/config/routes") in fake_unit.requests
+        assert ("PUT", "/config/routes") in fake_unit.requests
+        assert fake_unit.configuration["routes"] == [
+            {"match": {"uri": "/.well-known/acme-challenge/*"}, "action": {"share": webroot + "/$uri"}},
+            {"action": {"share": "/srv/www/unit/index.html"}},
+        ]
 
         configurator.cleanup(challenge_mock)
-        unitc_mock.put.assert_any_call(
-            '/config/routes',
-            json.dumps(only_80_listener_configuration()['routes']).encode()
-        )
+        assert ("DELETE", "/config/routes/0") in fake_unit.requests
+        assert configurator._configuration['routes'] == only_80_listener_configuration()['routes']
+        assert fake_unit.configuration == only_80_listener_configuration()
+
+        notify.stop()
+
+    def test_deploy_cert_for_many_domains_is_one_write(self):
+        fake_unit = self._start_unit(only_80_listener_configuration())
+
+        installer = self.config
+        installer.prepare()
+
+        notify = mock.patch('certbot.display.util.notify')
+        notify.start()
+
+        with tempfile.NamedTemporaryFile() as cert_file1, tempfile.NamedTemporaryFile() as cert_file2:
+            cert_file2.write(b'other certificate')
+            cert_file2.flush()
+            installer.deploy_cert("domain1", "cert.pem", cert_file1.name, "chain_path", cert_file1.name)
+            installer.deploy_cert("domain2", "cert.pem", cert_file2.name, "chain_path", cert_file2.name)
+            installer.save()
+
+        assert fake_unit.reconfigurations == 1
+        assert fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"] == [
+            "domain1_" + installer._entropy, "domain2_" + installer._entropy
+        ]
+
+        notify.stop()
+
+    def test_configuration_is_read_once(self):
+        fake_unit = self._start_unit(only_80_listener_configuration())
+
+        installer = self.config
+        installer.prepare()
+
+        notify = mock.patch('certbot.display.util.notify')
+        notify.start()
+
+        with tempfile.NamedTemporaryFile() as cert_file:
+            installer.deploy_cert("domain1", "cert.pem", cert_file.name, "chain_path", cert_file.name)
+            installer.deploy_cert("domain2", "cert.pem", cert_file.name, "chain_path", cert_file.name)
+
+        gets = [path for method, path in fake_unit.requests if method == "GET"]
+        # /certificates is only read to build the missing bundle index
+        # only the listeners are read for a deploy
+        assert gets == ["/config/listeners", "/certificates"]
+
+        notify.stop()
+
+    def test_deploy_cert_replaces_indexed_bundles(self):
+        fake_unit = self._start_unit(
+            {"listeners": {"*:443": {"pass": "routes", "tls": {"certificate": ["example.org_1", "other"]}}}},
+            {"example.org_1": bundle_description("example.org"), "other": bundle_description("other.org")})
+
+        bundle_index = BundleIndex(os.path.join(self.configuration.work_dir, "nginx-unit", "bundles.json"))
+        bundle_index.add("example.org_1", {"common_name": "example.org", "alt_names": [], "not_after": None})
+        bundle_index.add("example.org_0", {"common_name": "example.org", "alt_names": [], "not_after": None})
+        bundle_index.save()
+
+        installer = self.config
+        installer.prepare()
+
+        notify = mock.patch('certbot.display.util.notify')
+        notify.start()
+
+        with open(test_util.vector_path('cert_512.pem'), 'rb') as f:
+            cert_content = f.read()
+        with tempfile.NamedTemporaryFile() as cert_file:
+            cert_file.write(cert_content)
+            cert_file.flush()
+            installer.deploy_cert("example.org", "cert.pem", cert_file.name, "chain_path", cert_file.name)
+            installer.save()
+
+        new_bundle_name = "example.org_" + installer._entropy
+        assert ("PUT", "/config/listeners/*:443/tls/certificate") in fake_unit.requests
+        assert fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"] == ["other", new_bundle_name]
+        assert [request for request in fake_unit.requests if request[0] == "DELETE"] == [
+            ("DELETE", "/certificates/example.org_1")]
+        assert ("GET", "/certificates") not in fake_unit.requests
+
+        bundle_index = BundleIndex(bundle_index.path)
+        assert bundle_index.load()
+        assert list(bundle_index.bundles) == [new_bundle_name]
+        assert bundle_index.by_name("example.com") == [new_bundle_name]
+
+        notify.stop()
+
+    def test_deferred_renew_deploy(self):
+        fake_unit = self._start_unit(only_80_listener_configuration())
+        self.configuration.nginx_unit_deferred_deploy = True
+
+        configurators = []
+        with tempfile.NamedTemporaryFile() as cert_file:
+            for domain in ("domain1", "domain2"):
+                cert_file.write(domain.encode())
+                cert_file.flush()
+                lineage = mock.MagicMock(lineagename=domain, key_path=cert_file.name, fullchain_path=cert_file.name)
+                configurator = Configurator(self.configuration, name="nginx_unit")
+                configurator.renew_deploy(lineage)
+                configurators.append(configurator)
+
+            bundle_names = ["domain1_" + configurators[0]._entropy, "domain2_" + configurators[1]._entropy]
+            # uploaded during the renewal of each lineage
+            assert sorted(fake_unit.certificates) == bundle_names
+            assert fake_unit.reconfigurations == 0
+            journal_dir = configurators[0]._journal_dir()
+            assert [journal.status for journal in load_journals(journal_dir)] == [DEFERRED, DEFERRED]
+
+            # the post hook
+            fake_unit.reset_counters()
+            deployer = Deployer(UnitControl(fake_unit.socket_path), self.configuration.work_dir,
+                                lock_path=self.configuration.nginx_unit_lock_file)
+            deployer.apply_deferred()
+            deployer.close()
+
+        config_writes = [request for request in fake_unit.requests
+                         if request[0] != "GET" and request[1].startswith("/config")]
+        assert config_writes == [("PUT", "/config/listeners/*:443")]
+        assert fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"] == bundle_names
+        assert [journal.status for journal in load_journals(journal_dir)] == [APPLIED, APPLIED, FINISHED]
+
+    def test_deferred_renew_deploy_failure_is_raised(self):
+        fake_unit = self._start_unit(only_80_listener_configuration())
+        self.configuration.nginx_unit_deferred_deploy = True
+        fake_unit.failures["/certificates/domain1_" + self.config._entropy] = 500
+
+        with tempfile.NamedTemporaryFile() as cert_file:
+            cert_file.write(b"domain1")
+            cert_file.flush()
+            lineage = mock.MagicMock(lineagename="domain1", key_path=cert_file.name, fullchain_path=cert_file.name)
+            with self.assertRaises(errors.Error) as context:
+                self.config.renew_deploy(lineage)
+        assert "copy to /certificates failed" in str(context.exception)
+        assert fake_unit.reconfigurations == 0
+
+    def test_deploy_cert_keeps_bundles_unit_fails_to_describe(self):
+        fake_unit = self._start_unit(
+            {"listeners": {"*:443": {"pass": "routes", "tls": {"certificate": ["example.org_1"]}}}},
+            {"example.org_1": bundle_description("example.org")})
+        fake_unit.failures["/certificates/example.org_1"] = 500
+
+        bundle_index = BundleIndex(os.path.join(self.configuration.work_dir, "nginx-unit", "bundles.json"))
+        bundle_index.add("example.org_1", {"common_name": "example.org", "alt_names": [], "not_after": None})
+        bundle_index.save()
+
+        installer = self.config
+        installer.prepare()
+        with tempfile.NamedTemporaryFile() as cert_file:
+            with open(test_util.vector_path('cert_512.pem'), 'rb') as f:
+                cert_file.write(f.read())
+            cert_file.flush()
+            # only a missing bundle is forgotten, not one Unit is unable to describe
+            with self.assertRaises(errors.Error):
+                installer.deploy_cert("example.org", "cert.pem", cert_file.name, "chain_path", cert_file.name)
+
+        assert list(installer._get_bundle_index().bundles) == ["example.org_1"]
+
+    def test_deploy_unchanged_certificate_is_noop(self):
+        with tempfile.NamedTemporaryFile() as cert_file:
+            cert_file.write(b'certificate content')
+            cert_file.flush()
+            fingerprint = bundle_fingerprint(b'certificate contentcertificate content')
+
+            bundle_index = BundleIndex(os.path.join(self.configuration.work_dir, "nginx-unit", "bundles.json"))
+            bundle_index.add("domain_1", {"common_name": "domain", "alt_names": [], "not_after": None,
+                                          "fingerprint": fingerprint})
+            bundle_index.save()
+            fake_unit = self._start_unit(
+                {"listeners": {"*:443": {"pass": "routes", "tls": {"certificate": ["domain_1"]}}}},
+                {"domain_1": bundle_description("domain")})
+
+            installer = self.config
+            installer.prepare()
+
+            notify = mock.patch('certbot.display.util.notify')
+            notify.start()
+            installer.deploy_cert("domain", "cert.pem", cert_file.name, "chain_path", cert_file.name)
+            installer.save()
+            notify.stop()
+
+        assert [method for method, _ in fake_unit.requests] == ["GET"]
+
+    def test_update_configuration_replays_on_conflict(self):
+        fake_unit = self._start_unit(only_80_listener_configuration(), {"other_1": bundle_description("other")})
+
+        installer = self.config
+        installer.prepare()
+        # another process adds a 443 listener between the first read and the commit
+        fake_unit.configuration["listeners"]["*:443"] = {"pass": "routes", "tls": {"certificate": ["other_1"]}}
+
+        notify = mock.patch('certbot.display.util.notify')
+        notify.start()
+
+        with tempfile.NamedTemporaryFile() as cert_file:
+            installer.deploy_cert("domain", "cert.pem", cert_file.name, "chain_path", cert_file.name)
+            installer.save()
+
+        config_writes = [request for request in fake_unit.requests
+                         if request[0] != "GET" and request[1].startswith("/config")]
+        # the listener added meanwhile is kept, the new bundle is appended to it
+        assert config_writes == [("POST", "/config/listeners/*:443/tls/certificate")]
+        assert fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"] == [
+            "other_1", "domain_" + installer._entropy]
 
         notify.stop()
+
+    @mock.patch('certbot_nginx_unit.configurator.wait_until_served')
+    @mock.patch('certbot.achallenges.AnnotatedChallenge')
+    def test_perform_waits_for_challenge_files(self, challenge_mock, wait_mock):
+        self._start_unit(only_80_listener_configuration())
+        challenge_mock.response_and_validation.return_value = ("response", "validation")
+        challenge_mock.validation.return_value = "validation"
+        challenge_mock.chall.encode.return_value = "token"
+        challenge_mock.domain = "example.org"
+        self.configuration.nginx_unit_self_check_timeout = 10
+        wait_mock.side_effect = lambda served_files, timeout, address, port: served_files
+
+        configurator = self.config
+        notify = mock.patch('certbot.display.util.notify')
+        notify.start()
+
+        with self.assertRaises(errors.PluginError) as ctx:
+            configurator.perform([challenge_mock])
+        assert str(ctx.exception) == "Nginx Unit does not serve the challenge files of example.org after 10 seconds"
+        # the *:80 listener of the Unit reached at its control socket
+        assert wait_mock.call_args.args[2:] == ("127.0.0.1", 80)
+        served_file = wait_mock.call_args.args[0][0]
+        assert served_file.path == "/.well-known/acme-challenge/token"
+        assert served_file.content == b"validation"
+
+        notify.stop()
+
+    @mock.patch('certbot.achallenges.AnnotatedChallenge')
+    def test_challenge_files_are_replicated(self, challenge_mock):
+        self._start_unit(only_80_listener_configuration())
+        challenge_mock.response_and_validation.return_value = ("response", "validation")
+        challenge_mock.validation.return_value = "validation"
+        challenge_mock.chall.encode.return_value = "token"
+        nodes = [tempfile.mkdtemp("node2"), tempfile.mkdtemp("node3")]
+        self.configuration.nginx_unit_challenge_targets = ",".join(nodes)
+
+        configurator = self.config
+        with mock.patch('certbot.display.util.notify'):
+            configurator.perform([challenge_mock])
+        for node in nodes:
+            with open(os.path.join(node, ".well-known", "acme-challenge", "token"), "rb") as f:
+                assert f.read() == b"validation"
+
+        configurator.cleanup([challenge_mock])
+        for node in nodes:
+            assert os.listdir(os.path.join(node, ".well-known", "acme-challenge")) == []
+
+    @mock.patch('certbot.achallenges.AnnotatedChallenge')
+    def test_persistent_acme_route(self, challenge_mock):
+        fake_unit = self._start_unit(only_80_listener_configuration())
+        challenge_mock.response_and_validation.return_value = ("response", "validation")
+        challenge_mock.chall.encode.return_value = "token"
+        self.configuration.nginx_unit_persistent_acme_route = True
+
+        configurator = self.config
+        configurator.perform([challenge_mock])
+        configurator.cleanup([challenge_mock])
+
+        # the route is installed once and kept
+        assert [request for request in fake_unit.requests if request[0] != "GET"] == [("PUT", "/config/routes")]
+
+        fake_unit.reset_counters()
+        configurator = Configurator(self.configuration, name="nginx_unit")
+        assert ["response"] == configurator.perform([challenge_mock])
+        configurator.cleanup([challenge_mock])
+        configurator.unitc.close()
+
+        assert [method for method, _ in fake_unit.requests] == ["GET", "GET"]
@@ -0,0 +1,38 @@
+"""Test for certbot_nginx_unit.diff."""
+import unittest
+
+from certbot_nginx_unit.diff import MISSING, Operation, diff
+
+
+class DiffTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.diff.diff"""
+
+    def setUp(self):
+        self.listeners = {
+            "*:80": {"pass": "routes"},
+            "*:443": {"pass": "routes", "tls": {"certificate": ["a", "b"]}},
+        }
+
+    def test_equal(self):
+        assert diff(self.listeners, self.listeners, "/listeners") == []
+
+    def test_single_value(self):
+        new = {"*:80": {"pass": "routes/acme"}, "*:443": self.listeners["*:443"]}
+        assert diff(self.listeners, new, "/listeners") == [Operation("PUT", "/listeners/*:80/pass", "routes/acme")]
+
+    def test_array_append_and_remove(self):
+        old = self.listeners["*:443"]
+        appended = {"pass": "routes", "tls": {"certificate": ["a", "b", "c"]}}
+        removed = {"pass": "routes", "tls": {"certificate": ["b"]}}
+        assert diff(old, appended, "/l") == [Operation("POST", "/l/tls/certificate", "c")]
+        assert diff(old, removed, "/l") == [Operation("DELETE", "/l/tls/certificate/0")]
+
+    def test_several_changes_are_one_write(self):
+        new = {"pass": "routes", "tls": {"certificate": ["b", "c"]}}
+        assert diff(self.listeners["*:443"], new, "/l") == [Operation("PUT", "/l/tls/certificate", ["b", "c"])]
+
+    def test_added_and_removed_keys(self):
+        assert diff({}, {"a/b": 1}, "") == [Operation("PUT", "/a%2Fb", 1)]
+        assert diff({"a": 1}, {}, "") == [Operation("DELETE", "/a")]
+        assert diff(MISSING, [], "/routes") == [Operation("PUT", "/routes", [])]
+        assert diff([], MISSING, "/routes") == [Operation("DELETE", "/routes")]
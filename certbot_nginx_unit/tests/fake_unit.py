@@ -0,0 +1,324 @@
+"""Local stand-in for the Nginx Unit control API, listening on a unix socket.
+
+It serves ``/config`` and ``/certificates`` like Unit does (GET, PUT, POST and
+DELETE on any subtree, listeners referencing missing bundles are refused),
+with an optional latency per request and failures injected by path, and
+counts the requests, the reconfigurations and the bytes transferred.
+
+"""
+import copy
+import http.server
+import json
+import socketserver
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import NameOID
+
+from certbot.compat import os
+from certbot_nginx_unit.bundle_index import UNIT_VALIDITY_FORMAT
+
+MISSING = object()
+
+
+def certificate_info(bundle: bytes) -> Dict[str, Any]:
+    """Description of an uploaded bundle, as returned by ``GET /certificates/<name>``."""
+    chain = []
+    try:
+        certificates = x509.load_pem_x509_certificates(bundle)
+    except ValueError:
+        certificates = []
+    for certificate in certificates:
+        common_names = certificate.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+        try:
+            extension = certificate.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+            alt_names = extension.value.get_values_for_type(x509.DNSName)
+        except x509.ExtensionNotFound:
+            alt_names = []
+        if hasattr(certificate, "not_valid_after_utc"):
+            since, until = certificate.not_valid_before_utc, certificate.not_valid_after_utc
+        else:
+            since, until = certificate.not_valid_before, certificate.not_valid_after
+        chain.append({
+            "subject": {"common_name": str(common_names[0].value) if common_names else "", "alt_names": alt_names},
+            "validity": {"since": since.strftime(UNIT_VALIDITY_FORMAT), "until": until.strftime(UNIT_VALIDITY_FORMAT)},
+        })
+    key = "EC (256 bits)"
+    try:
+        private_key = serialization.load_pem_private_key(bundle, None)
+    except (TypeError, ValueError):
+        private_key = None
+    if isinstance(private_key, rsa.RSAPrivateKey):
+        key = "RSA ({0} bits)".format(private_key.key_size)
+    elif isinstance(private_key, ec.EllipticCurvePrivateKey):
+        key = "ECDH ({0})".format(private_key.curve.name)
+    return {"key": key, "chain": chain}
+
+
+def generated_configuration(listeners: int = 1, routes: int = 1,
+                            bundles: int = 1) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Configuration and certificates of a Unit serving many sites.
+
+    :param int listeners: number of TLS listeners besides ``*:80``
+    :param int routes: number of route steps
+    :param int bundles: number of certificate bundles, spread over the TLS listeners
+    :returns: the ``/config`` and the ``/certificates`` trees
+
+    """
+    certificates = {}
+    for index in range(bundles):
+        name = "site{0}.example.org".format(index)
+        certificates[name + "_20240101000000"] = {
+            "key": "RSA (2048 bits)",
+            "chain": [{
+                "subject": {"common_name": name, "alt_names": [name, "www." + name]},
+                "validity": {"since": "Jan  1 00:00:00 2024 GMT", "until": "Jan  1 00:00:00 2099 GMT"},
+            }],
+        }
+    bundle_names = list(certificates)
+    tls_listeners = {}
+    addresses = ["*:443"] + ["127.0.0.{0}:443".format(index) for index in range(1, listeners)]
+    for position, address in enumerate(addresses[:listeners]):
+        tls_listeners[address] = {
+            "pass": "routes",
+            "tls": {"certificate": bundle_names[position::max(listeners, 1)]},
+        }
+    configuration = {
+        "listeners": {"*:80": {"pass": "routes"}, **tls_listeners},
+        "routes": [
+            {"match": {"host": "site{0}.example.org".format(index)},
+             "action": {"share": "/srv/www/site{0}$uri".format(index)}}
+            for index in range(routes)
+        ],
+        "applications": {},
+    }
+    return configuration, certificates
+
+
+class _State:
+    def __init__(self, configuration: Dict[str, Any], certificates: Dict[str, Any], latency: float):
+        self.lock = threading.Lock()
+        self.configuration = configuration
+        self.certificates = certificates
+        self.latency = latency
+        self.requests: List[Tuple[str, str]] = []
+        # status answered to any request of a path, instead of serving it
+        self.failures: Dict[str, int] = {}
+        self.reconfigurations = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+
+def _segments(path: str) -> List[str]:
+    return [segment for segment in path.split("/") if segment]
+
+
+def _resolve(tree: Any, segments: List[str]) -> Any:
+    for segment in segments:
+        if isinstance(tree, dict) and segment in tree:
+            tree = tree[segment]
+        elif isinstance(tree, list) and segment.isdigit() and int(segment) < len(tree):
+            tree = tree[int(segment)]
+        else:
+            return MISSING
+    return tree
+
+
+def _referenced_bundles(configuration: Dict[str, Any]) -> List[str]:
+    bundle_names = []
+    for listener in configuration.get("listeners", {}).values():
+        certificate = listener.get("tls", {}).get("certificate", []) if isinstance(listener, dict) else []
+        bundle_names.extend(certificate if isinstance(certificate, list) else [certificate])
+    return bundle_names
+
+
+class _ControlHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_ControlServer"
+
+    def _reply(self, status: int, value: Any) -> None:
+        body = json.dumps(value).encode()
+        with self.server.state.lock:
+            self.server.state.bytes_sent += len(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method: str) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        state = self.server.state
+        if state.latency:
+            time.sleep(state.latency)
+        with state.lock:
+            state.requests.append((method, self.path))
+            state.bytes_received += len(body)
+            if self.path in state.failures:
+                status, value = state.failures[self.path], {"error": "Internal server error."}
+            else:
+                status, value = self._apply(state, method, _segments(self.path), body)
+        self._reply(status, value)
+
+    def _apply(self, state: _State, method: str, segments: List[str], body: bytes) -> Tuple[int, Any]:
+        if not segments or segments[0] not in ("config", "certificates"):
+            return 404, {"error": "Invalid path."}
+        if segments[0] == "certificates":
+            return self._apply_certificates(state, method, segments[1:], body)
+
+        if method == "GET":
+            value = _resolve(state.configuration, segments[1:])
+            return (404, {"error": "Value doesn't exist."}) if value is MISSING else (200, value)
+        configuration = copy.deepcopy(state.configuration)
+        try:
+            if len(segments) == 1:
+                if method != "PUT":
+                    return 405, {"error": "Invalid method."}
+                configuration = json.loads(body)
+            else:
+                container = _resolve(configuration, segments[1:-1])
+                key: Any = int(segments[-1]) if isinstance(container, list) else segments[-1]
+                if method == "PUT":
+                    container[key] = json.loads(body)
+                elif method == "POST":
+                    container[key].append(json.loads(body))
+                else:
+                    del container[key]
+        except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+            return 400, {"error": "Invalid configuration."}
+        missing = [name for name in _referenced_bundles(configuration) if name not in state.certificates]
+        if missing:
+            return 400, {"error": "Certificate bundle \"{0}\" not found.".format(missing[0])}
+        state.configuration = configuration
+        state.reconfigurations += 1
+        return 200, {"success": "Reconfiguration done."}
+
+    @staticmethod
+    def _apply_certificates(state: _State, method: str, segments: List[str], body: bytes) -> Tuple[int, Any]:
+        if method == "GET":
+            value = _resolve(state.certificates, segments)
+            return (404, {"error": "No certificates found."}) if value is MISSING else (200, value)
+        if len(segments) != 1:
+            return 400, {"error": "Invalid method."}
+        name = segments[0]
+        if method == "PUT":
+            if name in state.certificates:
+                return 400, {"error": "Cannot add certificate bundle: already exists."}
+            state.certificates[name] = certificate_info(body)
+            return 200, {"success": "Certificate chain uploaded."}
+        if method == "DELETE":
+            if name not in state.certificates:
+                return 404, {"error": "No certificates found."}
+            if name in _referenced_bundles(state.configuration):
+                return 400, {"error": "Certificate is used in the configuration."}
+            del state.certificates[name]
+            return 200, {"success": "Certificate deleted."}
+        return 400, {"error": "Invalid method."}
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._handle("GET")
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        self._handle("PUT")
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self._handle("POST")
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        self._handle("DELETE")
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, *args):
+        pass
+
+
+class _ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, state: _State):
+        super().__init__(socket_path, _ControlHandler)
+        self.state = state
+
+
+class FakeUnit:
+    """Fake Unit control API on a unix socket, to be used as a context manager.
+
+    :param configuration: initial ``/config`` tree
+    :param certificates: initial ``/certificates`` tree
+    :param float latency: seconds added to every request
+
+    """
+
+    def __init__(self, configuration: Optional[Dict[str, Any]] = None,
+                 certificates: Optional[Dict[str, Any]] = None, latency: float = 0.0):
+        self._state = _State(copy.deepcopy(configuration or {"listeners": {}, "routes": [], "applications": {}}),
+                             copy.deepcopy(certificates or {}), latency)
+        self._tempdir = ""
+        self.socket_path = ""
+        self._server: Optional[_ControlServer] = None
+
+    @property
+    def configuration(self) -> Dict[str, Any]:
+        return self._state.configuration
+
+    @property
+    def certificates(self) -> Dict[str, Any]:
+        return self._state.certificates
+
+    @property
+    def requests(self) -> List[Tuple[str, str]]:
+        return self._state.requests
+
+    @property
+    def failures(self) -> Dict[str, int]:
+        """Status answered by path, to simulate the failures of Unit."""
+        return self._state.failures
+
+    @property
+    def reconfigurations(self) -> int:
+        """Number of successful writes to ``/config``."""
+        return self._state.reconfigurations
+
+    @property
+    def bytes_received(self) -> int:
+        return self._state.bytes_received
+
+    @property
+    def bytes_sent(self) -> int:
+        return self._state.bytes_sent
+
+    def reset_counters(self) -> None:
+        with self._state.lock:
+            self._state.requests = []
+            self._state.reconfigurations = 0
+            self._state.bytes_received = 0
+            self._state.bytes_sent = 0
+
+    def start(self) -> None:
+        self._tempdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self._tempdir, "control.unit.sock")
+        self._server = _ControlServer(self.socket_path, self._state)
+        # a short poll interval: the tests start and stop many servers
+        threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            os.remove(self.socket_path)
+            os.rmdir(self._tempdir)
+
+    def __enter__(self) -> "FakeUnit":
+        self.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
@@ -0,0 +1,213 @@
+"""Test for certbot_nginx_unit.journal."""
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from certbot.compat import filesystem
+from certbot.compat import os
+from certbot_nginx_unit.deployer import Deployer
+from certbot_nginx_unit.journal import APPLIED, FAILED, FINISHED, ROLLED_BACK, Journal, load_journals
+from certbot_nginx_unit.notify import use_printer
+from certbot_nginx_unit.tests.benchmark import write_certificate
+from certbot_nginx_unit.tests.fake_unit import FakeUnit, generated_configuration
+from certbot_nginx_unit.unitc import UnitControl
+
+
+def _dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+class JournalTest(unittest.TestCase):
+    """Test for the deploys journaled by certbot_nginx_unit.deployer.Deployer"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.work_dir = os.path.join(self.tempdir, "work")
+        self.journal_dir = os.path.join(self.work_dir, "nginx-unit", "bundles.journal")
+        use_printer(lambda message: None)
+
+    def tearDown(self):
+        use_printer(None)
+
+    def _issue(self, domain, version):
+        """Archive file of the certificate ``version`` of ``domain``, as certbot keeps them."""
+        archive = os.path.join(self.tempdir, "archive", domain)
+        if not os.path.isdir(archive):
+            filesystem.makedirs(archive)
+        path = os.path.join(archive, "cert{0}.pem".format(version))
+        shutil.move(write_certificate(self.tempdir, domain), path)
+        return path
+
+    def _deploy(self, fake_unit, paths):
+        deployer = Deployer(UnitControl(fake_unit.socket_path), self.work_dir,
+                            lock_path=os.path.join(self.tempdir, "unit.lock"))
+        deployer.deploy("www.example.org", paths[0], paths[0])
+        deployer.deploy("api.example.org", paths[1], paths[1])
+        deployer.save()
+        deployer.close()
+        return deployer
+
+    def test_run_is_journaled(self):
+        configuration, certificates = generated_configuration()
+        with FakeUnit(configuration, certificates) as fake_unit:
+            self._deploy(fake_unit, [self._issue("www.example.org", 1), self._issue("api.example.org", 1)])
+
+        journal, = load_journals(self.journal_dir)
+        assert journal.status == FINISHED
+        assert [entry["op"] for entry in journal.entries] == [
+            "plan", "upload", "upload", "configure", "configured", "end"]
+        assert journal.listeners_before == {"*:80": None, "*:443": ["site0.example.org_20240101000000"]}
+
+    def test_interrupted_run_is_resumed(self):
+        configuration, certificates = generated_configuration()
+        www_path = self._issue("www.example.org", 1)
+        api_path = self._issue("api.example.org", 1)
+        with FakeUnit(configuration, certificates) as fake_unit:
+            self._deploy(fake_unit, [www_path, api_path])
+            www_bundle, api_bundle = fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"][1:]
+
+            # a run killed after its first upload
+            new_www_path = self._issue("www.example.org", 2)
+            new_api_path = self._issue("api.example.org", 2)
+            deploys = [
+                {"bundle": "www.example.org_20990101000000_aaaaaa", "key": new_www_path,
+                 "fullchain": new_www_path, "replaces": [www_bundle]},
+                {"bundle": "api.example.org_20990101000000_aaaaaa", "key": new_api_path,
+                 "fullchain": new_api_path, "replaces": [api_bundle]},
+            ]
+            journal = Journal(os.path.join(self.journal_dir, "20990101000000_aaaaaa-1.jsonl"))
+            journal.append("plan", version=1, pid=_dead_pid(), deploys=deploys)
+            with open(new_www_path, "rb") as f:
+                certificate = f.read()
+            UnitControl(fake_unit.socket_path).put("/certificates/" + deploys[0]["bundle"], certificate)
+            journal.append("upload", bundle=deploys[0]["bundle"])
+
+            fake_unit.reset_counters()
+            deployer = Deployer(UnitControl(fake_unit.socket_path), self.work_dir,
+                                lock_path=os.path.join(self.tempdir, "unit.lock"))
+            deployer._connect()
+            deployer.close()
+
+            assert fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"] == [
+                "site0.example.org_20240101000000",
+                deploys[0]["bundle"], deploys[1]["bundle"]]
+            assert ("PUT", "/certificates/" + deploys[0]["bundle"]) not in fake_unit.requests
+            assert www_bundle not in fake_unit.certificates
+            assert api_bundle not in fake_unit.certificates
+        assert Journal.load(journal.path).status == FINISHED
+
+    def test_interrupted_run_with_the_same_pid_is_resumed(self):
+        configuration, certificates = generated_configuration()
+        www_path = self._issue("www.example.org", 1)
+        with FakeUnit(configuration, certificates) as fake_unit:
+            # left by a crashed run of an earlier container, where certbot had the same PID
+            deploys = [{"bundle": "www.example.org_20990101000000_aaaaaa", "key": www_path, "fullchain": www_path,
+                        "replaces": []}]
+            journal = Journal(os.path.join(self.journal_dir, "20990101000000_aaaaaa-1.jsonl"))
+            journal.append("plan", version=1, pid=os.getpid(), deploys=deploys)
+            assert journal.interrupted() and not journal.in_progress()
+
+            deployer = Deployer(UnitControl(fake_unit.socket_path), self.work_dir,
+                                lock_path=os.path.join(self.tempdir, "unit.lock"))
+            deployer._connect()
+            deployer.close()
+
+            assert fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"] == [
+                "site0.example.org_20240101000000", deploys[0]["bundle"]]
+        assert Journal.load(journal.path).status == FINISHED
+        # the runs of this process are not resumed
+        own = Journal.create(self.journal_dir, "20990101000000_bbbbbb-1", deploys)
+        assert not own.interrupted() and not own.in_progress()
+
+    def test_restored_bundle_is_journaled_with_its_files(self):
+        configuration, certificates = generated_configuration()
+        www_path = self._issue("www.example.org", 1)
+        with FakeUnit(configuration, certificates) as fake_unit:
+            self._deploy(fake_unit, [www_path, self._issue("api.example.org", 1)])
+            www_bundle = fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"][1]
+            # taken off the listener but still in Unit
+            UnitControl(fake_unit.socket_path).put("/config/listeners/*:443/tls/certificate",
+                                                   json.dumps(["site0.example.org_20240101000000"]).encode())
+
+            deployer = Deployer(UnitControl(fake_unit.socket_path), self.work_dir,
+                                lock_path=os.path.join(self.tempdir, "unit.lock"))
+            outcomes = deployer.reconcile([("www.example.org", www_path, www_path)])
+            deployer.close()
+
+        assert outcomes["restored"] == ["www.example.org"]
+        journal = load_journals(self.journal_dir)[-1]
+        assert journal.deploys == [{"bundle": www_bundle, "key": filesystem.realpath(www_path),
+                                    "fullchain": filesystem.realpath(www_path), "replaces": []}]
+
+    def test_abandoned_deferred_run_is_applied(self):
+        configuration, certificates = generated_configuration()
+        www_path = self._issue("www.example.org", 1)
+        with FakeUnit(configuration, certificates) as fake_unit:
+            # a deferred run whose certbot process ended without applying it
+            deploys = [{"bundle": "www.example.org_20990101000000_aaaaaa", "key": www_path, "fullchain": www_path,
+                        "replaces": []}]
+            deferred = Journal(os.path.join(self.journal_dir, "20990101000000_aaaaaa-1.jsonl"))
+            deferred.append("plan", version=1, pid=_dead_pid(), deploys=deploys)
+            with open(www_path, "rb") as f:
+                UnitControl(fake_unit.socket_path).put("/certificates/" + deploys[0]["bundle"], f.read())
+            deferred.append("upload", bundle=deploys[0]["bundle"])
+            deferred.append("deferred")
+            # lost since its upload, by a Unit state reset
+            del fake_unit.certificates[deploys[0]["bundle"]]
+
+            fake_unit.reset_counters()
+            deployer = Deployer(UnitControl(fake_unit.socket_path), self.work_dir,
+                                lock_path=os.path.join(self.tempdir, "unit.lock"))
+            deployer._connect()
+            deployer.close()
+
+            assert fake_unit.configuration["listeners"]["*:443"]["tls"]["certificate"] == [
+                "site0.example.org_20240101000000", deploys[0]["bundle"]]
+            assert ("PUT", "/certificates/" + deploys[0]["bundle"]) in fake_unit.requests
+        assert [journal.status for journal in load_journals(self.journal_dir)] == [APPLIED, FINISHED]
+
+    def test_failed_resume_is_journaled(self):
+        configuration, certificates = generated_configuration()
+        with FakeUnit(configuration, certificates) as fake_unit:
+            # the files of a bundle restored by an older run were not journaled
+            journal = Journal(os.path.join(self.journal_dir, "20990101000000_aaaaaa-1.jsonl"))
+            journal.append("plan", version=1, pid=_dead_pid(), deploys=[
+                {"bundle": "www.example.org_20990101000000_aaaaaa", "key": None, "fullchain": None,
+                 "replaces": []}])
+
+            for _ in range(2):
+                deployer = Deployer(UnitControl(fake_unit.socket_path), self.work_dir,
+                                    lock_path=os.path.join(self.tempdir, "unit.lock"))
+                deployer._connect()
+                deployer.close()
+        assert Journal.load(journal.path).status == FAILED
+        assert [entry["op"] for entry in Journal.load(journal.path).entries] == ["plan", "failed"]
+
+    def test_rollback(self):
+        configuration, certificates = generated_configuration()
+        with FakeUnit(configuration, certificates) as fake_unit:
+            self._deploy(fake_unit, [self._issue("www.example.org", 1), self._issue("api.example.org", 1)])
+            deployed_configuration = fake_unit.configuration
+            deployed_bundles = set(fake_unit.certificates)
+
+            self._deploy(fake_unit, [self._issue("www.example.org", 2), self._issue("api.example.org", 2)])
+            assert fake_unit.configuration != deployed_configuration
+
+            deployer = Deployer(UnitControl(fake_unit.socket_path), self.work_dir,
+                                lock_path=os.path.join(self.tempdir, "unit.lock"))
+            deployer._connect()
+            deployer._rollback_deploys(1)
+            deployer.close()
+
+            assert fake_unit.configuration == deployed_configuration
+            assert set(fake_unit.certificates) == deployed_bundles
+        assert [journal.status for journal in load_journals(self.journal_dir)] == [FINISHED, ROLLED_BACK]
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,57 @@
+"""Test for certbot_nginx_unit.jsonstream."""
+import json
+import unittest
+
+from certbot_nginx_unit.jsonstream import decode, iter_members, response_error
+
+
+def _chunks(document: bytes, size: int):
+    return [document[position:position + size] for position in range(0, len(document), size)]
+
+
+class DecodeTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.jsonstream.decode"""
+
+    document = {
+        "béta.example.org_20240101000000": {"key": "RSA (2048 bits)", "chain": [{"subject": {}}]},
+        "numbers": [12345, 6.5e3, -1],
+        "count": 1234567,
+        "empty": {},
+    }
+
+    def test_any_chunking(self):
+        body = json.dumps(self.document, ensure_ascii=False).encode("utf-8")
+        for size in (1, 2, 3, 7, 4096):
+            assert decode(_chunks(body, size)) == self.document
+
+    def test_select(self):
+        body = json.dumps(self.document).encode()
+        members = iter_members(_chunks(body, 5), lambda name, value: type(value).__name__)
+        assert list(members) == [("béta.example.org_20240101000000", "dict"), ("numbers", "list"),
+                                 ("count", "int"), ("empty", "dict")]
+
+    def test_not_an_object(self):
+        assert decode([b' ["*:443"]']) == ["*:443"]
+        assert decode([b'"bundle"']) == "bundle"
+
+    def test_invalid(self):
+        for body in (b'{"a": 1', b'{"a": 1,}', b'{"a" 1}', b'{"a": 1} 2', b''):
+            with self.assertRaises(ValueError):
+                decode(_chunks(body, 2))
+
+
+class ResponseErrorTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.jsonstream.response_error"""
+
+    def test_error_status(self):
+        assert response_error(400, b'{"error": "Invalid configuration.", "detail": "no tls"}') == \
+            "Invalid configuration. (no tls)"
+        assert response_error(502, b'<html>Bad Gateway</html>') == "HTTP status 502"
+
+    def test_error_text_in_a_successful_response(self):
+        assert response_error(200, b'{"routes": [{"action": {"return": 404, "location": "/\\"error\\""}}]}') is None
+        assert response_error(200, b'{"error": "Reconfiguration failed."}') == "Reconfiguration failed."
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,45 @@
+"""Test for certbot_nginx_unit.lock."""
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from certbot import errors
+from certbot.compat import os
+from certbot_nginx_unit.lock import UnitLock
+
+# exits 1 when the lock file argv[1] is locked by another process
+TRY_LOCK = """
+import fcntl, sys
+with open(sys.argv[1], "r+") as f:
+    try:
+        fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        sys.exit(1)
+"""
+
+
+class UnitLockTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.lock.UnitLock"""
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "unit.lock")
+
+    def _locked_by_another_process(self):
+        return subprocess.run([sys.executable, "-c", TRY_LOCK, self.path], check=False).returncode == 1
+
+    def test_reentrant(self):
+        lock = UnitLock(self.path)
+        with lock:
+            with lock:
+                pass
+            assert self._locked_by_another_process()
+        assert not self._locked_by_another_process()
+
+    def test_timeout(self):
+        with UnitLock(self.path):
+            # another lock of the same process waits too
+            with self.assertRaises(errors.PluginError):
+                UnitLock(self.path, timeout=0).acquire()
+        with UnitLock(self.path, timeout=0):
+            pass
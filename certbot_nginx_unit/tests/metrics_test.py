@@ -0,0 +1,43 @@
+"""Test for certbot_nginx_unit.metrics."""
+import json
+import tempfile
+import unittest
+
+from certbot.compat import os
+from certbot_nginx_unit.metrics import Metrics
+
+
+class MetricsTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.metrics.Metrics"""
+
+    def test_write(self):
+        metrics = Metrics()
+        metrics.record_call("PUT", "/certificates/example.org_1", 100, 36, 0.25)
+        metrics.record_call("PUT", "/certificates/example.com_1", 50, 36, 0.5)
+        metrics.record_call("GET", "/config", 0, 0, 0.1, "connection")
+
+        @metrics.timed("deploy_cert")
+        def deploy_cert():
+            return "deployed"
+
+        assert deploy_cert() == "deployed"
+
+        tempdir = tempfile.mkdtemp()
+        textfile_path = os.path.join(tempdir, "certbot.prom")
+        json_path = os.path.join(tempdir, "certbot.json")
+        metrics.write(textfile_path, json_path)
+
+        with open(textfile_path, encoding="utf-8") as f:
+            textfile = f.read().splitlines()
+        assert 'certbot_nginx_unit_api_calls_total{method="PUT",path="/certificates/{bundle}",error=""} 2' in textfile
+        assert ('certbot_nginx_unit_api_request_bytes_total{method="PUT",path="/certificates/{bundle}",error=""} 150'
+                in textfile)
+        assert 'certbot_nginx_unit_api_calls_total{method="GET",path="/config",error="connection"} 1' in textfile
+        assert 'certbot_nginx_unit_phase_calls_total{phase="deploy_cert"} 1' in textfile
+
+        with open(json_path, encoding="utf-8") as f:
+            summary = json.load(f)
+        put_calls = [call for call in summary["api_calls"] if call["method"] == "PUT"]
+        assert put_calls[0]["max_seconds"] == 0.5
+        assert summary["phases"]["deploy_cert"]["count"] == 1
+        assert sorted(os.listdir(tempdir)) == ["certbot.json", "certbot.prom"]
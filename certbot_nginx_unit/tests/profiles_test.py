@@ -0,0 +1,50 @@
+"""Test for certbot_nginx_unit.profiles."""
+import tempfile
+import unittest
+
+from unittest import mock
+
+from certbot import errors
+from certbot.compat import os
+from certbot_nginx_unit.profiles import PROFILES, has_aes_instructions, profile_commands
+
+
+class ProfilesTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.profiles.profile_commands"""
+
+    def _cpuinfo(self, flags):
+        path = os.path.join(tempfile.mkdtemp(), "cpuinfo")
+        with open(path, "w") as f:
+            f.write("processor\t: 0\nflags\t\t: {0}\n".format(flags))
+        return path
+
+    def test_auto(self):
+        assert has_aes_instructions(self._cpuinfo("fpu sse2 aes avx"))
+        assert not has_aes_instructions(self._cpuinfo("fpu sse2 avx"))
+        assert has_aes_instructions(os.path.join(tempfile.mkdtemp(), "missing"))
+
+        commands = profile_commands("auto", self._cpuinfo("fpu sse2"))
+        assert commands["ciphersuites"].startswith("TLS_CHACHA20_POLY1305_SHA256")
+        assert commands["options"] == "ServerPreference,PrioritizeChaCha"
+        commands = profile_commands("auto", self._cpuinfo("fpu sse2 aes"))
+        assert commands["ciphersuites"].startswith("TLS_AES_128_GCM_SHA256")
+
+    def test_tls13(self):
+        commands = profile_commands("tls13")
+        assert commands["minprotocol"] == "TLSv1.3"
+        assert "cipherstring" not in commands
+
+    def test_unsupported(self):
+        with self.assertRaises(errors.PluginError):
+            profile_commands("fastest")
+        with mock.patch.dict(PROFILES, {"custom": {"cipherstring": "ECDHE-RSA-AES128-GCM-SHA256:NO-SUCH-CIPHER",
+                                                   "groups": "prime256v1:no-such-group"}}):
+            assert profile_commands("custom") == {"cipherstring": "ECDHE-RSA-AES128-GCM-SHA256",
+                                                  "groups": "prime256v1"}
+        with mock.patch.dict(PROFILES, {"custom": {"cipherstring": "NO-SUCH-CIPHER"}}):
+            with self.assertRaises(errors.PluginError):
+                profile_commands("custom")
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,98 @@
+"""Test for certbot_nginx_unit.replication."""
+import io
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+from unittest import mock
+
+from certbot import errors
+from certbot.compat import filesystem
+from certbot.compat import os
+from certbot_nginx_unit.replication import (DirectoryTarget, SshTarget, parse_targets, publish_everywhere,
+                                            remove_everywhere)
+
+_local_run = subprocess.run
+
+FILES = {"token1": b"validation1", "token2": b"validation2"}
+
+
+class ReplicationTest(unittest.TestCase):
+    """Test for the challenge files published by certbot_nginx_unit.replication"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def test_parse_targets(self):
+        targets = parse_targets(" /mnt/node2/www , ssh://deploy@node3:2222/srv/www/unit/,")
+        assert isinstance(targets[0], DirectoryTarget)
+        assert targets[0].directory == "/mnt/node2/www/.well-known/acme-challenge"
+        assert isinstance(targets[1], SshTarget)
+        assert targets[1].destination == "deploy@node3"
+        assert targets[1].port == 2222
+        assert targets[1].directory == "/srv/www/unit/.well-known/acme-challenge"
+        with self.assertRaises(errors.PluginError):
+            parse_targets("ftp://node2/www")
+
+    def test_directories(self):
+        targets = [DirectoryTarget(os.path.join(self.tempdir, name)) for name in ("node2", "node3")]
+        publish_everywhere(targets, FILES)
+        for target in targets:
+            assert sorted(os.listdir(target.directory)) == ["token1", "token2"]
+            assert target.missing(FILES) == []
+
+        remove_everywhere(targets, list(FILES))
+        for target in targets:
+            assert os.listdir(target.directory) == []
+            assert target.missing(FILES) == ["token1", "token2"]
+
+    def test_failed_target_is_reported(self):
+        blocked = os.path.join(self.tempdir, "blocked")
+        with open(blocked, "w") as f:
+            f.write("not a directory")
+        targets = [DirectoryTarget(os.path.join(self.tempdir, "node2")), DirectoryTarget(blocked)]
+
+        with self.assertRaises(errors.PluginError) as context:
+            publish_everywhere(targets, FILES)
+        assert str(context.exception).startswith("Challenge files not published on 1 of 2 nodes: " + blocked)
+        assert targets[0].missing(FILES) == []
+
+    @mock.patch("certbot_nginx_unit.replication.subprocess.run")
+    def test_ssh(self, run_mock):
+        target = SshTarget("ssh://node2/srv/www")
+        run_mock.return_value = subprocess.CompletedProcess([], 0, b"", b"")
+        target.publish(FILES)
+        command = run_mock.call_args.args[0]
+        assert command[:3] == ["ssh", "-o", "BatchMode=yes"]
+        assert command[3:] == ["node2", "mkdir -p /srv/www/.well-known/acme-challenge && "
+                                        "tar -x -m -o -f - -C /srv/www/.well-known/acme-challenge"]
+        with tarfile.open(fileobj=io.BytesIO(run_mock.call_args.kwargs["input"])) as tar:
+            assert tar.getnames() == ["token1", "token2"]
+            assert tar.extractfile("token2").read() == b"validation2"
+
+        # the script reading the files back runs in a local shell instead of on node2
+        target.directory = os.path.join(tempfile.mkdtemp(), "acme-challenge")
+        run_mock.side_effect = lambda command, **kwargs: _local_run(["sh", "-c", command[-1]], **kwargs)
+        assert target.missing(FILES) == ["token1", "token2"]
+        filesystem.mkdir(target.directory)
+        with open(os.path.join(target.directory, "token1"), "wb") as f:
+            f.write(b"validation1")
+        with open(os.path.join(target.directory, "token2"), "wb") as f:
+            f.write(b"stale\nvalidation2")
+        run_mock.reset_mock()
+        assert target.missing(FILES) == ["token2"]
+        assert run_mock.call_count == 1
+        with open(os.path.join(target.directory, "token2"), "wb") as f:
+            f.write(b"validation2")
+        assert target.missing(FILES) == []
+
+        run_mock.side_effect = None
+        run_mock.return_value = subprocess.CompletedProcess([], 255, b"", b"Connection refused")
+        with self.assertRaises(errors.PluginError) as context:
+            target.remove(list(FILES))
+        assert "Connection refused" in str(context.exception)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
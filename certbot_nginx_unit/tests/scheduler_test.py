@@ -0,0 +1,78 @@
+"""Test for certbot_nginx_unit.scheduler."""
+import datetime
+import tempfile
+import unittest
+
+from certbot.compat import os
+from certbot_nginx_unit.scheduler import MaintenanceWindow, ReconfigurationScheduler
+
+
+class MaintenanceWindowTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.scheduler.MaintenanceWindow"""
+
+    def test_parse(self):
+        assert MaintenanceWindow.parse("2:00-4:30") == MaintenanceWindow(datetime.time(2), datetime.time(4, 30))
+        with self.assertRaises(ValueError):
+            MaintenanceWindow.parse("2h-4h")
+
+    def test_seconds_until_open(self):
+        window = MaintenanceWindow.parse("02:00-04:00")
+        assert window.seconds_until_open(datetime.datetime(2024, 1, 1, 3, 0)) == 0
+        assert window.seconds_until_open(datetime.datetime(2024, 1, 1, 1, 30)) == 1800
+        assert window.seconds_until_open(datetime.datetime(2024, 1, 1, 4, 0)) == 22 * 3600
+
+    def test_overnight(self):
+        window = MaintenanceWindow.parse("23:00-01:00")
+        assert window.seconds_until_open(datetime.datetime(2024, 1, 1, 0, 30)) == 0
+        assert window.seconds_until_open(datetime.datetime(2024, 1, 1, 23, 30)) == 0
+        assert window.seconds_until_open(datetime.datetime(2024, 1, 1, 22, 0)) == 3600
+
+
+class ReconfigurationSchedulerTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.scheduler.ReconfigurationScheduler"""
+
+    def setUp(self):
+        self.state_path = os.path.join(tempfile.mkdtemp(), "nginx-unit", "bundles.reconfigurations.json")
+        self.now = 1000.0
+        self.sleeps = []
+
+    def _sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def _scheduler(self, max_writes, **kwargs):
+        return ReconfigurationScheduler(self.state_path, max_writes, 10.0, clock=lambda: self.now,
+                                        sleep=self._sleep, **kwargs)
+
+    def test_unlimited(self):
+        self._scheduler(0).throttle(100)
+        assert self.sleeps == []
+        assert not os.path.exists(self.state_path)
+
+    def test_throttle(self):
+        scheduler = self._scheduler(2)
+        scheduler.throttle(1)
+        scheduler.throttle(1)
+        assert self.sleeps == []
+        self.now += 4
+        scheduler.throttle(1)
+        assert self.sleeps == [6.0]
+        # more writes than the limit wait for an empty window
+        scheduler.throttle(3)
+        assert self.sleeps == [6.0, 10.0]
+
+    def test_shared_by_processes(self):
+        self._scheduler(1).throttle(1)
+        self._scheduler(1).throttle(1)
+        assert self.sleeps == [10.0]
+
+    def test_wait_for_window(self):
+        opening = datetime.datetime.fromtimestamp(self.now) + datetime.timedelta(minutes=90)
+        window = MaintenanceWindow(opening.time().replace(second=0, microsecond=0),
+                                   (opening + datetime.timedelta(hours=1)).time())
+        self._scheduler(0, maintenance_window=window).wait_for_window()
+        assert len(self.sleeps) == 1 and 89 * 60 <= self.sleeps[0] <= 90 * 60
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
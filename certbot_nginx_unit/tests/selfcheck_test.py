@@ -0,0 +1,57 @@
+"""Test for certbot_nginx_unit.selfcheck."""
+import http.server
+import threading
+import unittest
+
+from certbot_nginx_unit.selfcheck import ServedFile, listener_address, wait_until_served
+
+
+class _ChallengeHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.headers["Host"] == "example.org" and self.path == "/.well-known/acme-challenge/token":
+            self.send_response(200)
+            self.send_header("Content-Length", "10")
+            self.end_headers()
+            self.wfile.write(b"validation")
+        else:
+            self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class WaitUntilServedTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.selfcheck.wait_until_served"""
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _ChallengeHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_returns_files_not_served(self):
+        served = ServedFile("example.org", "/.well-known/acme-challenge/token", b"validation")
+        other_host = ServedFile("example.com", "/.well-known/acme-challenge/token", b"validation")
+        wrong_content = ServedFile("example.org", "/.well-known/acme-challenge/token", b"other")
+
+        not_served = wait_until_served([served, other_host, wrong_content], 0.2, port=self.server.server_port,
+                                       interval=0.1)
+
+        assert not_served == [other_host, wrong_content]
+
+
+class ListenerAddressTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.selfcheck.listener_address"""
+
+    def test_wildcard_listener_is_fetched_at_the_control_host(self):
+        assert listener_address("*:80") == ("127.0.0.1", 80)
+        assert listener_address("*:80", "/var/run/control.unit.sock") == ("127.0.0.1", 80)
+        assert listener_address("*:80", "unix:/var/run/control.unit.sock") == ("127.0.0.1", 80)
+        assert listener_address("*:80", "10.0.0.2:8080") == ("10.0.0.2", 80)
+        assert listener_address("*:80", "http://unit.example.org:8080/") == ("unit.example.org", 80)
+
+    def test_listener_address(self):
+        assert listener_address("192.0.2.1:8080", "10.0.0.2:8080") == ("192.0.2.1", 8080)
+        assert listener_address("[::1]:80") == ("::1", 80)
@@ -0,0 +1,51 @@
+"""Test for certbot_nginx_unit.session."""
+import base64
+import tempfile
+import unittest
+
+from certbot.compat import filesystem
+from certbot.compat import os
+from certbot_nginx_unit.session import TICKET_KEY_SIZE, TICKET_KEYS_KEPT, SessionSettings, TicketKeyRing, \
+    session_options
+
+
+class TicketKeyRingTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.session.TicketKeyRing"""
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "nginx-unit", "ticket-keys.json")
+        self.now = 1000.0
+
+    def _keys(self):
+        return TicketKeyRing(self.path, lambda: self.now).keys(3600)
+
+    def test_rotation(self):
+        first = self._keys()
+        assert len(first) == 1
+        assert len(base64.b64decode(first[0])) == TICKET_KEY_SIZE
+        assert filesystem.check_mode(self.path, 0o600)
+
+        self.now += 1800
+        assert self._keys() == first
+
+        self.now += 1800
+        second = self._keys()
+        # the previous key still decrypts the tickets issued before the rotation
+        assert second[:-1] == first and second[-1] != first[0]
+
+        for _ in range(TICKET_KEYS_KEPT):
+            self.now += 3600
+            keys = self._keys()
+        assert len(keys) == TICKET_KEYS_KEPT
+        assert first[0] not in keys
+
+    def test_session_options(self):
+        assert not SessionSettings().managed
+        assert session_options(SessionSettings(cache_size=10240, timeout=3600)) == {
+            "cache_size": 10240, "timeout": 3600}
+        options = session_options(SessionSettings(ticket_keys_path=self.path))
+        assert options["tickets"] == TicketKeyRing(self.path).keys(3600)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,79 @@
+"""Test for certbot_nginx_unit.transaction."""
+import json
+import unittest
+
+from unittest import mock
+
+from certbot_nginx_unit.transaction import ConfigTransaction
+
+
+class ConfigTransactionTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.transaction.ConfigTransaction"""
+
+    def test_commit_collapses_staged_paths(self):
+        configuration = {
+            "listeners": {"*:80": {"pass": "routes"}, "*:443": {"pass": "routes", "tls": {"certificate": ["a"]}}},
+            "routes": [],
+        }
+        unitc = mock.MagicMock()
+        transaction = ConfigTransaction()
+        transaction.stage("/routes")
+        transaction.stage("/listeners/*:443/tls/certificate")
+        transaction.stage("/listeners", "ok", "ko")
+        transaction.stage("/listeners/*:80/pass")
+
+        assert transaction.staged_paths() == ["/routes", "/listeners"]
+        assert transaction.commit(unitc, configuration) == 2
+        assert unitc.put.call_args_list == [
+            mock.call("/config/routes", b'[]', "", ""),
+            mock.call("/config/listeners",
+                      b'{"*:80": {"pass": "routes"}, "*:443": {"pass": "routes", "tls": {"certificate": ["a"]}}}',
+                      "ok", "ko"),
+        ]
+        assert transaction.commit(unitc, configuration) == 0
+
+    def test_merge(self):
+        configuration = {
+            "listeners": {"*:80": {"pass": "routes/acme"}, "*:443": {"pass": "routes", "tls": {"certificate": ["b"]}}},
+            "routes": {"acme": []},
+        }
+        unitc = mock.MagicMock()
+        transaction = ConfigTransaction(merge=True)
+        transaction.begin({
+            "listeners": {"*:80": {"pass": "routes"}, "*:443": {"pass": "routes", "tls": {"certificate": ["a"]}}},
+            "routes": {},
+        })
+        transaction.stage("/routes/acme", "route ok", "route ko")
+        transaction.stage("/listeners/*:80/pass", "pass ok", "pass ko")
+        transaction.stage("/listeners/*:443/tls/certificate")
+
+        assert transaction.staged_paths() == ["/routes/acme", "/listeners"]
+        assert transaction.commit(unitc, configuration) == 2
+        assert unitc.put.call_args_list == [
+            mock.call("/config/routes/acme", b'[]', "route ok", "route ko"),
+            mock.call("/config/listeners", json.dumps(configuration["listeners"]).encode(), "pass ok", "pass ko"),
+        ]
+
+    def test_commit_deletes_missing_paths(self):
+        unitc = mock.MagicMock()
+        transaction = ConfigTransaction()
+        transaction.stage("/listeners/*:80")
+        transaction.stage("/routes/1")
+
+        assert transaction.commit(unitc, {"listeners": {}, "routes": [{}]}) == 2
+        unitc.delete.assert_has_calls([
+            mock.call("/config/listeners/*:80", None, "", ""),
+            mock.call("/config/routes/1", None, "", ""),
+        ])
+        unitc.put.assert_not_called()
+
+    def test_changed_paths(self):
+        transaction = ConfigTransaction()
+        transaction.begin({"listeners": {"*:80": {"pass": "routes"}}, "routes": []})
+        transaction.stage("/routes")
+        transaction.stage("/listeners/*:443")
+
+        assert transaction.changed_paths({"listeners": {"*:80": {"pass": "routes"}}, "routes": []}) == []
+        assert transaction.changed_paths({"listeners": {"*:443": {}}, "routes": [{}]}) == [
+            "/routes", "/listeners/*:443"
+        ]
@@ -0,0 +1,138 @@
+"""Test for certbot_nginx_unit.unitc."""
+import http.server
+import os
+import socketserver
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+
+from certbot import errors
+from certbot_nginx_unit.metrics import METRICS
+from certbot_nginx_unit.unitc import AsyncUnitc, UnitControl
+
+
+class _ControlHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.server.requests.append(("GET", self.path, None))
+        if self.path == "/config/missing":
+            self._reply(404, b'{"error": "Value doesn\'t exist."}')
+            return
+        self._reply(200, b'{"listeners": {}}')
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append(("PUT", self.path, body))
+        self._reply(200, b'{"success": "Reconfiguration done."}')
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, *args):
+        pass
+
+
+class _ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        super().__init__(socket_path, _ControlHandler)
+        self.requests = []
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+
+class UnitControlTest(unittest.TestCase):
+    """Test for certbot_nginx_unit.unitc.UnitControl"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tempdir, "control.sock")
+        self.server = _ControlServer(self.socket_path)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.client = UnitControl(self.socket_path)
+        self.notify = mock.patch('certbot.display.util.notify')
+        self.notify.start()
+
+    def tearDown(self):
+        self.notify.stop()
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove(self.socket_path)
+        os.rmdir(self.tempdir)
+
+    def test_requests_share_one_connection(self):
+        assert self.client.get("/config") == '{"listeners": {}}'
+        self.client.put("/config/listeners", b'{"*:80": {"pass": "routes"}}')
+
+        assert self.server.requests[0] == ("GET", "/config", None)
+        assert self.server.requests[1] == ("PUT", "/config/listeners", b'{"*:80": {"pass": "routes"}}')
+        assert self.server.connections == 1
+
+    def test_error_status(self):
+        with self.assertRaises(errors.Error) as ctx:
+            self.client.get("/config/missing", "", "get failed")
+        assert str(ctx.exception) == "get failed"
+
+    def test_get_json_is_streamed(self):
+        assert self.client.get_json("/config", select=lambda name, value: sorted(value)) == {"listeners": []}
+        with self.assertRaises(errors.Error) as ctx:
+            self.client.get_json("/config/missing")
+        assert str(ctx.exception) == "Value doesn't exist."
+        assert ctx.exception.not_found
+        # both responses were read completely: the connection is kept
+        assert self.client.get("/config") == '{"listeners": {}}'
+        assert self.server.connections == 1
+
+    def test_calls_are_recorded(self):
+        METRICS.reset()
+        self.client.put("/certificates/bundle", b"pem")
+        with self.assertRaises(errors.Error):
+            self.client.get("/config/missing")
+
+        calls = {(call["method"], call["path"], call["error"]): call for call in METRICS.summary()["api_calls"]}
+        assert calls[("PUT", "/certificates/{bundle}", "")]["request_bytes"] == 3
+        assert calls[("PUT", "/certificates/{bundle}", "")]["response_bytes"] == 36
+        assert calls[("GET", "/config/missing", "unit")]["count"] == 1
+        METRICS.reset()
+
+    def test_unreachable_socket(self):
+        client = UnitControl("unix:" + os.path.join(self.tempdir, "missing.sock"))
+        with self.assertRaises(errors.PluginError):
+            client.get("/config")
+
+    def test_discover(self):
+        with mock.patch("certbot_nginx_unit.unitc.DEFAULT_CONTROL_SOCKETS", ["/nonexistent", self.socket_path]):
+            assert UnitControl.discover().address == self.socket_path
+        with mock.patch("certbot_nginx_unit.unitc.DEFAULT_CONTROL_SOCKETS", ["/nonexistent"]):
+            assert UnitControl.discover() is None
+
+    def test_async_calls(self):
+        async_unitc = AsyncUnitc(self.client.clone, concurrency=2)
+        calls = [("PUT", "/certificates/bundle%d" % i, b"pem", "", "put failed") for i in range(5)]
+        calls.append(("GET", "/config/missing", None, "", "get failed"))
+        try:
+            results = async_unitc.run(calls)
+        finally:
+            async_unitc.close()
+
+        assert results[:5] == ['{"success": "Reconfiguration done."}'] * 5
+        assert isinstance(results[5], errors.Error)
+        uploaded = sorted(path for method, path, _ in self.server.requests if method == "PUT")
+        assert uploaded == ["/certificates/bundle%d" % i for i in range(5)]
+        assert self.server.connections <= 2
@@ -0,0 +1,174 @@
+"""Staged Nginx Unit configuration writes.
+
+Mutations are applied to the in-memory configuration and the touched paths are
+staged; commit compares every staged subtree with the configuration read from
+Unit and writes only what changed, so that a whole phase costs the fewest
+possible control API writes (each write is a Unit router reconfiguration).
+When writes are paced, the staged paths of a top-level section are merged
+into a single write of their closest common subtree.
+
+"""
+import copy
+import json
+import logging
+from typing import Any, Dict, List, Tuple
+
+from .diff import MISSING, Operation, diff
+from .unitc import Unitc
+
+logger = logging.getLogger(__name__)
+
+CONFIG_ROOT = "/config"
+
+
+def split_path(path: str) -> List[str]:
+    """Split a configuration path ("/listeners/*:80/pass") in its segments."""
+    return [segment for segment in path.split("/") if segment]
+
+
+def resolve(configuration: Any, path: str) -> Any:
+    """Value at ``path`` in ``configuration``, ``MISSING`` if it does not exist."""
+    value = configuration
+    for segment in split_path(path):
+        if isinstance(value, dict) and segment in value:
+            value = value[segment]
+        elif isinstance(value, list) and segment.isdigit() and int(segment) < len(value):
+            value = value[int(segment)]
+        else:
+            return MISSING
+    return value
+
+
+def store(configuration: Dict[str, Any], path: str, value: Any) -> None:
+    """Set (or remove when ``MISSING``) the value at ``path`` in ``configuration``."""
+    *parents, last = split_path(path)
+    container: Any = configuration
+    for segment in parents:
+        if isinstance(container, list):
+            container = container[int(segment)]
+        else:
+            container = container.setdefault(segment, {})
+    if isinstance(container, list):
+        if value is MISSING:
+            del container[int(last)]
+        else:
+            container[int(last)] = value
+    elif value is MISSING:
+        container.pop(last, None)
+    else:
+        container[last] = value
+
+
+def _is_ancestor(ancestor: str, path: str) -> bool:
+    ancestor_segments = split_path(ancestor)
+    return split_path(path)[:len(ancestor_segments)] == ancestor_segments
+
+
+def _common_ancestor(path: str, other: str) -> str:
+    segments = []
+    for segment, other_segment in zip(split_path(path), split_path(other)):
+        if segment != other_segment:
+            break
+        segments.append(segment)
+    return "/" + "/".join(segments)
+
+
+class ConfigTransaction:
+    """Paths of the Unit configuration changed in memory and not yet written.
+
+    :param bool merge: write each top-level section once, trading a larger request for
+        fewer reconfigurations
+
+    """
+
+    def __init__(self, merge: bool = False) -> None:
+        self.merge = merge
+        self._staged: Dict[str, Tuple[str, str]] = {}
+        self._snapshot: Dict[str, Any] = {}
+
+    def begin(self, configuration: Dict[str, Any]) -> None:
+        """Record ``configuration`` as the one currently applied by Unit."""
+        self._snapshot = copy.deepcopy(configuration)
+        self._staged.clear()
+
+    def record(self, path: str, value: Any) -> None:
+        """Record ``value`` as the one applied by Unit at ``path``, read after :meth:`begin`."""
+        store(self._snapshot, path, copy.deepcopy(value))
+
+    def stage(self, path: str, success_message: str = "", error_message: str = "") -> None:
+        """Mark the configuration subtree at ``path`` (relative to /config) as changed.
+
+        Subtrees are written in staging order: stage a route before the listener passing to it.
+
+        """
+        self._staged[path] = (success_message, error_message)
+
+    def staged_paths(self) -> List[str]:
+        """Staged paths in staging order, without those covered by a staged ancestor.
+
+        When merging, the paths of the same top-level section are replaced by their closest
+        common ancestor.
+
+        """
+        paths = [path for path in self._staged
+                 if not any(ancestor != path and _is_ancestor(ancestor, path) for ancestor in self._staged)]
+        if not self.merge:
+            return paths
+        merged: List[str] = []
+        for path in paths:
+            for index, other in enumerate(merged):
+                if split_path(other)[:1] == split_path(path)[:1]:
+                    merged[index] = _common_ancestor(other, path)
+                    break
+            else:
+                merged.append(path)
+        return merged
+
+    def _messages(self, path: str) -> Tuple[str, str]:
+        if path in self._staged:
+            return self._staged[path]
+        # a merged ancestor reports with the first path staged under it
+        return next(messages for staged, messages in self._staged.items() if _is_ancestor(path, staged))
+
+    def operations(self, configuration: Dict[str, Any]) -> List[Tuple[Operation, str, str]]:
+        """Operations (with their messages) turning the applied configuration into ``configuration``."""
+        operations = []
+        for path in self.staged_paths():
+            success_message, error_message = self._messages(path)
+            path_operations = diff(resolve(self._snapshot, path), resolve(configuration, path), path)
+            if self.merge and len(path_operations) > 1:
+                path_operations = [Operation("PUT", path, resolve(configuration, path))]
+            for operation in path_operations:
+                operations.append((operation, success_message, error_message))
+        return operations
+
+    def changed_paths(self, current: Dict[str, Any]) -> List[str]:
+        """Staged paths whose value in ``current`` is not the one recorded at :meth:`begin` anymore.
+
+        This is the compare step of a compare-and-swap update: when another process wrote
+        one of the staged subtrees, the update must be redone on a fresh read.
+
+        """
+        return [path for path in self.staged_paths() if resolve(current, path) != resolve(self._snapshot, path)]
+
+    def commit(self, unitc: Unitc, configuration: Dict[str, Any]) -> int:
+        """Write the staged changes of ``configuration`` and return the number of writes."""
+        writes = 0
+        for operation, success_message, error_message in self.operations(configuration):
+            path = CONFIG_ROOT + operation.path
+            if operation.method == "DELETE":
+                unitc.delete(path, None, success_message, error_message)
+            elif operation.method == "POST":
+                unitc.post(path, json.dumps(operation.value).encode(), success_message, error_message)
+            else:
+                unitc.put(path, json.dumps(operation.value).encode(), success_message, error_message)
+            writes += 1
+        for path in self.staged_paths():
+            store(self._snapshot, path, copy.deepcopy(resolve(configuration, path)))
+        logger.debug("Configuration transaction committed with %d writes", writes)
+        self._staged.clear()
+        return writes
+
+    def rollback(self) -> None:
+        """Forget the staged paths."""
+        self._staged.clear()
@@ -1,19 +1,68 @@
 from __future__ import annotations
 
+import http.client
+import os
+import socket
 import tempfile
 import subprocess
 import logging
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator, List, Tuple, Union
 from certbot import errors
-from certbot import util
-from certbot.display import util as display_util
+
+from . import jsonstream
+from .metrics import METRICS
+from .notify import notify
+
+if TYPE_CHECKING:
+    import asyncio
 
 logger = logging.getLogger(__name__)
 
+# size of the reads of a streamed response
+CHUNK_SIZE = 64 * 1024
+
+DEFAULT_CONTROL_SOCKETS = [
+    "/var/run/control.unit.sock",
+    "/var/run/unit/control.sock",
+    "/run/control.unit.sock",
+    "/run/unit/control.sock",
+    "/usr/local/var/run/unit/control.sock",
+    "/opt/homebrew/var/run/unit/control.sock",
+]
+
+
+NOT_FOUND = 404
+# errors of the missing values, the status of the responses read by the unitc command is unknown
+NOT_FOUND_ERRORS = ("Value doesn't exist.", "No certificates found.", "Certificate doesn't exist.")
+
+
+class UnitError(errors.Error):
+    """Error answered by the Nginx Unit control API.
+
+    :param int status: HTTP status of the response, None when unknown
+
+    """
+
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def not_found(self) -> bool:
+        """Whether the requested value does not exist."""
+        return self.status == NOT_FOUND
+
 
 class Unitc(object):
     def call(self, method: str, path: str, input_data: bytes | None = None,
              success_message: str = "", error_message: str = "") -> str:
+        # certbot.util pulls acme and requests in: only imported when running the unitc command
+        from certbot import util  # pylint: disable=import-outside-toplevel
+
         output = ""
+        start = time.monotonic()
         with tempfile.TemporaryFile() as out:
             try:
                 params = ["unitc", "--no-log", method, path]
@@ -25,16 +74,22 @@ class Unitc(object):
             except (OSError, ValueError):
                 msg = "Unable to run the command: %s" + " ".join(params)
                 logger.error(msg)
+                METRICS.record_call(method, path, len(input_data or b""), 0, time.monotonic() - start, "connection")
                 raise errors.SubprocessError(msg)
 
             out.seek(0)
-            output = out.read().decode("utf-8")
+            raw_output = out.read()
+            output = raw_output.decode("utf-8")
             logger.debug("Unitc result: %s", output)
-        # @todo from json check if error
-        if proc.returncode != 0 or '"error"' in output:
-            raise errors.Error(error_message)
-        else:
-            display_util.notify(success_message)
+        error = jsonstream.response_error(200 if proc.returncode == 0 else 500, raw_output)
+        METRICS.record_call(method, path, len(input_data or b""), len(output), time.monotonic() - start,
+                            "unit" if error else "")
+        if error:
+            logger.debug("Nginx Unit refused %s %s: %s", method, path, error)
+            status = NOT_FOUND if error.startswith(NOT_FOUND_ERRORS) else None
+            raise UnitError(error_message or error, status)
+        elif success_message:
+            notify(success_message)
 
         return output
 
@@ -44,5 +99,320 @@ class Unitc(object):
     def put(self, path: str, input_data: bytes | None = None, success_message: str = "", error_message: str = ""):
         self.call("PUT", path, input_data, success_message, error_message)
 
+    def post(self, path: str, input_data: bytes | None = None, success_message: str = "", error_message: str = ""):
+        self.call("POST", path, input_data, success_message, error_message)
+
     def delete(self, path: str, input_data: bytes | None = None, success_message: str = "", error_message: str = ""):
         self.call("DELETE", path, input_data, success_message, error_message)
+
+    def get_json(self, path: str, success_message: str = "", error_message: str = "",
+                 select: jsonstream.Select | None = None) -> Any:
+        """Parsed value at ``path``, the members of an object reduced by ``select`` as they are decoded."""
+        output = self.get(path, success_message, error_message)
+        try:
+            return jsonstream.decode([output.encode("utf-8")], select)
+        except ValueError as exception:
+            raise errors.Error(error_message or "Invalid JSON response: {0}".format(exception))
+
+    def clone(self) -> Unitc:
+        """Client with the same settings for use from another thread."""
+        return self
+
+    def close(self) -> None:
+        pass
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class UnitControl(Unitc):
+    """Nginx Unit control API client speaking HTTP/1.1 directly to the control socket.
+
+    The connection is opened on the first call and kept alive for the whole run.
+
+    :param str address: unix socket path (optionally prefixed by ``unix:``) or
+        ``host:port`` / ``http://host:port`` of a TCP control address
+    :param float timeout: socket timeout in seconds
+
+    """
+    IDEMPOTENT_METHODS = ("GET", "PUT", "DELETE")
+
+    def __init__(self, address: str, timeout: float = 30.0):
+        self.address = address
+        self.timeout = timeout
+        self._connection: http.client.HTTPConnection | None = None
+
+    def clone(self) -> UnitControl:
+        return UnitControl(self.address, self.timeout)
+
+    @classmethod
+    def discover(cls) -> UnitControl | None:
+        """Client for the first default control socket found, None otherwise."""
+        for socket_path in DEFAULT_CONTROL_SOCKETS:
+            if os.path.exists(socket_path):
+                logger.debug("Found Nginx Unit control socket %s", socket_path)
+                return cls(socket_path)
+        return None
+
+    def _connect(self) -> http.client.HTTPConnection:
+        address = self.address
+        if address.startswith("unix:"):
+            return _UnixHTTPConnection(address[len("unix:"):], self.timeout)
+        if address.startswith("http://"):
+            address = address[len("http://"):].rstrip("/")
+        elif address.startswith("/"):
+            return _UnixHTTPConnection(address, self.timeout)
+        return http.client.HTTPConnection(address, timeout=self.timeout)
+
+    def _send(self, method: str, path: str, input_data: bytes | None,
+              read: bool = True) -> tuple[http.client.HTTPResponse, bytes]:
+        """Response to the request and, when ``read``, its body, left to the caller otherwise."""
+        reused = self._connection is not None
+        if self._connection is None:
+            self._connection = self._connect()
+        try:
+            self._connection.request(method, path, body=input_data)
+            response = self._connection.getresponse()
+            body = response.read() if read else b""
+        except (http.client.HTTPException, OSError):
+            self.close()
+            # the server may have dropped an idle keep-alive connection: retry once on a fresh one
+            if not reused or method not in self.IDEMPOTENT_METHODS:
+                raise
+            return self._send(method, path, input_data, read)
+        if read and response.will_close:
+            self.close()
+        return response, body
+
+    def _request(self, method: str, path: str, input_data: bytes | None) -> tuple[int, bytes]:
+        response, body = self._send(method, path, input_data)
+        return response.status, body
+
+    def _unreachable(self, method: str, path: str, input_data: bytes | None, start: float,
+                     exception: Exception) -> errors.PluginError:
+        METRICS.record_call(method, path, len(input_data or b""), 0, time.monotonic() - start, "connection")
+        msg = "Unable to reach the Nginx Unit control API at {0}: {1}".format(self.address, exception)
+        logger.error(msg)
+        return errors.PluginError(msg)
+
+    def call(self, method: str, path: str, input_data: bytes | None = None,
+             success_message: str = "", error_message: str = "") -> str:
+        logger.debug("Unit control request: %s %s", method, path)
+        start = time.monotonic()
+        try:
+            status, body = self._request(method, path, input_data)
+        except (http.client.HTTPException, OSError) as exception:
+            raise self._unreachable(method, path, input_data, start, exception)
+
+        output = body.decode("utf-8")
+        logger.debug("Unit control result: %s %s", status, output)
+        error = jsonstream.response_error(status, body)
+        METRICS.record_call(method, path, len(input_data or b""), len(body), time.monotonic() - start,
+                            "unit" if error else "")
+        if error:
+            logger.debug("Nginx Unit refused %s %s: %s", method, path, error)
+            raise UnitError(error_message or error, status)
+        elif success_message:
+            notify(success_message)
+
+        return output
+
+    def get_json(self, path: str, success_message: str = "", error_message: str = "",
+                 select: jsonstream.Select | None = None) -> Any:
+        """Parsed value at ``path``, decoded while the response is read.
+
+        The members of an object are reduced by ``select`` as soon as they are decoded: the
+        whole body is never held in memory.
+
+        """
+        logger.debug("Unit control request: GET %s (streamed)", path)
+        start = time.monotonic()
+        try:
+            response, _ = self._send("GET", path, None, read=False)
+        except (http.client.HTTPException, OSError) as exception:
+            raise self._unreachable("GET", path, None, start, exception)
+
+        size = 0
+
+        def chunks() -> Iterator[bytes]:
+            nonlocal size
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                size += len(chunk)
+                yield chunk
+
+        value = None
+        try:
+            if response.status >= 400:
+                body = response.read()
+                size = len(body)
+                error = jsonstream.response_error(response.status, body)
+            else:
+                value = jsonstream.decode(chunks(), select)
+                error = None
+        except (http.client.HTTPException, OSError) as exception:
+            self.close()
+            raise self._unreachable("GET", path, None, start, exception)
+        except ValueError as exception:
+            error = "Invalid JSON response: {0}".format(exception)
+        if response.will_close or not response.isclosed():
+            self.close()
+        METRICS.record_call("GET", path, 0, size, time.monotonic() - start, "unit" if error else "")
+        if error:
+            logger.debug("Nginx Unit refused GET %s: %s", path, error)
+            raise UnitError(error_message or error, response.status)
+        elif success_message:
+            notify(success_message)
+        return value
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def create_unitc(control: str | None = None, use_unitc: bool = False) -> Unitc:
+    """Control API client for the ``control`` address, the unitc command or the local control socket."""
+    if use_unitc:
+        logger.debug("Using the unitc command for the control API")
+        return Unitc()
+    if control:
+        return UnitControl(control)
+    unit_control = UnitControl.discover()
+    if unit_control is None:
+        logger.info("No Nginx Unit control socket found, falling back to the unitc command")
+        return Unitc()
+    return unit_control
+
+
+Call = Tuple[str, str, Union[bytes, None], str, str]
+
+
+class AsyncUnitc(object):
+    """Asynchronous control API client running at most ``concurrency`` calls at a time.
+
+    Every call runs in a worker thread on an idle client made by ``factory``, so
+    that each concurrent call has its own control socket connection.
+
+    :param factory: returns a new client (e.g. ``UnitControl.clone``)
+    :param int concurrency: maximum number of calls in flight
+
+    """
+
+    def __init__(self, factory: Callable[[], Unitc], concurrency: int = 4):
+        self.factory = factory
+        self.concurrency = max(1, concurrency)
+        self._idle: List[Unitc] = []
+        self._clients: List[Unitc] = []
+        self._lock = threading.Lock()
+        self._semaphore: asyncio.Semaphore | None = None
+
+    def _acquire(self) -> Unitc:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            client = self.factory()
+            self._clients.append(client)
+            return client
+
+    def _release(self, client: Unitc) -> None:
+        with self._lock:
+            self._idle.append(client)
+
+    async def call(self, method: str, path: str, input_data: bytes | None = None,
+                   success_message: str = "", error_message: str = "") -> str:
+        import asyncio  # pylint: disable=import-outside-toplevel
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            client = self._acquire()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    None, client.call, method, path, input_data, success_message, error_message)
+            finally:
+                self._release(client)
+
+    async def put(self, path: str, input_data: bytes | None = None, success_message: str = "",
+                  error_message: str = "") -> str:
+        return await self.call("PUT", path, input_data, success_message, error_message)
+
+    async def delete(self, path: str, input_data: bytes | None = None, success_message: str = "",
+                     error_message: str = "") -> str:
+        return await self.call("DELETE", path, input_data, success_message, error_message)
+
+    async def _gather(self, calls: Iterable[Call]) -> List[str | BaseException]:
+        import asyncio  # pylint: disable=import-outside-toplevel
+
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            return await asyncio.gather(*(self.call(*call) for call in calls), return_exceptions=True)
+        finally:
+            self._semaphore = None
+
+    def run(self, calls: Iterable[Call]) -> List[str | BaseException]:
+        """Run ``calls`` (method, path, input data, messages) concurrently.
+
+        :returns: the output of each call, or the exception it raised, in the same order
+
+        """
+        # asyncio is only imported by the concurrent calls: the command line tools start without it
+        import asyncio  # pylint: disable=import-outside-toplevel
+
+        return asyncio.run(self._gather(calls))
+
+    def close(self) -> None:
+        with self._lock:
+            for client in self._clients:
+                client.close()
+            self._clients = []
+            self._idle = []
+
+
+def run_calls(unitc: Unitc, calls: List[Call], concurrency: int = 4,
+              pool: AsyncUnitc | None = None) -> List[str | BaseException]:
+    """Run independent PUT or DELETE calls, at most ``concurrency`` at a time.
+
+    :param pool: client whose connections are kept for the next calls, closed by the caller
+    :returns: the output of each call, or the error it raised, in the same order
+
+    """
+    if len(calls) <= 1:
+        results: List[str | BaseException] = []
+        for method, path, input_data, success_message, error_message in calls:
+            unitc_method = unitc.delete if method == "DELETE" else unitc.put
+            try:
+                results.append(unitc_method(path, input_data, success_message, error_message))
+            except errors.Error as exception:
+                results.append(exception)
+        return results
+
+    if pool is not None:
+        return pool.run(calls)
+    async_unitc = AsyncUnitc(unitc.clone, concurrency)
+    try:
+        return async_unitc.run(calls)
+    finally:
+        async_unitc.close()
+
+
+def raise_first_error(results: List[str | BaseException]) -> None:
+    """Raise the first error of the results of :func:`run_calls`."""
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result